@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-def quick_run():
+import sys
+import argparse
+
+
+def quick_run(use_reactor=None, workers=None, take_over=False):
   """Quick way of running the thing.
 
   Note that default right now is 'no async', which means, function won't
@@ -10,16 +14,64 @@ def quick_run():
   If async is off, then we can:
   >>> from quick_run import quick_run
   >>> bot = quick_run() # authenticate, subscribe to streaming api, get handle
+
+  With ``use_reactor`` (default: config.USE_REACTOR; or, from the command
+  line, --reactor), everything runs on the Twisted reactor instead, with
+  non-blocking API calls. Returns once the bot is stopped.
+
+  With ``workers`` > 1 (default: config.WORKERS; or --workers N), this
+  process only reads the userstream, and events are handled by that many
+  worker processes (see ``twidibot.workers``.)
+
+  If config.EXTRA_ACCOUNTS are set, all accounts run side by side (see
+  ``twidibot.accounts``.)
+
+  With ``take_over`` (--take-over), the bot takes over from the one already
+  running (a single account, without workers), which then exits; for
+  restarts without downtime (see ``twidibot.handoff``.)
   """
 
+  from twidibot import config
   from twidibot.twitter_bot import TwitterBot
 
-  bot = TwitterBot()
+  workers = config.WORKERS if workers is None else workers
+  use_reactor = config.USE_REACTOR if use_reactor is None else use_reactor
+  if take_over and (workers > 1 or config.EXTRA_ACCOUNTS):
+    raise ValueError('Taking over works with a single account, without '
+        'workers.')
+  if workers > 1:
+    from twidibot.workers import StreamDispatcher
+    bot = StreamDispatcher(workers)
+  elif config.EXTRA_ACCOUNTS:
+    from twidibot.accounts import BotAccounts
+    accounts = BotAccounts.fromConfig()
+    accounts.run(use_reactor)
+    return accounts
+  else:
+    bot = TwitterBot(take_over=take_over)
+    if not take_over:
+      bot.startHandoffServer() # (otherwise, once it has taken over)
+    if use_reactor:
+      bot.runReactor()
+      return bot
+
   bot.authenticate()
   #bot.api.update_status('yup!')
   bot.subscribeToStreams()
 
   return bot
 
+def main(argv):
+  parser = argparse.ArgumentParser(description='Run the bot.')
+  parser.add_argument('--reactor', action='store_true', default=None,
+      help='run on the Twisted reactor, with non-blocking API calls')
+  parser.add_argument('--workers', type=int, help='handle events in this '
+      'many worker processes')
+  parser.add_argument('--take-over', action='store_true', help='take over '
+      'from the bot already running, without downtime')
+  args = parser.parse_args(argv[1:])
+  quick_run(use_reactor=args.reactor, workers=args.workers,
+      take_over=args.take_over)
+
 if __name__ == '__main__':
-  quick_run()
+  main(sys.argv)
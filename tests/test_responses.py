@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for ``twidibot.responses.ReplyBuffer`` packing and sending.
+
+  python -m unittest discover tests
+"""
+
+import unittest
+
+from twidibot.responses import ReplyBuffer
+
+
+class FakeCatalog(object):
+  """Canned responses as one chunk each: their message ID."""
+
+  def chunks(self, message_id, locale=None):
+    return [message_id]
+
+
+def bridgeLines(count, length=100):
+  return '\n'.join('obfs3 192.0.2.%d:443 %s' % (i, 'A' * length)
+      for i in xrange(count))
+
+
+class ReplyBufferTest(unittest.TestCase):
+  def makeReply(self, bridges, character_limit=280):
+    reply = ReplyBuffer(FakeCatalog(), character_limit)
+    reply.add(bridges, tag='bridges')
+    reply.addResponse('unfollow_notice', requires=['bridges'])
+    return reply
+
+  def sendFailingFirst(self, reply):
+    sent, attempts = list(), list()
+    def send(text):
+      attempts.append(text)
+      if len(attempts) == 1:
+        raise IOError('failed')
+      sent.append(text)
+    errors = list()
+    reply.flush(send, done=errors.extend)
+    return sent, errors
+
+  def testRequirementMetWithinOneDM(self):
+    reply = self.makeReply(bridgeLines(1))
+    messages = reply.pack()
+    self.assertEqual(len(messages), 1)
+    self.assertTrue(messages[0][0].endswith('unfollow_notice'))
+
+  def testRequiredTagSpanningDMs(self):
+    # (the notice fits in with the last of the bridges, but mustn't go
+    # there: it would go out even if an earlier bridges DM failed)
+    reply = self.makeReply(bridgeLines(3))
+    messages = reply.pack()
+    self.assertEqual([text for text, _, _ in messages
+        if 'unfollow_notice' in text], ['unfollow_notice'])
+    self.assertEqual(messages[-1][2], frozenset(['bridges']))
+
+  def testNoticeNotSentIfBridgesFailed(self):
+    reply = self.makeReply(bridgeLines(3))
+    sent, errors = self.sendFailingFirst(reply)
+    self.assertEqual(len(errors), 1)
+    self.assertFalse(any('unfollow_notice' in text for text in sent))
+    self.assertFalse(reply.sent('bridges'))
+
+  def testNoticeSentWithBridges(self):
+    reply = self.makeReply(bridgeLines(3))
+    sent = list()
+    reply.flush(sent.append)
+    self.assertEqual(sent[-1], 'unfollow_notice')
+    self.assertTrue(reply.sent('bridges'))
+
+
+if __name__ == '__main__':
+  unittest.main()
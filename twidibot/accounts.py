@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Several bot accounts in one deployment.
+
+Per-account limits (on DMs sent, users followed) cap what one account can
+do, however fast the bot is. ``BotAccounts`` runs a ``TwitterBot`` for each
+of the accounts in config (the main one, plus config.EXTRA_ACCOUNTS), each
+with its own credentials, userstream and outbound rate budgets
+(config.DM_BUDGET, config.FOLLOW_BUDGET.)
+
+All of them share one state (churn control, challenge-responses) and bridge
+getter, so asking a second account for bridges within MIN_REREQUEST_TIME
+gets a user nothing they wouldn't get from the first one.
+
+Streams are read in a thread per account, or all on the reactor.
+"""
+
+import sys
+import time
+import signal
+
+from twidibot import config
+from twidibot.logger import log
+from twidibot.twitter_bot import TwitterBot
+
+
+class BotAccounts(object):
+  def __init__(self, accounts):
+    """``accounts`` is a list of access config dicts (see
+    ``TwitterBot.default_access_config``.) The first account's bot owns the
+    shared state."""
+
+    self.bots = list()
+    for access_config in accounts:
+      self.bots.append(TwitterBot(
+          shared_with=self.bots[0] if self.bots else None, **access_config))
+    self.storage_controller = self.bots[0].storage_controller
+    self.reactor = None
+    self.stopping = False
+
+    # instead of the first bot's handlers, which only know about its stream:
+    signal.signal(signal.SIGTERM, self.handleSIGTERM)
+    signal.signal(signal.SIGINT, self.handleSIGTERM)
+
+  @classmethod
+  def fromConfig(cls):
+    return cls([TwitterBot.default_access_config] +
+        list(config.EXTRA_ACCOUNTS))
+
+  def run(self, use_reactor=False):
+    """Authenticate and subscribe to the userstream, for every account.
+
+    Blocks (until SIGTERM / SIGINT), unless streaming asynchronously
+    (config.ASYNC_STREAMING_API.)
+    """
+
+    if use_reactor:
+      for bot in self.bots:
+        bot.startOnReactor()
+      self.reactor = self.bots[0].reactor
+      self.reactor.run(installSignalHandlers=False)
+      return
+
+    for bot in self.bots:
+      bot.authenticate()
+      bot.subscribeToStreams(in_background=True)
+    log.info("Running %d bot accounts.", len(self.bots))
+
+    if not config.ASYNC_STREAMING_API:
+      while True:
+        signal.pause()
+
+  def handleSIGTERM(self, sig_number, stack_frame):
+    log.info("BotAccounts::handleSIGTERM(): caught signal %d.", sig_number)
+    if self.stopping:
+      log.info("Already shutting down.")
+      return
+    self.stopping = True
+    deadline = time.time() + config.SHUTDOWN_DEADLINE
+    if self.reactor is not None:
+      self.reactor.callFromThread(self.stop, deadline)
+      return
+    self.stop(deadline)
+    log.info("Exiting program.")
+    sys.exit(0)
+
+  def stop(self, deadline):
+    """Shut every bot down by ``deadline`` (see ``TwitterBot.drain()``.)"""
+
+    for bot in self.bots:
+      bot.stopIntake()
+    if self.reactor is not None:
+      for bot in self.bots:
+        bot.stopOnReactor()
+      self.bots[0].whenIdle(deadline - config.SHUTDOWN_SAVE_TIME, self.finish,
+          self.bots)
+      return
+    for bot in self.bots:
+      # (the first one drains the scheduler they share)
+      bot.drain(deadline)
+    self.finish()
+
+  def finish(self):
+    for bot in self.bots:
+      bot.stopUnfollowQueue()
+
+    log.info("Closing down storage controller.")
+    self.storage_controller.closeAll()
+
+    if self.reactor is not None:
+      log.info("Stopping reactor.")
+      self.reactor.stop()
+
+
+if __name__ == '__main__':
+  pass
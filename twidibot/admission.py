@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Admission control: which DMs get handled at all, under load.
+
+Every DM to the bot (after duplicates are dropped) is checked, in order,
+against:
+
+  * the sender's own budget (``user_budget``: so many requests per period);
+    over it, the DM is dropped, silently
+  * the latency target: if a new bridge request would wait longer than that
+    in the scheduler queue, it is shed. Answers to pending challenges are
+    still admitted (their sender is already waiting on us)
+  * the global budget (``budget``: requests per period, for the whole bot)
+
+A shed request's sender gets a short "busy, try later" reply (pre-rendered,
+see ``responses``), at most once per ``busy_reply_interval``; so during a
+surge, the bot keeps answering the users it admitted in bounded time,
+instead of falling behind for everyone.
+
+Without a scheduler (on the reactor, or with SCHEDULER_THREADS = 0), there
+is no queue to measure, so only the budgets apply.
+"""
+
+from twidibot import metrics
+from twidibot.helpers import TokenBucket, ExpiringLRUCache
+from twidibot.scheduler import CR_ANSWER
+
+
+ADMIT = 'admitted'
+DROP = 'dropped_user_budget'
+SHED_LATENCY = 'shed_latency'
+SHED_BUDGET = 'shed_budget'
+
+decisions = metrics.counter('twidibot_admission_total',
+    'Admission decisions for incoming direct messages.', 'decision')
+
+
+class AdmissionController(object):
+  def __init__(self, budget, user_budget, latency_target,
+      busy_reply_interval=3600, max_users=100000):
+    """``budget`` and ``user_budget`` are (count, per this many seconds);
+    ``latency_target`` is in seconds (None: no target.)"""
+
+    self.budget = TokenBucket.perPeriod(*budget)
+    self.user_budget = user_budget
+    self.latency_target = latency_target
+    # one bucket per recent sender; after a whole period, it'd be full again
+    # anyway, so it can go:
+    self.user_budgets = ExpiringLRUCache(max_users,
+        expiry_time=user_budget[1])
+    self.busy_notified = ExpiringLRUCache(max_users,
+        expiry_time=busy_reply_interval)
+
+  def decide(self, user_id, priority, scheduler=None):
+    """Admission decision for a DM from ``user_id``, of scheduling class
+    ``priority``."""
+
+    bucket = self.user_budgets.get(user_id)
+    if bucket is None:
+      bucket = TokenBucket.perPeriod(*self.user_budget)
+      if not self.user_budgets.setIfAbsent(user_id, bucket):
+        bucket = self.user_budgets.get(user_id, bucket)
+    if not bucket.take():
+      decision = DROP
+    elif self.latency_target and scheduler is not None and \
+        priority > CR_ANSWER and \
+        scheduler.expectedWait(priority) > self.latency_target:
+      decision = SHED_LATENCY
+    elif not self.budget.take():
+      decision = SHED_BUDGET
+    else:
+      decision = ADMIT
+    decisions.inc(decision)
+    return decision
+
+  def shouldNotify(self, user_id):
+    """Whether to send ``user_id`` the busy reply now (once per
+    ``busy_reply_interval``.)"""
+
+    return self.busy_notified.setIfAbsent(user_id, True)
+
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Non-blocking Twitter client, on the Twisted reactor.
+
+``AsyncTwitterClient`` makes OAuth-signed REST calls over persistent
+(keep-alive) connections, returning Deferreds which fire with the parsed JSON
+response (or fail with ``TwitterAPIError``.)
+
+``DeferredTwitterAPI`` puts the subset of the ``tweepy.API`` interface that
+``TwitterBot`` uses in front of it, so the bot's request handling code can
+stay as it is: calls return Deferreds instead of results. Direct messages
+(and unfollows) to the same user are sent one after another, in order;
+everything else runs concurrently.
+
+``AsyncUserStream`` reads the userstream on the reactor, too, so that a
+single reactor-driven process can have many requests in flight without a
+thread per request. See ``TwitterBot.runReactor()``.
+"""
+
+import hmac
+import time
+import json
+import base64
+import random
+import urllib
+import hashlib
+import urlparse
+from StringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Protocol
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, \
+    readBody
+from twisted.web.http_headers import Headers
+
+import tweepy.parsers
+
+from twidibot import metrics
+from twidibot.logger import log, UserRef
+
+
+API_ROOT = '/1.1'
+
+
+def quote(value):
+  """Percent-encode as OAuth wants it (RFC 3986)"""
+
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  return urllib.quote(str(value), safe='~')
+
+def oauthHeader(method, url, params, consumer_key, consumer_secret, token,
+    token_secret, nonce=None, timestamp=None):
+  """Return an OAuth 1.0a (HMAC-SHA1) Authorization header value.
+
+  ``url`` may contain a query string; ``params`` are any (form-encoded) body
+  parameters.
+  """
+
+  scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+  oauth_params = {
+    'oauth_consumer_key': consumer_key,
+    'oauth_nonce': nonce or '%032x' % random.getrandbits(128),
+    'oauth_signature_method': 'HMAC-SHA1',
+    'oauth_timestamp': str(timestamp or int(time.time())),
+    'oauth_token': token,
+    'oauth_version': '1.0',
+  }
+  all_params = urlparse.parse_qsl(query, keep_blank_values=True) + \
+      list(params.items()) + oauth_params.items()
+  param_string = '&'.join('%s=%s' % pair for pair in sorted(
+      (quote(k), quote(v)) for k, v in all_params))
+  base_string = '&'.join((method.upper(),
+      quote('%s://%s%s' % (scheme, netloc.lower(), path)),
+      quote(param_string)))
+  key = '%s&%s' % (quote(consumer_secret), quote(token_secret))
+  oauth_params['oauth_signature'] = base64.b64encode(
+      hmac.new(key, base_string, hashlib.sha1).digest())
+  return 'OAuth ' + ', '.join('%s="%s"' % (quote(k), quote(v))
+      for k, v in sorted(oauth_params.iteritems()))
+
+
+class TwitterAPIError(Exception):
+  def __init__(self, status, body):
+    super(TwitterAPIError, self).__init__('Twitter API error %s: %s' % (
+        status, body[:200]))
+    self.status = status
+    self.body = body
+
+
+class TwitterObject(object):
+  """Attribute access to a parsed JSON object (e.g. a user)."""
+
+  def __init__(self, data):
+    self.__dict__.update(data)
+
+
+class AsyncTwitterClient(object):
+  """OAuth-signed Twitter REST calls returning Deferreds."""
+
+  def __init__(self, access_config, host='api.twitter.com', secure=True,
+      timeout=20, max_connections=8):
+    self.access_config = access_config
+    self.base_url = '%s://%s%s' % ('https' if secure else 'http', host,
+        API_ROOT)
+    self.timeout = timeout
+    self.pool = HTTPConnectionPool(reactor, persistent=True)
+    self.pool.maxPersistentPerHost = max_connections
+    self.agent = Agent(reactor, connectTimeout=timeout, pool=self.pool)
+    self.pending = set() # Deferreds of the calls in flight
+
+  def authorization(self, method, url, params):
+    return oauthHeader(method, url, params,
+        self.access_config['api_key'], self.access_config['api_secret'],
+        self.access_config['access_token'],
+        self.access_config['token_secret'])
+
+  def request(self, method, path, params=None):
+    """Make a REST call; the Deferred fires with the decoded JSON."""
+
+    params = dict((k, v.encode('utf-8') if isinstance(v, unicode) else str(v))
+        for k, v in (params or {}).iteritems() if v is not None)
+    url = self.base_url + path
+    headers = Headers({'User-Agent': ['twidibot']})
+    body = None
+    if method == 'GET':
+      if params:
+        url += '?' + urllib.urlencode(sorted(params.items()))
+      headers.addRawHeader('Authorization',
+          self.authorization(method, url, {}))
+    else:
+      headers.addRawHeader('Authorization',
+          self.authorization(method, url, params))
+      headers.addRawHeader('Content-Type',
+          'application/x-www-form-urlencoded')
+      body = FileBodyProducer(StringIO(urllib.urlencode(params)))
+
+    d = self.agent.request(method, url, headers, body)
+    timeout = reactor.callLater(self.timeout, d.cancel)
+    self.pending.add(d)
+
+    def gotResponse(response):
+      return readBody(response).addCallback(gotBody, response.code)
+
+    def gotBody(body, code):
+      if code != 200:
+        raise TwitterAPIError(code, body)
+      return json.loads(body)
+
+    def done(result):
+      if timeout.active():
+        timeout.cancel()
+      self.pending.discard(d)
+      return result
+
+    d.addCallback(gotResponse)
+    d.addBoth(done)
+    return d
+
+  def sendDirectMessage(self, user_id, text):
+    return self.request('POST', '/direct_messages/new.json',
+        {'user_id': user_id, 'text': text})
+
+  def getUser(self, user_id=None, screen_name=None):
+    return self.request('GET', '/users/show.json',
+        {'user_id': user_id, 'screen_name': screen_name})
+
+  def createFriendship(self, user_id):
+    return self.request('POST', '/friendships/create.json',
+        {'user_id': user_id})
+
+  def destroyFriendship(self, user_id):
+    return self.request('POST', '/friendships/destroy.json',
+        {'user_id': user_id})
+
+  def verifyCredentials(self):
+    return self.request('GET', '/account/verify_credentials.json')
+
+  def followers(self, cursor=-1):
+    return self.request('GET', '/followers/list.json', {'cursor': cursor})
+
+
+class AsyncUserHandle(object):
+  """What ``DeferredTwitterAPI.get_user()`` returns: (un)follow without
+  fetching the user first."""
+
+  def __init__(self, api, user_id):
+    self.api = api
+    self.id = user_id
+
+  def follow(self):
+    return self.api.create_friendship(id=self.id).addErrback(self.failed,
+        'follow')
+
+  def unfollow(self):
+    return self.api.destroy_friendship(id=self.id).addErrback(self.failed,
+        'unfollow')
+
+  def failed(self, failure, action):
+    log.warning("Failed to %s user %s: %s", action, UserRef(self.id),
+        failure.getErrorMessage())
+
+
+class DeferredTwitterAPI(object):
+  """The part of ``tweepy.API`` used by the bot; calls return Deferreds.
+
+  Calls concerning the same user that have to happen in order (direct
+  messages and unfollows) are chained one after another.
+  """
+
+  def __init__(self, client):
+    self.client = client
+    self.parser = tweepy.parsers.ModelParser() # used by ``Status.parse()``
+    self._chains = dict() # user id => Deferred of the last call in line
+
+  def _inOrder(self, user_id, call, *args):
+    """Make ``call(*args)`` once earlier calls for ``user_id`` are done."""
+
+    previous = self._chains.get(user_id)
+    if previous is None:
+      d = call(*args)
+    else:
+      d = Deferred()
+      # wait for the previous call (whatever its outcome), then make ours:
+      previous.addBoth(lambda _: call(*args).chainDeferred(d))
+    self._chains[user_id] = tail = Deferred()
+    d.addBoth(self._chainDone, user_id, tail)
+    return d
+
+  def _chainDone(self, result, user_id, tail):
+    if self._chains.get(user_id) is tail:
+      del self._chains[user_id]
+    tail.callback(None)
+    return result
+
+  def send_direct_message(self, user_id=None, text=None, **kw):
+    start = time.time()
+    d = self._inOrder(user_id, self.client.sendDirectMessage, user_id, text)
+
+    def sent(result):
+      metrics.stage_latency.observe(time.time() - start, 'send_inflight')
+      return result
+    return d.addCallback(sent)
+
+  def get_user(self, id=None, **kw):
+    return AsyncUserHandle(self, id)
+
+  def create_friendship(self, id=None, **kw):
+    return self.client.createFriendship(id)
+
+  def destroy_friendship(self, id=None, **kw):
+    return self._inOrder(id, self.client.destroyFriendship, id)
+
+  def verify_credentials(self, **kw):
+    return self.client.verifyCredentials().addCallback(TwitterObject)
+
+  def me(self):
+    return self.verify_credentials()
+
+  def inFlight(self):
+    """How many calls haven't returned yet."""
+
+    return len(self.client.pending)
+
+
+class UserStreamProtocol(Protocol):
+  """Splits a length-delimited userstream into messages for the listener."""
+
+  def __init__(self, stream, finished):
+    self.stream = stream
+    self.finished = finished
+    self.buffer = ''
+
+  def dataReceived(self, data):
+    self.buffer += data
+    while self.stream.running:
+      self.buffer = self.buffer.lstrip('\r\n') # keep-alive newlines
+      line_end = self.buffer.find('\r\n')
+      if line_end < 0:
+        return
+      length = self.buffer[:line_end]
+      if not length.isdigit():
+        log.warning("AsyncUserStream: unexpected data on stream; dropping "
+            "what we have buffered.")
+        self.buffer = ''
+        return
+      end = line_end + 2 + int(length)
+      if len(self.buffer) < end:
+        return
+      raw_data, self.buffer = self.buffer[line_end + 2:end], self.buffer[end:]
+      if self.stream.listener.on_data(raw_data) is False:
+        self.stream.running = False
+        self.transport.stopProducing()
+        return
+
+  def connectionLost(self, reason):
+    self.stream.protocol = None
+    self.finished.callback(None)
+
+
+class AsyncUserStream(object):
+  """Reads the userstream on the reactor, reconnecting (with backoff) if the
+  connection is lost."""
+
+  MIN_RETRY_TIME = 5.0
+  MAX_RETRY_TIME = 320.0
+
+  def __init__(self, client, listener, host='userstream.twitter.com',
+      secure=True):
+    self.client = client
+    self.listener = listener
+    self.url = '%s://%s%s/user.json?delimited=length' % (
+        'https' if secure else 'http', host, API_ROOT)
+    self.agent = Agent(reactor, connectTimeout=client.timeout)
+    self.running = False
+    self.retry_time = self.MIN_RETRY_TIME
+    self.protocol = None # while connected
+
+  def start(self):
+    self.running = True
+    self.connect()
+
+  def stop(self):
+    """Stop reading the stream (dropping whatever is buffered.)"""
+
+    self.running = False
+    if self.protocol is not None:
+      self.protocol.transport.stopProducing()
+
+  def connect(self):
+    headers = Headers({'User-Agent': ['twidibot']})
+    headers.addRawHeader('Authorization',
+        self.client.authorization('POST', self.url, {}))
+    d = self.agent.request('POST', self.url, headers)
+    d.addCallback(self.gotResponse)
+    d.addErrback(self.failed)
+
+  def gotResponse(self, response):
+    if response.code != 200:
+      self.listener.on_error(response.code)
+      if response.code == 420:
+        self.retry_time = max(self.retry_time, 60.0)
+      return self.reconnectLater()
+    log.info("AsyncUserStream: connected to userstream")
+    self.retry_time = self.MIN_RETRY_TIME
+    self.listener.on_connect()
+    finished = Deferred()
+    self.protocol = UserStreamProtocol(self, finished)
+    response.deliverBody(self.protocol)
+    if not self.running: # (stopped while connecting)
+      self.protocol.transport.stopProducing()
+    finished.addCallback(lambda _: self.reconnectLater())
+
+  def failed(self, failure):
+    log.warning("AsyncUserStream: %s", failure.getErrorMessage())
+    self.reconnectLater()
+
+  def reconnectLater(self):
+    if not self.running:
+      return
+    log.info("AsyncUserStream: reconnecting in %.0f s", self.retry_time)
+    reactor.callLater(self.retry_time, self.connect)
+    self.retry_time = min(self.retry_time * 2, self.MAX_RETRY_TIME)
+
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmarks for the bot's hot paths.
+
+Covers ``on_data()`` parsing per event type, DM request parsing with up to
+hundreds of transports and command phrases, ``sendMessage()`` chunking (and
+``sendResponse()``, with pre-chunked canned responses), churn control and
+challenge-response operations at various user counts, logging (straight to a
+file, and queued for the ``logger``'s writer thread), persisting / loading
+state at scale, and startup: importing the bot, and a fresh bot process's
+first reply (with some state to load.) With --state-server HOST:PORT, also
+state server round trips (see ``remote_storage``.)
+
+  python -m twidibot.benchmarks --json > results.json
+  python -m twidibot.benchmarks --save-baseline baseline.json
+  python -m twidibot.benchmarks --baseline baseline.json --threshold 0.2
+
+When comparing against a baseline, benchmarks slower than the baseline by more
+than the threshold (a fraction) are flagged as regressions, and the exit
+status is 1. Timings are per operation, best of ``--repeat`` runs.
+
+Startup benchmarks also have a fixed budget (``BUDGETS``, in seconds); going
+over it makes the exit status 1, too, baseline or not.
+"""
+
+import os
+import re
+import gc
+import sys
+import json
+import time
+import shutil
+import logging
+import hashlib
+import argparse
+import tempfile
+import subprocess
+import platform
+import itertools
+
+from twidibot import config
+from twidibot.helpers import gpDump, gpLoad
+from twidibot.bot_storage import PersistableStorageContainer, ShardedDict
+from twidibot.churn_control import ChurnController, BloomChurnController
+from twidibot.challenge_response import BogusTextBasedChallengeResponseSystem
+from twidibot.request_parser import RequestParser
+from twidibot.stream_replay import FakeTwitterAPI, direct_message_json, \
+    follow_json, delete_json, user_json, unlimit_budgets
+
+
+DEFAULT_SIZES = (10 ** 4, 10 ** 6, 10 ** 7)
+MIN_RUN_TIME = 0.2 # seconds; calibrate the number of ops per run to this
+LONG_OP_TIME = 5.0 # seconds; a single op this slow is only run once
+
+STARTUP_STATE_USERS = 10 ** 5 # in the state a new bot process loads
+BUDGETS = {
+  'startup.import': 0.5,
+  'startup.first_reply': 1.5,
+}
+
+# (run in a new process, in a directory with state files in it:)
+FIRST_REPLY_SCRIPT = '''
+import os, json, time
+from twidibot import config
+config.LOG_FILE = 'main.log'
+config.LOG_TO_CONSOLE_TOO = False
+config.METRICS_HTTP_PORT = None
+config.PROFILING_SIGNALS = False
+config.TRACE_SAMPLE_RATE = 0
+config.DO_CHALLENGE_RESPONSE = False
+from twidibot.twitter_bot import TwitterBot, TwitterBotStreamListener
+from twidibot.stream_replay import FakeTwitterAPI, direct_message_json, \
+    unlimit_budgets
+unlimit_budgets()
+api = FakeTwitterAPI()
+bot = TwitterBot()
+bot.api = api
+bot.bot_info = api.me()
+listener = TwitterBotStreamListener(bot=bot, api=api)
+listener.on_data(json.dumps(direct_message_json(1, 1000, 'get bridges')))
+while not api.sent_messages:
+  time.sleep(0.001)
+os._exit(0)
+'''
+
+
+def timeOps(fn, repeat=3):
+  """Time ``fn()``, returning (best seconds per op, ops per run)."""
+
+  start = time.time()
+  fn()
+  single = time.time() - start
+  if single >= LONG_OP_TIME:
+    return single, 1
+
+  number = max(1, int(MIN_RUN_TIME / single) if single else 1000)
+  best = None
+  for _ in range(repeat):
+    run = itertools.repeat(None, number)
+    start = time.time()
+    for _ in run:
+      fn()
+    per_op = (time.time() - start) / number
+    best = per_op if best is None or per_op < best else best
+  return best, number
+
+
+class NullBot(object):
+  """Just enough of a ``TwitterBot`` for the listener to dispatch to."""
+
+  def __init__(self, api):
+    self.bot_info = api.bot_user
+    self.watchdog = None
+    self.scheduler = None
+
+  def waitForState(self):
+    pass
+
+  def priorityOf(self, event_type, status):
+    return None
+
+  def isRepeatMessage(self, status):
+    return False
+
+  def isRepeatEvent(self, status):
+    return False
+
+  def admitMessage(self, status, priority):
+    return True
+
+  def handleFollowEvent(self, event):
+    pass
+
+  def handleDirectMessage(self, status):
+    pass
+
+
+def makeUserContainer(size, timestamp=1400000000):
+  container = PersistableStorageContainer('benchmark')
+  container.users = ShardedDict((hashlib.sha1('user%d' % i).hexdigest(),
+      timestamp) for i in xrange(size))
+  return container
+
+
+def benchOnData():
+  from twidibot.twitter_bot import TwitterBotStreamListener
+
+  api = FakeTwitterAPI()
+  listener = TwitterBotStreamListener(bot=NullBot(api), api=api)
+  events = {
+    'dm': direct_message_json(1, 1000, 'get bridges obfs3'),
+    'follow': follow_json(1000),
+    'delete': delete_json(1, 1000),
+    'status': {'in_reply_to_status_id': None, 'id': 1, 'text': 'a tweet',
+        'user': user_json(1000)},
+    'limit': {'limit': {'track': 10}},
+  }
+  for kind, data in sorted(events.iteritems()):
+    raw_data = json.dumps(data)
+    yield 'on_data.%s' % kind, lambda: listener.on_data(raw_data)
+
+def benchRequestParser():
+  for size in (len(config.KNOWN_PT_TYPES), 100, 500):
+    transports = list(config.KNOWN_PT_TYPES) + ['pt%d' % i for i in
+        range(size - len(config.KNOWN_PT_TYPES))]
+    command_words = dict(config.COMMAND_WORDS)
+    for i in range(size / 10): # a couple of phrases for each extra locale
+      command_words['x%d' % i] = {'get': ('get%d' % i, 'fetch %d' % i),
+          'bridges': ('bridges%d' % i,), 'get_bridges': ('getbridges%d' % i,)}
+    parser = RequestParser(transports, command_words)
+    messages = itertools.cycle([u'get bridges', u'get bridges obfs3',
+        u'Could you please get me some bridges? fte or pt%d' % (size / 2),
+        u'12', u'\u0434\u0430\u0439 \u043c\u043e\u0441\u0442\u044b'])
+    yield 'request_parser.parse.%d' % size, \
+        lambda: parser.parse(messages.next())
+
+def benchSendMessage():
+  from twidibot.stream_replay import build_bot
+
+  bot = build_bot(FakeTwitterAPI())
+  messages = {
+    'short': 'Please wait a while before requesting bridges again!',
+    'bridges': 'Some bridges for you:\n' + '\n'.join(
+        'obfs3 10.0.0.%d:443 %s' % (i, hashlib.sha1(str(i)).hexdigest())
+        for i in range(3)),
+    'long_line': 'x' * (config.CHARACTER_LIMIT * 5),
+  }
+  for kind, message in sorted(messages.iteritems()):
+    yield 'sendMessage.%s' % kind, lambda: bot.sendMessage(1000, message)
+  for message_id in ('greeting', 'churn_notice'):
+    yield 'sendResponse.%s' % message_id, \
+        lambda: bot.sendResponse(1000, message_id)
+
+def benchChurn(sizes, wanted):
+  for size in sizes:
+    for prefix, controller_class in (('churn', ChurnController),
+        ('churn_bloom', BloomChurnController)):
+      if not any(wanted('%s.%s.%d' % (prefix, name, size)) for name in
+          ('canGiveBridgesToUser', 'addOrUpdateUser', 'checkAndUpdateUser')):
+        continue # don't build big containers for nothing
+      if controller_class is ChurnController:
+        controller = ChurnController(makeUserContainer(size))
+      elif size <= 10 ** 6: # (filling the filter takes a while)
+        # a filter sized for (and holding) ``size`` recent users:
+        controller = BloomChurnController(
+            makeUserContainer(size, time.time()), capacity=size)
+        controller.bloomFilter() # (moves the users into it)
+      else:
+        continue
+      handles = itertools.cycle(['user%d' % i for i in range(0, 2 * size,
+          max(1, size / 500))]) # mix of known and unknown users
+      yield '%s.canGiveBridgesToUser.%d' % (prefix, size), \
+          lambda: controller.canGiveBridgesToUser(handles.next(),
+              expiry_time=config.MIN_REREQUEST_TIME)
+      yield '%s.addOrUpdateUser.%d' % (prefix, size), \
+          lambda: controller.addOrUpdateUser(handles.next(), time.time())
+      yield '%s.checkAndUpdateUser.%d' % (prefix, size), \
+          lambda: controller.checkAndUpdateUser(handles.next(),
+              expiry_time=config.MIN_REREQUEST_TIME)
+      controller = None
+      gc.collect()
+
+def benchChallengeResponse():
+  container = PersistableStorageContainer('benchmark')
+  container.users = ShardedDict()
+  cr = BogusTextBasedChallengeResponseSystem(container)
+  handles = itertools.cycle(['user%d' % i for i in range(1000)])
+  for i in range(1000):
+    cr.generateChallengeForUser('user%d' % i, None)
+  yield 'cr.generateChallengeForUser', \
+      lambda: cr.generateChallengeForUser(handles.next(), None)
+  yield 'cr.checkUserAnswer', \
+      lambda: cr.checkUserAnswer(handles.next(), '12')
+
+def benchLogging():
+  from twidibot.logger import LogWriter, QueueHandler, BatchingFileHandler, \
+      UserRef
+
+  directory = tempfile.mkdtemp(prefix='twidibot-bench-')
+  try:
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s ')
+    sync_handler = logging.FileHandler(os.path.join(directory, 'sync.log'))
+    file_handler = BatchingFileHandler(os.path.join(directory, 'queued.log'))
+    for handler in (sync_handler, file_handler):
+      handler.setFormatter(formatter)
+    writer = LogWriter([file_handler], safe_log=True)
+    writer.start()
+    for name, handler in (('sync', sync_handler),
+        ('queued', QueueHandler(writer))):
+      logger = logging.getLogger('twidibot-benchmark.%s' % name)
+      logger.propagate = False
+      logger.addHandler(handler)
+      logger.setLevel(logging.INFO)
+      yield 'log.%s' % name, lambda: logger.info("Not providing bridges to "
+          "%s because of set churn rate.", UserRef('user1000'))
+    writer.stop()
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+def benchStartup(wanted):
+  directory = tempfile.mkdtemp(prefix='twidibot-bench-')
+  environment = dict(os.environ, PYTHONPATH=os.pathsep.join([
+      os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+      filter(None, [os.environ.get('PYTHONPATH')])))
+
+  def run(script):
+    subprocess.check_call([sys.executable, '-c', script], cwd=directory,
+        env=environment)
+
+  try:
+    yield 'startup.import', lambda: run('import twidibot.twitter_bot')
+    if wanted('startup.first_reply'):
+      gpDump(makeUserContainer(STARTUP_STATE_USERS), os.path.join(directory,
+          'user_access_times.state.gz'))
+      yield 'startup.first_reply', lambda: run(FIRST_REPLY_SCRIPT)
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+def benchState(sizes, wanted):
+  directory = tempfile.mkdtemp(prefix='twidibot-bench-')
+  try:
+    for size in sizes:
+      if not wanted('state.gpDump.%d' % size) and \
+          not wanted('state.gpLoad.%d' % size):
+        continue
+      container = makeUserContainer(size)
+      filename = os.path.join(directory, 'state-%d.gz' % size)
+      yield 'state.gpDump.%d' % size, lambda: gpDump(container, filename)
+      yield 'state.gpLoad.%d' % size, lambda: gpLoad(filename)
+      container = None
+      gc.collect()
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def benchRemoteState(address):
+  from twidibot.remote_storage import RemoteDict, RemoteStateClient, \
+      ConnectionPool
+
+  host, port = address.rsplit(':', 1)
+  client = RemoteStateClient(ConnectionPool(host, int(port)))
+  users = RemoteDict(client, 'benchmark.users', ttl=60)
+  users.clear()
+  keys = [hashlib.sha1('user%d' % i).hexdigest() for i in range(100)]
+  users.update((key, 1400000000) for key in keys)
+  handles = itertools.cycle(['user%d' % i for i in range(1000)])
+  container = PersistableStorageContainer('benchmark')
+  container.users = users
+  controller = ChurnController(container)
+
+  yield 'remote.ping', lambda: client.call({'op': 'ping'})
+  yield 'remote.get', lambda: users.get(keys[0])
+  yield 'remote.set', lambda: users.__setitem__(keys[0], 1400000000)
+  yield 'remote.mget.100', lambda: users.mget(keys)
+  yield 'remote.pipelined_get.10', lambda: client.execute([{'op': 'mget',
+      'ns': users.namespace, 'keys': [key]} for key in keys[:10]])
+  yield 'remote.checkAndUpdateUser', \
+      lambda: controller.checkAndUpdateUser(handles.next(), expiry_time=60)
+  users.clear()
+  client.close()
+
+def runBenchmarks(sizes=DEFAULT_SIZES, repeat=3, only=None, progress=None,
+    state_server=None):
+  """Run all (or ``only`` matching) benchmarks; returns a results dict."""
+
+  def wanted(name):
+    return not only or re.search(only, name)
+
+  # (so that e.g. ``sendMessage()`` times sending, not being out of budget)
+  unlimit_budgets()
+  suites = (
+    benchOnData(),
+    benchRequestParser(),
+    benchSendMessage(),
+    benchChurn(sizes, wanted),
+    benchChallengeResponse(),
+    benchLogging(),
+    benchStartup(wanted),
+    benchState(sizes, wanted),
+    benchRemoteState(state_server) if state_server else (),
+  )
+  results = dict()
+  for name, fn in itertools.chain(*suites):
+    if not wanted(name):
+      continue
+    per_op, number = timeOps(fn, repeat)
+    results[name] = {'seconds_per_op': per_op, 'ops_per_run': number}
+    if progress:
+      progress(name, per_op)
+  return {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'timestamp': time.time(),
+    'results': results,
+  }
+
+def compareResults(results, baseline, threshold):
+  """Return a list of (name, baseline, current, ratio, regressed) tuples."""
+
+  comparison = list()
+  for name, current in sorted(results['results'].iteritems()):
+    old = baseline['results'].get(name)
+    if not old:
+      continue
+    ratio = current['seconds_per_op'] / old['seconds_per_op'] \
+        if old['seconds_per_op'] else float('inf')
+    comparison.append((name, old['seconds_per_op'],
+        current['seconds_per_op'], ratio, ratio > 1.0 + threshold))
+  return comparison
+
+
+def overBudget(results):
+  """Return a list of (name, budget, current) for benchmarks over budget."""
+
+  return [(name, budget, results['results'][name]['seconds_per_op'])
+      for name, budget in sorted(BUDGETS.iteritems())
+      if name in results['results'] and
+          results['results'][name]['seconds_per_op'] > budget]
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+      help='comma-separated user counts for churn / state benchmarks')
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--only', help='only run benchmarks matching regex')
+  parser.add_argument('--json', action='store_true',
+      help='print results as JSON')
+  parser.add_argument('--save-baseline', metavar='FILE')
+  parser.add_argument('--baseline', metavar='FILE',
+      help='compare results against this baseline')
+  parser.add_argument('--threshold', type=float, default=0.2,
+      help='flag benchmarks this much (fraction) slower than baseline')
+  parser.add_argument('--state-server', metavar='HOST:PORT',
+      help='also benchmark round trips to this state server')
+  args = parser.parse_args(argv[1:])
+
+  def progress(name, per_op):
+    sys.stderr.write('%-40s %12.3f us/op\n' % (name, per_op * 1e6))
+
+  sizes = [int(size) for size in args.sizes.split(',') if size]
+  results = runBenchmarks(sizes, args.repeat, args.only,
+      progress=None if args.json else progress,
+      state_server=args.state_server)
+
+  if args.save_baseline:
+    with open(args.save_baseline, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+  regressed = False
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    comparison = compareResults(results, baseline, args.threshold)
+    results['comparison'] = [dict(zip(('name', 'baseline', 'current',
+        'ratio', 'regressed'), row)) for row in comparison]
+    regressed = any(row[4] for row in comparison)
+    if not args.json:
+      for name, old, new, ratio, is_regression in comparison:
+        print '%-40s %12.3f -> %12.3f us/op  x%.2f%s' % (name, old * 1e6,
+            new * 1e6, ratio, '  REGRESSION' if is_regression else '')
+
+  over_budget = overBudget(results)
+  results['over_budget'] = [dict(zip(('name', 'budget', 'current'), row))
+      for row in over_budget]
+  if not args.json:
+    for name, budget, current in over_budget:
+      print '%-40s %12.3f s, over budget (%.3f s)' % (name, current, budget)
+
+  if args.json:
+    print json.dumps(results, indent=2, sort_keys=True)
+  return 1 if regressed or over_budget else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
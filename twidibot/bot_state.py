@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from twidibot.bot_storage import PersistableStorageHandler
+import time
+import threading
+
+from twidibot import config
+from twidibot.logger import log
+from twidibot.bot_storage import PersistableStorageHandler, ShardedDict
 
 
 class TwitterBotState(object):
@@ -20,24 +25,141 @@ class TwitterBotState(object):
       answers to challenge-responses (response objects including an answer and
       a timestamp when the answer challenge was generated.)
 
+    * a dictionary of bot accounts mapping to the unfollows they still have
+      to do (see ``unfollow_queue``.)
+
+    * a dictionary of bot accounts mapping to the work (events, replies) left
+      unfinished when they last shut down (see ``TwitterBot.drain()``.)
+
+  (All four "dictionaries" are ``ShardedDict``s, safe to use from several
+  threads.)
+
   Bot state may have multiple "containers" attached per storage handler,
   as well as multiple, different storage handlers (all managed by a central
   controller.) Some handlers may handle non-persistable state/data, etc.
+
+  With ``load_in_background``, local state is loaded on a thread of its own:
+  containers start out empty, and are filled in when it's done, and
+  ``loaded`` is set. Whoever uses the state before that has to wait for
+  ``loaded``. (The handler is only added to the controller then, too: closing
+  down before that mustn't save the empty containers over the real ones.)
+
+  Taking over from a running process (see ``handoff``), state comes from its
+  ``snapshot`` instead; ``loaded`` is set once ``finishTakeOver()`` has
+  applied the last changes.
   """
 
-  def __init__(self, storage_controller):
-    main_handler = PersistableStorageHandler()
+  def __init__(self, storage_controller, storage_suffix=None,
+      load_in_background=False, snapshot=None):
+    self.main_handler = main_handler = self.makeStorageHandler(
+        storage_suffix)
+    self.loaded = threading.Event()
+    self._checkpoint_lock = threading.Lock()
+    local = isinstance(main_handler, PersistableStorageHandler)
+    in_background = load_in_background and local
+    options = {'try_to_load': False} if local and (in_background or
+        snapshot is not None) else dict()
+
     self.user_access_times = main_handler.addContainer(
-        "user_access_times", users=dict())
+        "user_access_times", users=ShardedDict(), **options)
 
     # XXX consider putting the user C-Rs into an ephemeral container (which
     # XXX could e.g. make sure everything is wiped when handler is closed)
     # i.e., we may not even want to persist C-Rs; let me them expire if the
     # program needs to shut down.
     self.user_challenges = main_handler.addContainer(
-        "user_challenges", users=dict())
+        "user_challenges", users=ShardedDict(), **options)
+
+    self.pending_unfollows = main_handler.addContainer(
+        "pending_unfollows", users=ShardedDict(), **options)
+
+    self.unfinished_work = main_handler.addContainer(
+        "unfinished_work", users=ShardedDict(), **options)
+
+    if snapshot is not None:
+      # (``finishTakeOver()`` does the rest)
+      for container in self.containers():
+        items = snapshot.get(container._container_name)
+        if items:
+          container.users.update(items)
+    elif in_background:
+      thread = threading.Thread(target=self.load, args=(storage_controller,),
+          name='state-loader')
+      thread.daemon = True
+      thread.start()
+    else:
+      self.finishLoading(storage_controller)
+
+  def containers(self):
+    return (self.user_access_times, self.user_challenges,
+        self.pending_unfollows, self.unfinished_work)
+
+  def load(self, storage_controller):
+    start = time.time()
+    try:
+      for container in self.containers():
+        name = container._container_name
+        if self.main_handler.loadContainer(container, name):
+          log.info("Loaded persistable container \"%s\" from storage", name)
+        else:
+          log.info("Couldn't load persistable container \"%s\" from storage "
+              "- continuing.", name)
+    except Exception as e:
+      log.exception("Failed to load bot state: %s", e)
+    log.info("Loaded bot state in %.2f s.", time.time() - start)
+    self.finishLoading(storage_controller)
+
+  def finishLoading(self, storage_controller):
+    if isinstance(self.main_handler, PersistableStorageHandler):
+      # state saved before we used ``ShardedDict``s has plain dicts:
+      for container in (self.user_access_times, self.user_challenges):
+        container.users = ShardedDict.fromContainerValue(container.users)
+
+    storage_controller.addHandler(self.main_handler)
+    self.loaded.set()
+
+  def finishTakeOver(self, storage_controller, changes):
+    """Apply the ``changes`` since the snapshot (see ``handoff``), and
+    carry on."""
+
+    for container in self.containers():
+      changed, removed = changes.get(container._container_name, ((), ()))
+      if changed:
+        container.users.update(changed)
+      for key in removed:
+        container.users.pop(key, None)
+    self.finishLoading(storage_controller)
+
+  def checkpoint(self, container):
+    """Save ``container`` now, rather than only on shutdown. (Remote
+    containers are always saved already.)"""
+
+    if not isinstance(self.main_handler, PersistableStorageHandler):
+      return True
+    if not self.loaded.is_set():
+      return False # (it'd be saved over the real thing)
+    # (bots for several accounts may share this state)
+    with self._checkpoint_lock:
+      return self.main_handler.saveContainer(container,
+          container._container_name)
+
+  @staticmethod
+  def makeStorageHandler(storage_suffix=None):
+    """The handler for config.STATE_BACKEND: 'local' (pickle files), or
+    'remote' (a ``state_server``, shared by all bot processes.)"""
 
-    storage_controller.addHandler(main_handler)
+    if config.STATE_BACKEND == 'remote':
+      from twidibot.remote_storage import RemoteStorageHandler
+      return RemoteStorageHandler(config.STATE_SERVER_HOST,
+          config.STATE_SERVER_PORT, pool_size=config.STATE_SERVER_POOL_SIZE,
+          timeout=config.STATE_SERVER_TIMEOUT, ttls={
+            'user_access_times': config.MIN_REREQUEST_TIME,
+            'user_challenges': config.CHALLENGE_RESPONSE_EXPIRY_TIME,
+          })
+    # (a separate ``storage_suffix`` per bot process keeps them from
+    # overwriting each other's state; see ``workers``)
+    return PersistableStorageHandler(storage_suffix,
+        directory=config.STATE_DIRECTORY)
 
 
 if __name__ == '__main__':
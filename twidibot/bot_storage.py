@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import threading
 
 from twidibot.logger import log
 from twidibot.helpers import gpDump, gpLoad, round_float_to_int
@@ -82,17 +83,20 @@ class PersistableStorageHandler(StorageHandler):
   APPEND_SUFFIX = True
   DEFAULT_SUFFIX = "state.gz"
 
-  def __init__(self, storage_suffix=None):
+  def __init__(self, storage_suffix=None, directory=None):
     super(PersistableStorageHandler, self).__init__()
 
     if not storage_suffix and self.APPEND_SUFFIX:
       storage_suffix = self.DEFAULT_SUFFIX
     self.storage_suffix = storage_suffix
+    self.directory = directory # (None: the current one)
 
   def formatFilenameFor(self, container, name):
     filename = name + "%s%s" % (
         "." + container.__class__.__name__ if self.APPEND_CLASS_NAME else "",
         "." + self.storage_suffix if self.storage_suffix else "")
+    if self.directory:
+      filename = os.path.join(self.directory, filename)
     return filename
 
   def loadContainer(self, container, name):
@@ -145,13 +149,13 @@ class PersistableStorageHandler(StorageHandler):
                                       # children will have this attribute
 
     if try_to_load and name: # can't load from storage without a name
-      if not self.loadContainer(container, name):
-        log.info("Couldn't load persistable container \"%s\" from storage - "
-            "continuing.", name)
-        for k, v in initial_attributes.iteritems():
-          setattr(container, k, v) # only initialize attrs if failed to load
-      else:
+      if self.loadContainer(container, name):
         log.info("Loaded persistable container \"%s\" from storage", name)
+        return
+      log.info("Couldn't load persistable container \"%s\" from storage - "
+          "continuing.", name)
+    for k, v in initial_attributes.iteritems():
+      setattr(container, k, v) # only initialize attrs if not loaded
 
   def detachContainer(self, container, try_to_save=True):
     name = container._container_name
@@ -174,6 +178,137 @@ class PersistableStorageHandler(StorageHandler):
     return super(PersistableStorageHandler, self).close()
 
 
+class ShardedDict(object):
+  """A dict split into shards, with a lock per shard.
+
+  Keys are expected to be hex digests (hashed user handles); a key's shard is
+  picked by its first few hex digits, which are uniformly distributed. (Other
+  keys are sharded by ``hash()``.) Threads working on different users then
+  rarely contend for the same lock.
+
+  ``checkAndSet()`` is an atomic check-then-update of one key. Iteration goes
+  shard by shard, each shard copied under its lock: consistent per shard,
+  not across shards.
+
+  Pickles as its contents only (locks are recreated when unpickled.)
+  """
+
+  DEFAULT_SHARDS = 16
+  PREFIX_LENGTH = 4 # hex digits used to pick a shard
+
+  def __init__(self, items=None, num_shards=DEFAULT_SHARDS):
+    self._setUp(num_shards)
+    if items:
+      self.update(items)
+
+  def _setUp(self, num_shards):
+    self.num_shards = num_shards
+    self._shards = [dict() for _ in xrange(num_shards)]
+    self._locks = [threading.Lock() for _ in xrange(num_shards)]
+
+  def _indexFor(self, key):
+    try:
+      return int(key[:self.PREFIX_LENGTH], 16) % self.num_shards
+    except (TypeError, ValueError):
+      return hash(key) % self.num_shards
+
+  def __getstate__(self):
+    return {'num_shards': self.num_shards, 'shards': self._shards}
+
+  def __setstate__(self, state):
+    self.num_shards = state['num_shards']
+    self._shards = state['shards']
+    self._locks = [threading.Lock() for _ in xrange(self.num_shards)]
+
+  def __len__(self):
+    return sum(len(shard) for shard in self._shards)
+
+  def __contains__(self, key):
+    return key in self._shards[self._indexFor(key)]
+
+  def __getitem__(self, key):
+    return self._shards[self._indexFor(key)][key]
+
+  def __setitem__(self, key, value):
+    i = self._indexFor(key)
+    with self._locks[i]:
+      self._shards[i][key] = value
+
+  def __delitem__(self, key):
+    i = self._indexFor(key)
+    with self._locks[i]:
+      del self._shards[i][key]
+
+  def get(self, key, default=None):
+    return self._shards[self._indexFor(key)].get(key, default)
+
+  def pop(self, key, *default):
+    i = self._indexFor(key)
+    with self._locks[i]:
+      return self._shards[i].pop(key, *default)
+
+  def update(self, items):
+    if hasattr(items, 'iteritems'):
+      items = items.iteritems()
+    for key, value in items:
+      self[key] = value
+
+  def clear(self):
+    for lock, shard in zip(self._locks, self._shards):
+      with lock:
+        shard.clear()
+
+  def checkAndSet(self, key, check, value):
+    """Atomically: if ``check(current value, or None)`` is true, set ``key``
+    to ``value``. Returns whether it was set."""
+
+    i = self._indexFor(key)
+    with self._locks[i]:
+      shard = self._shards[i]
+      if not check(shard.get(key)):
+        return False
+      shard[key] = value
+      return True
+
+  def removeIf(self, check):
+    """Remove all items for which ``check(value)`` is true. Returns how many
+    were removed."""
+
+    removed = 0
+    for lock, shard in zip(self._locks, self._shards):
+      with lock:
+        for key in [k for k, v in shard.iteritems() if check(v)]:
+          del shard[key]
+          removed += 1
+    return removed
+
+  def iteritems(self):
+    for lock, shard in zip(self._locks, self._shards):
+      with lock:
+        items = shard.items()
+      for item in items:
+        yield item
+
+  def items(self):
+    return list(self.iteritems())
+
+  def keys(self):
+    return [key for key, _ in self.iteritems()]
+
+  def values(self):
+    return [value for _, value in self.iteritems()]
+
+  def __iter__(self):
+    return (key for key, _ in self.iteritems())
+
+  @classmethod
+  def fromContainerValue(cls, value):
+    """Return ``value`` (e.g. a container's ``users`` loaded from an older
+    state file) as a ``ShardedDict``."""
+
+    return value if isinstance(value, cls) else cls(value)
+
+
 class StorageContainer(object):
   """Base class for things that store some bot data/state."""
   pass
@@ -31,6 +31,8 @@ Generic class ->
        'distributed distributors' that are isolated from core BridgeDB.
 """
 
+from twidibot.helpers import ExpiringLRUCache, hash_user_handle
+
 
 class BridgeGetter(object):
   """A generic class for a bridge-getter that gets bridges from bridgedb.
@@ -79,6 +81,45 @@ class TwitterBotBridgeGetter(BridgeGetterStub):
     return "Some bridges for you, %s:\n%s" % (user_info['name'], fake_string)
 
 
+class MemoizingBridgeGetter(BridgeGetter):
+  """Wraps another bridge-getter, remembering the bridges last given to
+  each (hashed) user.
+
+  If a user asks again (for the same transports) while the remembered set is
+  still fresh, they get the very same set back: no call to the backend, and
+  no new bridges enumerated to a repeat requester. Remembered sets expire
+  after ``expiry_time`` seconds (intended to be the churn window), and at
+  most ``max_users`` sets are kept (least recently used ones are dropped
+  first.)
+
+  Bridge sets are only ever kept in memory - they are never persisted.
+  """
+
+  def __init__(self, bridge_getter, max_users, expiry_time):
+    self.bridge_getter = bridge_getter
+    self.given_bridges = ExpiringLRUCache(max_users, expiry_time)
+
+  @staticmethod
+  def keyFor(user_info, transports):
+    return (hash_user_handle(user_info['screen_name']),
+        tuple(sorted(transports or ())))
+
+  def getBridges(self, user_id, user_info, transports):
+    key = self.keyFor(user_info, transports)
+    bridges = self.given_bridges.get(key)
+    if bridges is None:
+      bridges = self.bridge_getter.getBridges(user_id, user_info, transports)
+      if bridges:
+        self.given_bridges.set(key, bridges)
+    return bridges
+
+  def getMemoizedBridges(self, user_info, transports):
+    """Return the bridges last given to this user for these ``transports``,
+    if still fresh, else None. Never calls the backend."""
+
+    return self.given_bridges.get(self.keyFor(user_info, transports))
+
+
 class FakeBridgeGetter(BridgeGetter):
   """A bridge-getter that 'gets' fake bridge descriptors, and gives them
   as if for real, to whoever's asking.
@@ -1,21 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+"""Challenge-response systems.
+
+The text-based one lives here; the Twisted-based one (which pulls in
+twisted.web and SSL) is in ``reactor_challenge_response``, imported only if
+config.CHALLENGE_RESPONSE_SYSTEM asks for it.
+"""
+
 import time
 import hashlib
 import random
-import cookielib
-
-from twisted.web.client import Agent, CookieAgent
-from twisted.internet import reactor
-from twisted.internet.defer import Deferred
-from twisted.internet.protocol import Protocol
-from twisted.web.http_headers import Headers
-from twisted.internet.ssl import ClientContextFactory
 
 from twidibot import config
 from twidibot.logger import log
-from twidibot.helpers import round_float_to_int
+from twidibot.helpers import round_float_to_int, hash_user_handle
 
 
 class SimpleDataHolder(object):
@@ -98,8 +97,13 @@ class ChallengeResponseSystem(object):
     return cr.getChallenge().data
 
   def userHasAChallenge(self, user_handle):
+    """Whether the user has a challenge still waiting for an answer (an
+    expired one doesn't count.)"""
+
     hashed_handle = self.hashUserHandle(user_handle)
-    return self.user_challenges.users.get(hashed_handle)
+    intended_response = self.user_challenges.users.get(hashed_handle)
+    return bool(intended_response) and \
+        not self.hasExpired(intended_response, self.getCurrentTimestamp())
 
   def checkUserAnswer(self, user_handle, answer):
     current_timestamp = self.getCurrentTimestamp()
@@ -117,17 +121,18 @@ class ChallengeResponseSystem(object):
     if intended_response.data != answer: # XXX do constant-time compare maybe?
       return False
 
+    return not self.hasExpired(intended_response, current_timestamp)
+
+  @staticmethod
+  def hasExpired(intended_response, current_timestamp):
     return (intended_response.timestamp + \
-        config.CHALLENGE_RESPONSE_EXPIRY_TIME >= current_timestamp)
+        config.CHALLENGE_RESPONSE_EXPIRY_TIME < current_timestamp)
 
   @staticmethod
   def hashUserHandle(user_handle):
     """Do a one-way hash of Twitter user handle."""
 
-    # we should probably move functions such as this to ``helpers``
-
-    # XXX sha256? sha512? configurable at a higher level?
-    return hashlib.sha1(user_handle).hexdigest()
+    return hash_user_handle(user_handle)
 
   @staticmethod
   def hashResponse(response_data):
@@ -147,78 +152,6 @@ class ChallengeResponseSystem(object):
     return time.time()
 
 
-class WebClientContextFactory(ClientContextFactory):
-  """Context factory for Twisted SSL.
-
-  TODO use isis' certificate checking code here.
-  """
-
-  def getContext(self, hostname, port):
-    return ClientContextFactory.getContext(self)
-
-
-class ResponseBodyHolder(Protocol):
-  """Holds a response body of a Twisted request."""
-
-  def __init__(self, deferred, callback):
-    self.body = None
-    self.deferred = deferred
-    self.callback = callback
-
-  def dataReceived(self, bReceived):
-    if not self.body:
-      self.body = bReceived
-    else:
-      self.body += bReceived
-    if self.callback:
-      self.callback(bReceived)
-
-  def connectionLost(self, reason):
-    self.deferred.callback(None)
-
-
-class TwitterReactorChallengeResponse(ChallengeResponse):
-  def __init__(self, user_handle, user_data):
-    self._challenge = ChallengeDataHolder()
-    self._response = ResponseDataHolder()
-
-    #self._deferreds = list()
-    self._deferred = None
-    self._cookieJar = cookiejar.CookieJar() # we'll use the same jar for all
-                                            # requests
-    self._contextFactory = WebClientContextFactory()
-    self._pool = HTTPConnectionPool(reactor)
-
-    # make ourselves a web agent which also handles cookies and does
-    # persistent connections:
-    self._agent = CookieAgent(
-        Agent(reactor, self._contextFactory, pool=self._pool),
-        self._cookieJar)
-
-    #self.requestPOST("https://...", ...)
-
-  def getChallenge(self):
-    #deferred = self.requestGET("https://...")
-    # extract challenge, store in self._challenge
-    pass
-
-  def getResponse(self):
-    pass
-
-  def requestGET(self, url):
-    #self._deferreds.append(self._agent.request("GET", url))
-    self._deferred = self._agent.request("GET", url)
-    self._deferred.addCallback(self.doneRequest)
-    return self._deferred
-
-  def doneRequest(self, response):
-    finished = Deferred()
-    response.deliverBody(ResponseBodyHolder(finished, self.someDataReceved))
-
-  def someDataReceived(self, bReceived):
-    pass # we probably don't want to look at data until response is complete
-
-
 number_units = ("zero", "one", "two", "three", "four", "five", "six", "seven",
                 "eight", "nine", "ten", "eleven", "twelve", "thirteen",
                 "fourteen", "fifteen", "sixteen", "seventeen", "eighteen",
@@ -256,14 +189,5 @@ class BogusTextBasedChallengeResponseSystem(ChallengeResponseSystem):
   CR_object_class = BogusTextBasedChallengeResponse
 
 
-class TwitterReactorBasedChallengeResponseSystem(ChallengeResponseSystem):
-  """CR system that uses Twisted-reactor-based flow to get/deliver C/R over
-  twisted.web requests.
-  """
-
-  STORE_RESPONSES_HASHED = True
-  CR_object_class = TwitterReactorChallengeResponse
-
-
 if __name__ == '__main__':
   pass
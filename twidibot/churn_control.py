@@ -1,11 +1,29 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import hashlib
+"""Single-user churn control: how long since a user was last given bridges.
+
+``ChurnController`` keeps an exact (rounded) timestamp per hashed user
+handle: memory grows with the number of users, and the table is a list of
+everyone who asked lately.
+
+``BloomChurnController`` (config.CHURN_BACKEND = 'bloom') only keeps
+a ``RotatingBloomFilter``: fixed memory, however many users there are;
+constant-time checks; and nothing to enumerate users by. It's approximate,
+but errs on the side of refusing: a user who asked within MIN_REREQUEST_TIME
+is always refused (for up to MIN_REREQUEST_TIME / CHURN_BLOOM_BUCKETS longer
+than that, too); of users who didn't, about CHURN_BLOOM_ERROR_RATE are
+refused anyway (as long as there are at most CHURN_BLOOM_CAPACITY requests
+per MIN_REREQUEST_TIME.)
+"""
+
+import math
 import time
+import threading
 
 from twidibot import config
-from twidibot.helpers import round_float_to_int
+from twidibot.logger import log
+from twidibot.helpers import round_float_to_int, hash_user_handle
 
 
 class ChurnController(object):
@@ -18,13 +36,15 @@ class ChurnController(object):
     """
 
     self.access_times = access_times
+    # makes ``checkAndUpdateUser()`` atomic for containers that can't do it
+    # themselves (plain dicts):
+    self.lock = threading.RLock()
 
   @staticmethod
   def hashUserHandle(user_handle):
     """Do a one-way hash of Twitter user handle."""
 
-    # XXX sha256? sha512? configurable at a higher level?
-    return hashlib.sha1(user_handle).hexdigest()
+    return hash_user_handle(user_handle)
 
   @staticmethod
   def roundTimestamp(timestamp):
@@ -56,8 +76,13 @@ class ChurnController(object):
   def removeOldUsers(self, removeBefore):
     """Remove old user handles that have timestamps < removeBefore."""
 
+    users = self.access_times.users
+    if hasattr(users, 'removeIf'): # e.g. a ``ShardedDict``
+      users.removeIf(lambda timestamp: timestamp < removeBefore)
+      return
+
     old_users = list()
-    for user, timestamp in self.access_times.users.iteritems():
+    for user, timestamp in users.iteritems():
       if timestamp < removeBefore:
         old_users.append(user)
     for old_user in old_users:
@@ -76,6 +101,9 @@ class ChurnController(object):
 
     return self.access_times.users.get(self.hashUserHandle(user_handle))
 
+  def userCount(self):
+    return len(self.access_times.users)
+
   @staticmethod
   def getCurrentTimestamp():
     return time.time()
@@ -93,6 +121,277 @@ class ChurnController(object):
     last_timestamp = float(last_timestamp) # do explicit cast so types match
     return (last_timestamp + expiry_time <= current_timestamp)
 
+  def checkAndUpdateUser(self, user_handle,
+      expiry_time=config.MIN_REREQUEST_TIME):
+    """``canGiveBridgesToUser()`` and, if so, ``addOrUpdateUser()`` (with the
+    current time), atomically: of two concurrent requests from the same user,
+    only one can pass. Returns whether the user can be given bridges."""
+
+    current_timestamp = self.getCurrentTimestamp()
+    hashed_handle = self.hashUserHandle(user_handle)
+
+    def expired(last_timestamp):
+      return last_timestamp is None or \
+          float(last_timestamp) + expiry_time <= current_timestamp
+
+    users = self.access_times.users
+    rounded_timestamp = self.roundTimestamp(current_timestamp)
+    if hasattr(users, 'checkAndSet'): # e.g. a ``ShardedDict``
+      return users.checkAndSet(hashed_handle, expired, rounded_timestamp)
+    with self.lock:
+      if not expired(users.get(hashed_handle)):
+        return False
+      users[hashed_handle] = rounded_timestamp
+      return True
+
+
+class RotatingBloomFilter(object):
+  """Hashed user handles added lately: ``buckets`` + 1 Bloom filters, each
+  taking those added during one ``period`` (seconds); as a new period
+  starts, the oldest filter is dropped for a new, empty one. So whatever was
+  added within the last ``buckets`` periods is still in there, and nothing
+  added before the last ``buckets`` + 1.
+
+  Each filter is sized for ``capacity`` handles, so that looking one up in
+  all of them is a false positive with (about) ``error_rate`` probability.
+
+  Pickles as its settings plus all the filters' bits, as one string.
+  """
+
+  def __init__(self, period, buckets, capacity, error_rate, now=None):
+    self.period = float(period)
+    self.buckets = buckets
+    self.capacity = capacity
+    self.error_rate = error_rate
+    self._setUp()
+    self.newest = self.bucketOf(time.time() if now is None else now)
+    self.filters = [bytearray(self.num_bytes) for _ in xrange(buckets + 1)]
+    self.counts = [0] * (buckets + 1)
+
+  def _setUp(self):
+    # (a lookup goes through all the filters: split the error rate)
+    error_rate = self.error_rate / (self.buckets + 1)
+    num_bits = -self.capacity * math.log(error_rate) / math.log(2) ** 2
+    self.num_bytes = int(math.ceil(num_bits / 8))
+    self.num_bits = self.num_bytes * 8
+    self.num_hashes = max(1, int(round(
+        self.num_bits * math.log(2) / self.capacity)))
+    self._lock = threading.Lock()
+
+  def settings(self):
+    return (self.period, self.buckets, self.capacity, self.error_rate)
+
+  def __getstate__(self):
+    with self._lock:
+      return {'settings': self.settings(), 'newest': self.newest,
+          'counts': list(self.counts),
+          'bits': ''.join(str(bits) for bits in self.filters)}
+
+  def __setstate__(self, state):
+    self.period, self.buckets, self.capacity, self.error_rate = \
+        state['settings']
+    self._setUp()
+    self.newest = state['newest']
+    self.counts = state['counts']
+    bits = state['bits']
+    self.filters = [bytearray(bits[i:i + self.num_bytes])
+        for i in xrange(0, len(bits), self.num_bytes)]
+
+  def __eq__(self, other):
+    return isinstance(other, RotatingBloomFilter) and \
+        self.__getstate__() == other.__getstate__()
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __len__(self):
+    """About how many handles were added lately (within the last ``buckets``
+    + 1 periods.)"""
+
+    return sum(self.counts)
+
+  def copy(self):
+    bloom = RotatingBloomFilter.__new__(RotatingBloomFilter)
+    bloom.__setstate__(self.__getstate__())
+    return bloom
+
+  def bucketOf(self, timestamp):
+    return int(timestamp // self.period)
+
+  def positionsOf(self, hashed_handle):
+    """(byte, bit mask) pairs for ``hashed_handle``."""
+
+    # (double hashing: the handle is a hash already, so its halves are as
+    # good as two independent hashes)
+    first = int(hashed_handle[:16], 16)
+    second = int(hashed_handle[16:32], 16) | 1
+    num_bits = self.num_bits
+    positions = list()
+    for i in xrange(self.num_hashes):
+      position = (first + i * second) % num_bits
+      positions.append((position >> 3, 1 << (position & 7)))
+    return positions
+
+  def rotate(self, now):
+    """Drop the filters for periods past, as of ``now``."""
+
+    with self._lock:
+      self._rotate(now)
+
+  def _rotate(self, now):
+    bucket = self.bucketOf(now)
+    for _ in xrange(min(bucket - self.newest, self.buckets + 1)):
+      self.filters.pop()
+      self.filters.insert(0, bytearray(self.num_bytes))
+      self.counts.pop()
+      self.counts.insert(0, 0)
+    self.newest = max(self.newest, bucket)
+
+  def _find(self, positions, since):
+    """Index of the newest filter (for a period ending after ``since``)
+    with all ``positions`` set; None if there's none."""
+
+    for index, bits in enumerate(self.filters):
+      if since is not None and (self.newest - index + 1) * self.period <= \
+          since:
+        break
+      for byte, mask in positions:
+        if not bits[byte] & mask:
+          break
+      else:
+        return index
+    return None
+
+  def _add(self, index, positions):
+    bits = self.filters[index]
+    for byte, mask in positions:
+      bits[byte] |= mask
+    self.counts[index] += 1
+
+  def add(self, hashed_handle, timestamp, now):
+    """Add ``hashed_handle`` as of ``timestamp`` (if that's recent enough to
+    be kept at all.)"""
+
+    positions = self.positionsOf(hashed_handle)
+    with self._lock:
+      self._rotate(now)
+      index = self.newest - self.bucketOf(min(timestamp, now))
+      if index <= self.buckets:
+        self._add(index, positions)
+
+  def addedSince(self, hashed_handle, since, now):
+    """Whether ``hashed_handle`` was (probably) added at ``since`` or later;
+    or somewhat earlier (within the same period.) Only goes back ``buckets``
+    periods, at least."""
+
+    positions = self.positionsOf(hashed_handle)
+    with self._lock:
+      self._rotate(now)
+      return self._find(positions, since) is not None
+
+  def checkAndAdd(self, hashed_handle, since, now):
+    """Unless ``addedSince()``, add ``hashed_handle`` (as of ``now``),
+    atomically. Returns whether it was added."""
+
+    positions = self.positionsOf(hashed_handle)
+    with self._lock:
+      self._rotate(now)
+      if self._find(positions, since) is not None:
+        return False
+      self._add(0, positions)
+      return True
+
+  def lastAdded(self, hashed_handle, now):
+    """Start of the latest period ``hashed_handle`` was (probably) added in;
+    None if it wasn't."""
+
+    positions = self.positionsOf(hashed_handle)
+    with self._lock:
+      self._rotate(now)
+      index = self._find(positions, None)
+    if index is None:
+      return None
+    return (self.newest - index) * self.period
+
+
+class BloomChurnController(ChurnController):
+  """A ``ChurnController`` keeping a ``RotatingBloomFilter`` (rotated every
+  ``window`` / ``buckets`` seconds) instead of timestamps, in
+  ``access_times.users`` (under ``KEY``; exact timestamps found there, from
+  before, are moved into it.)"""
+
+  KEY = 'bloom'
+
+  def __init__(self, access_times, window=config.MIN_REREQUEST_TIME,
+      buckets=config.CHURN_BLOOM_BUCKETS,
+      capacity=config.CHURN_BLOOM_CAPACITY,
+      error_rate=config.CHURN_BLOOM_ERROR_RATE):
+    ChurnController.__init__(self, access_times)
+    self.window = window
+    self.settings = (float(window) / buckets, buckets, capacity, error_rate)
+
+  def bloomFilter(self):
+    # (looked up every time: loading state replaces the container's users)
+    users = self.access_times.users
+    bloom = users.get(self.KEY)
+    if bloom is not None and bloom.settings() == self.settings:
+      return bloom
+    with self.lock:
+      bloom = users.get(self.KEY)
+      if bloom is not None and bloom.settings() == self.settings:
+        return bloom
+      if bloom is not None:
+        log.warning("Churn control settings have changed; starting over with "
+            "an empty filter.")
+      now = self.getCurrentTimestamp()
+      bloom = RotatingBloomFilter(*self.settings, now=now)
+      migrated = 0
+      for hashed_handle, timestamp in users.items():
+        if hashed_handle == self.KEY:
+          continue
+        if float(timestamp) + self.window > now:
+          bloom.add(hashed_handle, float(timestamp), now)
+          migrated += 1
+        users.pop(hashed_handle, None)
+      if migrated:
+        log.info("Moved %d users' churn control timestamps into a Bloom "
+            "filter.", migrated)
+      users[self.KEY] = bloom
+      return bloom
+
+  def addOrUpdateUser(self, user_handle, timestamp):
+    self.bloomFilter().add(self.hashUserHandle(user_handle), timestamp,
+        self.getCurrentTimestamp())
+
+  def removeOldUsers(self, removeBefore):
+    """(Old users go as their filter is dropped; see
+    ``RotatingBloomFilter``.)"""
+
+    self.bloomFilter().rotate(self.getCurrentTimestamp())
+
+  def getTimestampForUser(self, user_handle):
+    """Start of the period the user was last given bridges in (roughly.)"""
+
+    return self.bloomFilter().lastAdded(self.hashUserHandle(user_handle),
+        self.getCurrentTimestamp())
+
+  def userCount(self):
+    bloom = self.access_times.users.get(self.KEY)
+    return len(bloom) if bloom is not None else 0
+
+  def canGiveBridgesToUser(self, user_handle,
+      expiry_time=config.MIN_REREQUEST_TIME):
+    current_timestamp = self.getCurrentTimestamp()
+    return not self.bloomFilter().addedSince(
+        self.hashUserHandle(user_handle), current_timestamp - expiry_time,
+        current_timestamp)
+
+  def checkAndUpdateUser(self, user_handle,
+      expiry_time=config.MIN_REREQUEST_TIME):
+    current_timestamp = self.getCurrentTimestamp()
+    return self.bloomFilter().checkAndAdd(self.hashUserHandle(user_handle),
+        current_timestamp - expiry_time, current_timestamp)
+
 
 if __name__ == '__main__':
   pass
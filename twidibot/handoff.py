@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Zero-downtime restarts: handing a running bot over to a new process.
+
+A running bot listens on a unix socket (config.HANDOFF_SOCKET.) A new
+process started with ``quick_run.py --take-over``:
+
+  1. connects, and gets a snapshot of the old one's bot state (churn
+     control, challenge-responses, pending unfollows), instead of loading
+     state files. (With a state server, there's nothing to copy: it's
+     shared anyway.)
+  2. authenticates, and opens its own userstream. Events it gets in the
+     meantime wait for its state (see ``TwitterBot.waitForState()``.)
+  3. once its stream is connected, asks the old one to let go: the old
+     process stops reading its stream, leaves the work it has queued for
+     the new one (see ``TwitterBot.release()``), and sends what changed in
+     its state since the snapshot, along with the DMs (and events) it has
+     seen; then it saves its state, and exits.
+  4. applies all that, and carries on: the events that waited are handled,
+     except for the ones the old process got to first.
+
+So pending challenges stay valid across a deploy, and while both streams
+are open, every request is answered (once.) If the new process can't get a
+snapshot, it loads state files, as usual; the old one keeps running until
+asked to let go.
+
+Messages are pickles (each preceded by its length), so the socket must only
+be reachable by the bot's own user; it's created with mode 0600.
+"""
+
+import os
+import time
+import struct
+import socket
+import threading
+import cPickle as pickle
+
+from twidibot import config
+from twidibot.logger import log
+from twidibot.bot_storage import PersistableStorageHandler
+from twidibot.churn_control import RotatingBloomFilter
+
+
+SNAPSHOT = 'snapshot'
+RELEASE = 'release'
+
+_missing = object()
+
+
+class HandoffError(Exception):
+  pass
+
+
+def sendMessage(connection, message):
+  data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+  connection.sendall(struct.pack('!I', len(data)) + data)
+
+def receiveMessage(connection):
+  header = _receive(connection, 4)
+  return pickle.loads(_receive(connection, struct.unpack('!I', header)[0]))
+
+def _receive(connection, size):
+  chunks = list()
+  while size:
+    chunk = connection.recv(min(size, 1 << 20))
+    if not chunk:
+      raise HandoffError('connection closed')
+    chunks.append(chunk)
+    size -= len(chunk)
+  return ''.join(chunks)
+
+
+def snapshotOf(state):
+  """Local bot state (see ``TwitterBotState.containers()``), as container
+  name => dict of its ``users``."""
+
+  if not isinstance(state.main_handler, PersistableStorageHandler):
+    return dict()
+  # (values changed in place, like churn control's Bloom filter, are copied,
+  # so that ``changesSince()`` can tell)
+  return dict((container._container_name, dict((key, value.copy()
+      if isinstance(value, RotatingBloomFilter) else value)
+      for key, value in container.users.iteritems()))
+      for container in state.containers())
+
+def changesSince(before, after):
+  """What changed between two snapshots: container name => (changed items,
+  removed keys.)"""
+
+  changes = dict()
+  for name, items in after.iteritems():
+    previous = before.get(name, dict())
+    changed = dict((key, value) for key, value in items.iteritems()
+        if previous.get(key, _missing) != value)
+    removed = [key for key in previous if key not in items]
+    changes[name] = (changed, removed)
+  return changes
+
+
+class HandoffServer(object):
+  """Hands the running ``bot`` over to a process taking over (see above.)"""
+
+  def __init__(self, bot, path, timeout=60.0):
+    self.bot = bot
+    self.path = path
+    self.timeout = timeout
+    self.socket = None
+    self._lock = threading.Lock() # one takeover at a time
+
+  def start(self):
+    if os.path.exists(self.path):
+      os.unlink(self.path) # left by a process that's gone (or handed over)
+    self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.socket.bind(self.path)
+    os.chmod(self.path, 0600)
+    self.socket.listen(1)
+    thread = threading.Thread(target=self._serve, name='handoff-server')
+    thread.daemon = True
+    thread.start()
+    log.info("Listening for a process to hand over to, on %s.", self.path)
+
+  def _serve(self):
+    while True:
+      try:
+        connection, _ = self.socket.accept()
+      except socket.error:
+        return
+      # (not a daemon thread: once it's releasing, the process waits for it)
+      threading.Thread(target=self.handle, args=(connection,),
+          name='handoff').start()
+
+  def handle(self, connection):
+    if not self._lock.acquire(False):
+      log.warning("Refusing a second takeover while one is in progress.")
+      connection.close()
+      return
+    released = False
+    try:
+      connection.settimeout(self.timeout)
+      snapshot = dict()
+      while not released:
+        request = receiveMessage(connection)
+        if request == SNAPSHOT:
+          self.bot.waitForState()
+          snapshot = snapshotOf(self.bot.state)
+          sendMessage(connection, snapshot)
+          log.info("Sent a state snapshot to a process taking over.")
+        elif request == RELEASE:
+          log.info("Handing over to the new process.")
+          released = True
+          self.bot.release(time.time() + config.SHUTDOWN_DEADLINE)
+          sendMessage(connection, (changesSince(snapshot,
+              snapshotOf(self.bot.state)), self.bot.seen_messages.keys()))
+        else:
+          raise HandoffError('unexpected request: %r' % (request,))
+    except (socket.error, HandoffError) as e:
+      log.error("Handoff failed: %s", e)
+    finally:
+      connection.close()
+      self._lock.release()
+    if released:
+      self.bot.exitAfterHandoff()
+
+
+class HandoffClient(object):
+  """The taking-over end (see above.)"""
+
+  def __init__(self, path, timeout=60.0):
+    self.path = path
+    self.timeout = timeout
+    self.connection = None
+
+  def fetchSnapshot(self):
+    """Connect, and get the running process' state snapshot; None if there's
+    no process to take over from."""
+
+    try:
+      self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.connection.settimeout(self.timeout)
+      self.connection.connect(self.path)
+      sendMessage(self.connection, SNAPSHOT)
+      snapshot = receiveMessage(self.connection)
+    except (socket.error, HandoffError) as e:
+      log.warning("No process to take over from (%s); starting afresh.", e)
+      self.close()
+      return None
+    log.info("Got a state snapshot from the running process.")
+    return snapshot
+
+  def release(self):
+    """Have the running process let go. Returns (changes since the
+    snapshot, keys of the DMs / events it has seen.)"""
+
+    sendMessage(self.connection, RELEASE)
+    return receiveMessage(self.connection)
+
+  def close(self):
+    if self.connection is not None:
+      self.connection.close()
+      self.connection = None
+
+
+if __name__ == '__main__':
+  pass
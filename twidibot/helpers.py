@@ -2,6 +2,10 @@
 
 import cPickle as pickle
 import gzip
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 
 
 def gpDump(obj, fn, protocol=pickle.HIGHEST_PROTOCOL):
@@ -31,6 +35,160 @@ def round_float_to_int(f_num):
                             # XXX edge cases?
   return int(f_num - 0.5)
 
+def percentile(sorted_values, p):
+  """Return the p-th percentile (0 <= p <= 100) of an already sorted list,
+  using nearest-rank. Returns None for an empty list."""
+
+  if not sorted_values:
+    return None
+  rank = int(round(p / 100.0 * (len(sorted_values) - 1)))
+  return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+def split_message(message, limit):
+  """Split ``message`` into chunks of at most ``limit`` characters each,
+  at newlines where possible (lines longer than that are cut up.)"""
+
+  chunks = list()
+  current = ''
+  for line in message.split('\n'):
+    candidate = current + '\n' + line if current else line
+    if len(candidate) <= limit:
+      current = candidate
+      continue
+    if current:
+      chunks.append(current)
+    while len(line) > limit:
+      chunks.append(line[:limit])
+      line = line[limit:]
+    current = line
+  if current:
+    chunks.append(current)
+  return chunks
+
+def hash_user_handle(user_handle):
+  """Do a one-way hash of Twitter user handle."""
+
+  # XXX sha256? sha512? configurable at a higher level?
+  return hashlib.sha1(user_handle).hexdigest()
+
+
+class ExpiringLRUCache(object):
+  """A bounded mapping with per-entry expiry.
+
+  At most ``max_size`` entries are kept; when full, the least recently used
+  entry is evicted. Entries older than ``expiry_time`` seconds are treated as
+  absent (and dropped when looked up.) ``expiry_time=None`` means entries
+  never expire by themselves.
+  """
+
+  def __init__(self, max_size, expiry_time=None):
+    self.max_size = max_size
+    self.expiry_time = expiry_time
+    self._entries = OrderedDict() # key => (timestamp, value)
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return self.get(key) is not None
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        return default
+      if self.expiry_time is not None and \
+          entry[0] + self.expiry_time <= time.time():
+        return default # expired; stays dropped
+      self._entries[key] = entry # re-insert as most recently used
+      return entry[1]
+
+  def set(self, key, value):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (time.time(), value)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def setIfAbsent(self, key, value):
+    """Set ``key`` unless it's there (and not expired) already. Returns
+    whether it was set."""
+
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and (self.expiry_time is None or
+          entry[0] + self.expiry_time > time.time()):
+        return False
+      self._entries.pop(key, None)
+      self._entries[key] = (time.time(), value)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+      return True
+
+  def pop(self, key, default=None):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+    return entry[1] if entry is not None else default
+
+  def keys(self):
+    """Keys that haven't expired, least recently used first."""
+
+    now = time.time()
+    with self._lock:
+      return [key for key, (timestamp, _) in self._entries.iteritems()
+          if self.expiry_time is None or timestamp + self.expiry_time > now]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+
+class TokenBucket(object):
+  """Rate budget: ``rate`` tokens per second, at most ``capacity`` saved up.
+
+  ``TokenBucket.perPeriod(1000, 24 * 3600)`` allows bursts of up to 1000,
+  refilling at 1000 a day.
+  """
+
+  def __init__(self, rate, capacity):
+    self.rate = float(rate)
+    self.capacity = float(capacity)
+    self._tokens = self.capacity
+    self._last = time.time()
+    self._lock = threading.Lock()
+
+  @classmethod
+  def perPeriod(cls, count, period):
+    return cls(count / float(period), count)
+
+  def _refill(self, now):
+    self._tokens = min(self.capacity,
+        self._tokens + (now - self._last) * self.rate)
+    self._last = now
+
+  def available(self):
+    with self._lock:
+      self._refill(time.time())
+      return self._tokens
+
+  def take(self, amount=1, timeout=0):
+    """Take ``amount`` tokens, waiting up to ``timeout`` seconds for them.
+    Returns whether we got them (if not, none are taken.)"""
+
+    deadline = time.time() + timeout
+    while True:
+      with self._lock:
+        now = time.time()
+        self._refill(now)
+        if self._tokens >= amount:
+          self._tokens -= amount
+          return True
+        wait = (amount - self._tokens) / self.rate if self.rate else None
+      if wait is None or now + wait > deadline:
+        return False
+      time.sleep(wait)
+
 
 if __name__ == '__main__':
   pass
@@ -1,19 +1,267 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+"""The ``twidibot`` logger.
+
+With config.LOG_ASYNC, logging a record only puts it on a queue; a
+``LogWriter`` thread formats and writes records in batches (one flush per
+batch), so nothing on the request path waits for the disk or the console.
+If the queue is full, records are dropped (and how many, logged later.)
+Records are formatted on the writer thread, so arguments are best not
+mutated after they're logged.
+
+The log file is rotated by size (LOG_MAX_BYTES, keeping LOG_BACKUP_COUNT old
+files.)
+
+User identifiers should be logged wrapped in ``UserRef``:
+
+  log.info("Not providing bridges to %s.", UserRef(screen_name))
+
+With config.SAFE_LOG, the writer's scrubbing stage replaces them with a
+truncated hash (the same as in ``tracing``); otherwise, they're logged as
+they are.
+"""
+
+import os
+import sys
+import atexit
 import logging
+import logging.handlers
+import threading
+from collections import deque
+
 from twidibot import config
+from twidibot.helpers import hash_user_handle
+
+# our format has no source file / line, or process ID; don't look them up
+# for every record:
+logging._srcfile = None
+logging.logProcesses = 0
+
+
+class UserRef(object):
+  """A user identifier (screen name, user ID), to be scrubbed before it's
+  logged."""
+
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __str__(self):
+    return str(self.value)
+
+  def scrubbed(self):
+    value = self.value
+    if isinstance(value, unicode):
+      value = value.encode('utf-8')
+    return hash_user_handle(str(value))[:10]
+
+
+def scrub(record):
+  """The scrubbing stage: hash ``UserRef``s among ``record``'s arguments."""
+
+  args = record.args
+  if isinstance(args, tuple):
+    if any(isinstance(arg, UserRef) for arg in args):
+      record.args = tuple(arg.scrubbed() if isinstance(arg, UserRef) else arg
+          for arg in args)
+  elif isinstance(args, dict):
+    record.args = dict((key, arg.scrubbed() if isinstance(arg, UserRef)
+        else arg) for key, arg in args.iteritems())
+
+
+class ScrubbingFilter(logging.Filter):
+  """The scrubbing stage, for logging without a ``LogWriter``."""
+
+  def filter(self, record):
+    scrub(record)
+    return True
+
+
+class BatchingFileHandler(logging.handlers.RotatingFileHandler):
+  """Rotates by size, like its parent; but ``emitBatch()`` writes a batch of
+  records with one flush."""
+
+  def emitBatch(self, records):
+    self.acquire()
+    try:
+      for record in records:
+        try:
+          if self.shouldRollover(record):
+            self.doRollover()
+          message = self.format(record)
+          if isinstance(message, unicode):
+            message = message.encode('utf-8')
+          self.stream.write(message + '\n')
+        except Exception:
+          self.handleError(record)
+      self.stream.flush()
+    finally:
+      self.release()
+
+
+class QueueHandler(logging.Handler):
+  """Hands records to a ``LogWriter``."""
+
+  def __init__(self, writer):
+    logging.Handler.__init__(self)
+    self.writer = writer
+
+  def handle(self, record):
+    # (no handler lock: appending to the queue is atomic)
+    if self.filter(record):
+      self.writer.put(record)
+      return True
+    return False
+
+  def emit(self, record):
+    self.writer.put(record)
+
+
+class LogWriter(object):
+  """Writes queued records to ``handlers``, on a thread of its own; which
+  looks for more every ``poll_interval`` seconds, once it's written all there
+  was. (A deque append is all a record costs the thread logging it: no locks
+  to take, no thread to wake.)
+
+  After a fork, the first record logged in the child starts a new queue and
+  thread there (the parent's aren't ours to drain.)
+  """
+
+  def __init__(self, handlers, queue_size=10000, batch_size=256,
+      poll_interval=0.05, safe_log=False):
+    self.handlers = handlers
+    self.queue_size = queue_size
+    self.batch_size = batch_size
+    self.poll_interval = poll_interval
+    self.safe_log = safe_log
+    self.dropped = 0
+    self.pid = None
+
+  def start(self):
+    self.pid = os.getpid()
+    self.records = deque()
+    self._stopping = threading.Event()
+    self._thread = threading.Thread(target=self._run, name='log-writer')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def put(self, record):
+    if self.pid != os.getpid():
+      self.start()
+    if len(self.records) < self.queue_size:
+      self.records.append(record)
+    else:
+      self.dropped += 1
+
+  def flush(self, timeout=None):
+    """Wait (up to ``timeout`` seconds) until everything queued so far has
+    been written."""
+
+    if self.pid != os.getpid():
+      return # (nothing logged in this process yet)
+    done = threading.Event()
+    self.records.append(done)
+    done.wait(timeout)
+
+  def stop(self, timeout=None):
+    """Write whatever is queued, and stop."""
+
+    if self.pid == os.getpid():
+      self._stopping.set()
+      self._thread.join(timeout)
+
+  def _run(self):
+    records = self.records
+    while True:
+      batch = list()
+      while records and len(batch) < self.batch_size:
+        batch.append(records.popleft())
+      if not batch:
+        if self._stopping.is_set():
+          return
+        self._stopping.wait(self.poll_interval)
+        continue
+
+      # (``flush()``es waiting for this batch:)
+      flushed = [item for item in batch
+          if not isinstance(item, logging.LogRecord)]
+      if flushed:
+        batch = [item for item in batch if isinstance(item, logging.LogRecord)]
+      if self.dropped:
+        dropped, self.dropped = self.dropped, 0
+        batch.append(log.makeRecord(log.name, logging.WARNING, None, 0,
+            "Log queue full: dropped %d records.", (dropped,), None))
+      try:
+        self._write(batch)
+      except Exception as e:
+        sys.stderr.write('Failed to write log records: %s\n' % e)
+      finally:
+        for done in flushed:
+          done.set()
+
+  def _write(self, records):
+    for record in records:
+      if self.safe_log:
+        scrub(record)
+    for handler in self.handlers:
+      records_at_level = [record for record in records
+          if record.levelno >= handler.level]
+      if not records_at_level:
+        continue
+      if hasattr(handler, 'emitBatch'):
+        handler.emitBatch(records_at_level)
+      else:
+        for record in records_at_level:
+          handler.handle(record)
+
 
 log = logging.getLogger('twidibot')
 
 log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s ')
-log_file_handler = logging.FileHandler(config.LOG_FILE)
+log_file_handler = BatchingFileHandler(config.LOG_FILE,
+    maxBytes=config.LOG_MAX_BYTES, backupCount=config.LOG_BACKUP_COUNT)
 log_file_handler.setFormatter(log_formatter)
-log.addHandler(log_file_handler)
+log_handlers = [log_file_handler]
 
 if config.LOG_TO_CONSOLE_TOO:
   log_console_handler = logging.StreamHandler()
   log_console_handler.setFormatter(log_formatter)
-  log.addHandler(log_console_handler)
+  log_handlers.append(log_console_handler)
+
+if config.LOG_ASYNC:
+  log_writer = LogWriter(log_handlers, queue_size=config.LOG_QUEUE_SIZE,
+      batch_size=config.LOG_BATCH_SIZE, safe_log=config.SAFE_LOG)
+  log_writer.start()
+  atexit.register(log_writer.stop, 5.0)
+  log.addHandler(QueueHandler(log_writer))
+else:
+  log_writer = None
+  if config.SAFE_LOG:
+    log.addFilter(ScrubbingFilter())
+  for handler in log_handlers:
+    log.addHandler(handler)
 
 log.setLevel(config.LOG_LEVEL)
+
+
+def redirect(filename):
+  """Log to ``filename`` from now on, instead of config.LOG_FILE (e.g. for a
+  replay, which mustn't fill up the live bot's log.)"""
+
+  log_file_handler.acquire()
+  try:
+    if log_file_handler.stream:
+      log_file_handler.stream.close()
+    log_file_handler.baseFilename = os.path.abspath(filename)
+    log_file_handler.stream = log_file_handler._open()
+  finally:
+    log_file_handler.release()
+
+def flush(timeout=None):
+  """Wait until records logged so far are written (e.g. before a worker
+  process exits, skipping ``atexit``.)"""
+
+  if log_writer is not None:
+    log_writer.flush(timeout)
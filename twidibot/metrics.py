@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Counters, gauges and latency histograms, exposed in Prometheus text format.
+
+Metrics live in a module-level ``registry``, and are cheap enough to always
+be collected: an update is a lock acquisition and an addition (plus a bisect
+for histograms.) Exposing them over HTTP is optional:
+
+  >>> from twidibot import metrics
+  >>> metrics.startHTTPServer(9105) # GET http://127.0.0.1:9105/metrics
+
+Metric (and label) names follow Prometheus conventions. Each metric may have
+at most one label, which keeps both the implementation and the text format
+simple.
+
+Metrics from other processes (see ``workers``) can be rendered together with
+ours: they send ``registry.snapshot()``s, and the registry gets a source
+callback returning the latest ones (``registry.addSource()``); values are
+summed per label.
+"""
+
+import time
+import bisect
+import socket
+import threading
+import BaseHTTPServer
+
+from twidibot.logger import log
+
+
+# seconds; from half a millisecond up to "something is really wrong"
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def formatValue(value):
+  if value == float('inf'):
+    return '+Inf'
+  if isinstance(value, float) and value.is_integer():
+    return str(int(value))
+  return repr(value)
+
+def formatLabels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\',
+      '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+      for name, value in labels)
+
+
+class Metric(object):
+  """Base class; children implement ``samples()``."""
+
+  TYPE = 'untyped'
+
+  def __init__(self, name, help_text, label_name=None):
+    self.name = name
+    self.help_text = help_text
+    self.label_name = label_name
+    self._lock = threading.Lock()
+
+  def _labels(self, label):
+    return ((self.label_name, label),) if self.label_name else ()
+
+  def samples(self, extra=()):
+    """Return a list of (name, labels, value) tuples; with the values in
+    ``extra`` (``snapshot()``s of the same metric elsewhere) added."""
+
+    raise NotImplementedError
+
+  def snapshot(self):
+    """Return the current values, in a picklable form."""
+
+    raise NotImplementedError
+
+  def reset(self):
+    pass
+
+  def render(self, extra=()):
+    lines = ['# HELP %s %s' % (self.name, self.help_text),
+        '# TYPE %s %s' % (self.name, self.TYPE)]
+    for name, labels, value in self.samples(extra):
+      lines.append('%s%s %s' % (name, formatLabels(labels),
+          formatValue(value)))
+    return '\n'.join(lines)
+
+
+class Counter(Metric):
+  TYPE = 'counter'
+
+  def __init__(self, name, help_text, label_name=None):
+    super(Counter, self).__init__(name, help_text, label_name)
+    self._values = dict() # label => value
+
+  def inc(self, label=None, amount=1):
+    with self._lock:
+      self._values[label] = self._values.get(label, 0) + amount
+
+  def value(self, label=None):
+    return self._values.get(label, 0)
+
+  def snapshot(self):
+    with self._lock:
+      return dict(self._values)
+
+  def reset(self):
+    with self._lock:
+      self._values.clear()
+
+  def samples(self, extra=()):
+    values = self.snapshot()
+    for snapshot in extra:
+      for label, value in snapshot.iteritems():
+        values[label] = values.get(label, 0) + value
+    return [(self.name, self._labels(label), value)
+        for label, value in sorted(values.items())]
+
+
+class Gauge(Metric):
+  """A value that can go up and down; or, if ``callback`` is given, a value
+  that is read (by calling ``callback()``) at collection time.
+
+  With a ``label_name``, the value is a dict: label => value.
+  """
+
+  TYPE = 'gauge'
+
+  def __init__(self, name, help_text, callback=None, label_name=None):
+    super(Gauge, self).__init__(name, help_text, label_name)
+    self.callback = callback
+    self._value = 0
+
+  def set(self, value):
+    self._value = value
+
+  def value(self):
+    if self.callback:
+      try:
+        return self.callback()
+      except Exception as e:
+        log.debug("Gauge %s: callback failed: %s", self.name, e)
+        return float('nan')
+    return self._value
+
+  def snapshot(self):
+    return self.value()
+
+  def samples(self, extra=()):
+    if not self.label_name:
+      return [(self.name, (), self.value() + sum(extra))]
+    values = self.value()
+    values = dict(values) if isinstance(values, dict) else dict()
+    for snapshot in extra:
+      for label, value in snapshot.iteritems():
+        values[label] = values.get(label, 0) + value
+    return [(self.name, self._labels(label), value)
+        for label, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+  TYPE = 'histogram'
+
+  def __init__(self, name, help_text, label_name=None,
+      buckets=DEFAULT_LATENCY_BUCKETS):
+    super(Histogram, self).__init__(name, help_text, label_name)
+    self.buckets = tuple(sorted(buckets))
+    self._series = dict() # label => [bucket counts..., sum, count]
+
+  def observe(self, value, label=None):
+    i = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      series = self._series.get(label)
+      if series is None:
+        series = self._series[label] = [0] * (len(self.buckets) + 2)
+      series[i] += 1 # non-cumulative here; cumulated when rendered
+      series[-2] += value
+      series[-1] += 1
+
+  def time(self, label=None):
+    """Return a context manager which observes the time spent within."""
+
+    return Timer(self, label)
+
+  def count(self, label=None):
+    series = self._series.get(label)
+    return series[-1] if series else 0
+
+  def snapshot(self):
+    with self._lock:
+      return dict((label, list(s)) for label, s in self._series.iteritems())
+
+  def reset(self):
+    with self._lock:
+      self._series.clear()
+
+  def samples(self, extra=()):
+    series = self.snapshot()
+    for snapshot in extra:
+      for label, s in snapshot.iteritems():
+        if len(s) != len(self.buckets) + 2:
+          continue # different buckets; can't add up
+        mine = series.setdefault(label, [0] * len(s))
+        for i, value in enumerate(s):
+          mine[i] += value
+    samples = list()
+    for label, s in sorted(series.items()):
+      labels = self._labels(label)
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets + (float('inf'),), s):
+        cumulative += bucket_count
+        samples.append((self.name + '_bucket', labels + (('le',
+            formatValue(float(bound))),), cumulative))
+      samples.append((self.name + '_sum', labels, s[-2]))
+      samples.append((self.name + '_count', labels, s[-1]))
+    return samples
+
+
+class Timer(object):
+  """Context manager that observes elapsed time into a histogram."""
+
+  __slots__ = ('histogram', 'label', 'start')
+
+  def __init__(self, histogram, label):
+    self.histogram = histogram
+    self.label = label
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.histogram.observe(time.time() - self.start, self.label)
+
+
+METRIC_TYPES = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+
+class Registry(object):
+  def __init__(self):
+    self.metrics = list()
+    self.sources = list()
+    self._by_name = dict()
+    self._lock = threading.Lock()
+
+  def register(self, metric):
+    """Register a metric, unless one with the same name already exists.
+    Returns the registered metric."""
+
+    with self._lock:
+      existing = self._by_name.get(metric.name)
+      if existing is not None:
+        return existing
+      self._by_name[metric.name] = metric
+      self.metrics.append(metric)
+      return metric
+
+  def get(self, name):
+    return self._by_name.get(name)
+
+  def addSource(self, callback):
+    """Render metrics from elsewhere, too: ``callback()`` returns a list of
+    ``snapshot()``s to add to ours."""
+
+    self.sources.append(callback)
+
+  def snapshot(self):
+    """Everything, in a picklable form: {name: (type, help, label name,
+    values)}"""
+
+    return dict((metric.name, (metric.TYPE, metric.help_text,
+        metric.label_name, metric.snapshot())) for metric in list(self.metrics))
+
+  def reset(self):
+    """Forget all values (e.g. in a freshly forked worker process), and all
+    sources."""
+
+    self.sources = list()
+    for metric in list(self.metrics):
+      metric.reset()
+
+  def render(self):
+    """Everything, in Prometheus text exposition format (version 0.0.4)"""
+
+    snapshots = list()
+    for source in self.sources:
+      snapshots.extend(source())
+    for snapshot in snapshots:
+      for name, (metric_type, help_text, label_name, _) in \
+          snapshot.iteritems():
+        if name not in self._by_name: # e.g. only registered in a worker
+          if metric_type == 'gauge':
+            self.register(Gauge(name, help_text, label_name=label_name))
+          else:
+            self.register(METRIC_TYPES[metric_type](name, help_text,
+                label_name))
+    return '\n'.join(metric.render([snapshot[metric.name][3]
+        for snapshot in snapshots if metric.name in snapshot])
+        for metric in list(self.metrics)) + '\n'
+
+
+registry = Registry()
+
+def counter(name, help_text, label_name=None):
+  return registry.register(Counter(name, help_text, label_name))
+
+def gauge(name, help_text, callback=None, label_name=None):
+  return registry.register(Gauge(name, help_text, callback, label_name))
+
+def histogram(name, help_text, label_name=None,
+    buckets=DEFAULT_LATENCY_BUCKETS):
+  return registry.register(Histogram(name, help_text, label_name, buckets))
+
+
+# the bot's own metrics:
+
+events = counter('twidibot_events_total',
+    'Userstream events received, by type.', 'type')
+messages_sent = counter('twidibot_direct_messages_sent_total',
+    'Direct messages (single DMs, after chunking) sent.')
+send_failures = counter('twidibot_send_failures_total',
+    'Replies that could not be (completely) sent.')
+churn_refusals = counter('twidibot_churn_refusals_total',
+    'Bridge requests refused because of churn control.')
+challenge_responses = counter('twidibot_challenge_responses_total',
+    'Challenge-response outcomes (issued, pass, fail).', 'result')
+duplicate_messages = counter('twidibot_duplicate_messages_total',
+    'Direct messages ignored as duplicates (replayed: same DM ID seen '
+    'before; repeated: same text from the same user just now).', 'reason')
+budget_exhausted = counter('twidibot_rate_budget_exhausted_total',
+    'Actions not taken because an account ran out of rate budget.', 'action')
+stage_latency = histogram('twidibot_stage_seconds',
+    'Time spent per request handling stage.', 'stage')
+
+def stage(name):
+  """``with metrics.stage('parse'): ...`` times a request handling stage."""
+
+  return Timer(stage_latency, name)
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split('?')[0] not in ('/', '/metrics'):
+      self.send_error(404)
+      return
+    body = registry.render()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass # scrapes are not worth a log line each
+
+
+_http_server = None
+_http_server_lock = threading.Lock()
+
+def startHTTPServer(port, host='127.0.0.1', retry_for=0.0):
+  """Serve ``registry`` over HTTP from a daemon thread. Returns the server;
+  None if it couldn't bind (which is logged: no metrics is no reason for the
+  bot to stop.) With ``retry_for``, keeps trying to bind for that many
+  seconds (e.g. while a process we're taking over from lets go of the port.)
+
+  Only one server is ever started per process; later calls return it.
+  """
+
+  global _http_server
+  with _http_server_lock:
+    if _http_server is not None:
+      return _http_server
+    deadline = time.time() + retry_for
+    while True:
+      try:
+        server = BaseHTTPServer.HTTPServer((host, port),
+            MetricsRequestHandler)
+        break
+      except socket.error as e:
+        if time.time() >= deadline:
+          log.error("Can't serve metrics on %s:%d: %s", host, port, e)
+          return None
+        time.sleep(0.1)
+    _http_server = server
+  thread = threading.Thread(target=server.serve_forever,
+      name='metrics-http')
+  thread.daemon = True
+  thread.start()
+  log.info("Serving metrics on http://%s:%d/metrics", host, port)
+  return server
+
+def stopHTTPServer():
+  """Stop serving metrics, and let go of the port."""
+
+  global _http_server
+  with _http_server_lock:
+    server, _http_server = _http_server, None
+  if server is not None:
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+  pass
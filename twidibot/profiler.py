@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""On-demand profiling of the running bot.
+
+Two profilers, each toggled by a signal:
+
+  * SIGUSR1: a sampling profiler. A background thread looks at every other
+    thread's stack every ``interval`` seconds. Cost is bounded by the
+    interval and a maximum stack depth, so it can be left running under real
+    load. Sees all threads.
+
+  * SIGUSR2: ``cProfile``. Exact call counts and times, but heavier. Profiles
+    the main thread (where signal handlers run; which is also where the
+    userstream is read, unless streaming asynchronously), and work run with
+    ``profiling.profiled()`` (which the ``scheduler``'s threads do), with a
+    profiler per thread; their stats are merged in the report.
+
+Sending the same signal again stops the profiler and writes its stats, plus
+the current stack of every thread, to a timestamped file in the profile
+directory (``logs/`` by default):
+
+  $ kill -USR1 <pid>; sleep 30; kill -USR1 <pid>
+
+Either profiler also stops by itself after ``max_duration`` seconds.
+"""
+
+import os
+import sys
+import time
+import pstats
+import signal
+import cProfile
+import StringIO
+import threading
+import traceback
+from collections import defaultdict
+
+from twidibot import profiling
+from twidibot.logger import log
+
+
+class CProfileSession(object):
+  """A ``cProfile.Profile`` per thread that does ``profiled()`` work, while
+  cProfile is on. (A profiler can only be turned on and off from the thread
+  it profiles; each is on only while it runs a call.)"""
+
+  def __init__(self):
+    self.profilers = dict() # thread => profiler
+    self.running = defaultdict(int) # profiler => calls in progress
+    self._lock = threading.Lock()
+
+  def runcall(self, function, *args):
+    thread = threading.current_thread()
+    with self._lock:
+      profiler = self.profilers.get(thread)
+      if profiler is None:
+        profiler = self.profilers[thread] = cProfile.Profile()
+      self.running[profiler] += 1
+      if self.running[profiler] > 1: # (nested: already on)
+        profiler = None
+    if profiler is None:
+      return function(*args)
+    try:
+      return profiler.runcall(function, *args)
+    finally:
+      with self._lock:
+        self.running[profiler] -= 1
+
+  def finishedProfilers(self, timeout):
+    """Profilers not in the middle of a call; waiting up to ``timeout``
+    seconds for those that are. Returns (profilers, number still busy.)"""
+
+    deadline = time.time() + timeout
+    while True:
+      with self._lock:
+        busy = [profiler for profiler in self.profilers.itervalues()
+            if self.running[profiler]]
+        if not busy or time.time() >= deadline:
+          return ([profiler for profiler in self.profilers.itervalues()
+              if profiler not in busy], len(busy))
+      time.sleep(0.05)
+
+
+class SamplingProfiler(object):
+  """Periodically samples the stacks of all (other) threads."""
+
+  def __init__(self, interval=0.01, max_depth=64):
+    self.interval = interval
+    self.max_depth = max_depth
+    self.samples = 0
+    self.leaf_counts = defaultdict(int) # (file, line, function) => samples
+    self.cumulative_counts = defaultdict(int) # (file, function) => samples
+    self.stack_counts = defaultdict(int) # stack (tuple of frames) => samples
+    self.started = None
+    self._running = False
+    self._thread = None
+
+  def start(self):
+    self._running = True
+    self.started = time.time()
+    self._thread = threading.Thread(target=self._run, name='profiler')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._running = False
+    if self._thread and self._thread is not threading.current_thread():
+      self._thread.join()
+
+  def _run(self):
+    own_id = threading.current_thread().ident
+    while self._running:
+      for thread_id, frame in sys._current_frames().items():
+        if thread_id != own_id:
+          self._sample(frame)
+      self.samples += 1
+      time.sleep(self.interval)
+
+  def _sample(self, frame):
+    stack = list()
+    while frame is not None and len(stack) < self.max_depth:
+      code = frame.f_code
+      stack.append((code.co_filename, frame.f_lineno, code.co_name))
+      frame = frame.f_back
+    if not stack:
+      return
+    self.leaf_counts[stack[0]] += 1
+    for function in set((f[0], f[2]) for f in stack):
+      self.cumulative_counts[function] += 1
+    self.stack_counts[tuple(stack)] += 1
+
+  def report(self, top=40):
+    duration = time.time() - self.started if self.started else 0
+    out = ['Sampling profile: %d samples over %.1f s (interval %.3f s)' %
+        (self.samples, duration, self.interval), '']
+
+    out.append('Top functions by own samples:')
+    for (filename, line, name), count in sorted(self.leaf_counts.items(),
+        key=lambda item: -item[1])[:top]:
+      out.append('%8d  %s:%d(%s)' % (count, filename, line, name))
+    out.append('')
+
+    out.append('Top functions by cumulative samples:')
+    for (filename, name), count in sorted(self.cumulative_counts.items(),
+        key=lambda item: -item[1])[:top]:
+      out.append('%8d  %s(%s)' % (count, filename, name))
+    out.append('')
+
+    out.append('Most frequent stacks:')
+    for stack, count in sorted(self.stack_counts.items(),
+        key=lambda item: -item[1])[:top / 4]:
+      out.append('%8d samples:' % count)
+      for filename, line, name in stack:
+        out.append('            %s:%d(%s)' % (filename, line, name))
+    return '\n'.join(out)
+
+
+def formatThreadStacks():
+  """Current stack of every thread, as text."""
+
+  names = dict((t.ident, t.name) for t in threading.enumerate())
+  out = list()
+  for thread_id, frame in sorted(sys._current_frames().items()):
+    out.append('Thread %s (%s):' % (thread_id, names.get(thread_id, '?')))
+    out.append(''.join(traceback.format_stack(frame)))
+  return '\n'.join(out)
+
+
+class ProfilerControl(object):
+  """Turns profilers on and off (via signals), and writes their reports."""
+
+  def __init__(self, profile_dir, sample_interval=0.01, max_duration=300,
+      finish_timeout=5.0):
+    self.profile_dir = profile_dir
+    self.sample_interval = sample_interval
+    self.max_duration = max_duration
+    self.finish_timeout = finish_timeout # for work in progress, on stopping
+    self.sampler = None
+    self.cprofiler = None
+    self._timers = dict()
+
+  def installSignalHandlers(self):
+    signal.signal(signal.SIGUSR1, lambda sig, frame: self.toggleSampling())
+    signal.signal(signal.SIGUSR2, lambda sig, frame: self.toggleCProfile())
+    log.debug("SIGUSR1 (sampling profiler) and SIGUSR2 (cProfile) handlers "
+        "are set.")
+
+  def _startTimer(self, name, stop):
+    # make sure a forgotten profiler doesn't stay on forever:
+    if self.max_duration:
+      timer = self._timers[name] = threading.Timer(self.max_duration, stop)
+      timer.daemon = True
+      timer.start()
+
+  def _cancelTimer(self, name):
+    timer = self._timers.pop(name, None)
+    if timer and timer is not threading.current_thread():
+      timer.cancel()
+
+  def toggleSampling(self):
+    if self.sampler:
+      self.stopSampling()
+    else:
+      self.startSampling()
+
+  def startSampling(self):
+    if self.sampler:
+      return
+    log.info("Starting sampling profiler.")
+    self.sampler = SamplingProfiler(self.sample_interval)
+    self.sampler.start()
+    self._startTimer('sampling', self.stopSampling)
+
+  def stopSampling(self):
+    sampler, self.sampler = self.sampler, None
+    if not sampler:
+      return
+    self._cancelTimer('sampling')
+    sampler.stop()
+    filename = self.writeReport('sampling', sampler.report())
+    log.info("Stopped sampling profiler; report written to %s", filename)
+
+  def toggleCProfile(self):
+    if self.cprofiler:
+      self.stopCProfile()
+    else:
+      self.startCProfile()
+
+  def startCProfile(self):
+    if self.cprofiler:
+      return
+    log.info("Starting cProfile.")
+    self.cprofiler = cProfile.Profile()
+    self.cprofiler.enable()
+    profiling.session = CProfileSession()
+    # cProfile can only be disabled from the thread it profiles; so, rather
+    # than stopping it from the timer thread, signal ourselves:
+    self._startTimer('cprofile', lambda: os.kill(os.getpid(), signal.SIGUSR2))
+
+  def stopCProfile(self):
+    profiler, self.cprofiler = self.cprofiler, None
+    if not profiler:
+      return
+    session, profiling.session = profiling.session, None
+    self._cancelTimer('cprofile')
+    profiler.disable()
+    stream = StringIO.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    # (threads' profilers are off between calls; but to be read, they have
+    # to be done with the one they're in, if any)
+    finished, busy = session.finishedProfilers(self.finish_timeout)
+    for thread_profiler in finished:
+      stats.add(thread_profiler)
+    stream.write('cProfile: main thread and %d other threads' %
+        len(finished))
+    if busy:
+      stream.write(' (%d left out: still busy after %.1f s)' % (busy,
+          self.finish_timeout))
+    stream.write('\n')
+    stats.sort_stats('cumulative').print_stats(60)
+    stats.sort_stats('time').print_stats(40)
+    filename = self.writeReport('cprofile', stream.getvalue())
+    log.info("Stopped cProfile; report written to %s", filename)
+
+  def writeReport(self, kind, report):
+    if not os.path.isdir(self.profile_dir):
+      os.makedirs(self.profile_dir)
+    filename = os.path.join(self.profile_dir, 'profile-%s-%s-%d.txt' % (
+        time.strftime('%Y%m%d-%H%M%S'), kind, os.getpid()))
+    with open(filename, 'w') as f:
+      f.write(report)
+      f.write('\n\nThread stacks at %s:\n\n' % time.strftime('%c'))
+      f.write(formatThreadStacks())
+    return filename
+
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Where work run on other threads joins a ``profiler`` cProfile session.
+
+Kept apart from ``profiler`` (no cProfile / pstats here), so that the
+``scheduler`` can wrap its work in ``profiled()`` while ``profiler`` itself
+is only imported if config.PROFILING_SIGNALS is set.
+"""
+
+
+session = None # while cProfile is on (a ``profiler.CProfileSession``)
+
+def profiled(function, *args):
+  """Call ``function``; under this thread's profiler, if cProfile is on."""
+
+  current = session
+  if current is None:
+    return function(*args)
+  return current.runcall(function, *args)
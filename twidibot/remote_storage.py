@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Bot state kept on a ``state_server``, shared by several bot processes.
+
+``RemoteStorageHandler`` is a ``StorageHandler`` whose containers' dict
+attributes (e.g. ``users``) are ``RemoteDict``s: dict-like views of a
+namespace on the server. Values are stored as JSON (see ``toJSON()``), so
+nothing read back from the server is ever more than data. Items can have a
+time to live, after which the server forgets them (so e.g. churn control
+entries don't need sweeping by the bot.)
+
+Connections are pooled, with TCP_NODELAY; ``RemoteStateClient.execute()``
+pipelines several requests over one connection (one write, then one read
+per response), and ``RemoteDict.mget()``/``update()`` batch many keys into
+one request. ``checkAndSet()`` is atomic, via compare-and-set on the server.
+
+Set config.STATE_BACKEND = 'remote' to use it.
+"""
+
+import json
+import Queue
+import socket
+import threading
+
+from twidibot.logger import log
+from twidibot.challenge_response import ChallengeDataHolder, \
+    ResponseDataHolder
+from twidibot.bot_storage import StorageHandler, StorageContainer, \
+    ShardedDict
+
+
+class StateServerError(Exception):
+  pass
+
+
+# (classes whose instances can be stored, as their attribute dicts)
+DATA_CLASSES = dict((cls.__name__, cls)
+    for cls in (ChallengeDataHolder, ResponseDataHolder))
+
+
+def toJSON(value):
+  """``value`` as something ``json.dumps()`` keeps intact: tuples, dicts
+  (whatever their keys) and ``DATA_CLASSES`` instances are tagged."""
+
+  if isinstance(value, tuple):
+    return {'__tuple__': [toJSON(item) for item in value]}
+  if isinstance(value, list):
+    return [toJSON(item) for item in value]
+  if isinstance(value, dict):
+    return {'__items__': [[toJSON(key), toJSON(item)]
+        for key, item in value.iteritems()]}
+  if DATA_CLASSES.get(type(value).__name__) is type(value):
+    return {'__class__': type(value).__name__,
+        '__dict__': toJSON(vars(value))}
+  if value is None or isinstance(value, (basestring, bool, int, long,
+      float)):
+    return value
+  raise TypeError("can't store %r on the state server" % type(value))
+
+
+def fromJSON(value):
+  """Inverse of ``toJSON()``. Raises ValueError on unknown classes."""
+
+  if isinstance(value, list):
+    return [fromJSON(item) for item in value]
+  if not isinstance(value, dict):
+    return value
+  if '__tuple__' in value:
+    return tuple(fromJSON(item) for item in value['__tuple__'])
+  if '__items__' in value:
+    return dict((fromJSON(key), fromJSON(item))
+        for key, item in value['__items__'])
+  cls = DATA_CLASSES.get(value.get('__class__'))
+  if cls is None:
+    raise ValueError('unknown stored value: %r' % value.get('__class__'))
+  instance = cls.__new__(cls)
+  instance.__dict__.update(
+      (str(key), item) for key, item in fromJSON(value['__dict__']).items())
+  return instance
+
+
+class StateConnection(object):
+  def __init__(self, host, port, timeout):
+    self.sock = socket.create_connection((host, port), timeout)
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.reader = self.sock.makefile('rb')
+    self.next_id = 0
+
+  def execute(self, requests):
+    """Send all requests, then read all responses. Raises socket.error or
+    ``StateServerError`` if the connection is broken."""
+
+    lines = list()
+    for request in requests:
+      request['id'] = self.next_id
+      self.next_id += 1
+      lines.append(json.dumps(request, separators=(',', ':')))
+    self.sock.sendall('\n'.join(lines) + '\n')
+
+    responses = list()
+    for request in requests:
+      line = self.reader.readline()
+      if not line:
+        raise StateServerError('connection closed by state server')
+      response = json.loads(line)
+      if response.get('id') != request['id']:
+        raise StateServerError('out of sync with state server')
+      responses.append(response)
+    return responses
+
+  def close(self):
+    try:
+      self.reader.close()
+      self.sock.close()
+    except socket.error:
+      pass
+
+
+class ConnectionPool(object):
+  """Up to ``size`` connections; callers wait (up to ``timeout``) for one
+  to be free."""
+
+  def __init__(self, host, port, size=4, timeout=2.0):
+    self.host = host
+    self.port = port
+    self.size = size
+    self.timeout = timeout
+    self._idle = Queue.LifoQueue()
+    self._created = 0
+    self._lock = threading.Lock()
+
+  def _acquire(self):
+    try:
+      return self._idle.get_nowait(), True
+    except Queue.Empty:
+      pass
+    with self._lock:
+      create = self._created < self.size
+      if create:
+        self._created += 1
+    if create:
+      try:
+        return StateConnection(self.host, self.port, self.timeout), False
+      except socket.error:
+        with self._lock:
+          self._created -= 1
+        raise
+    try:
+      return self._idle.get(timeout=self.timeout), True
+    except Queue.Empty:
+      raise StateServerError('no free state server connection')
+
+  def _discard(self, connection):
+    connection.close()
+    with self._lock:
+      self._created -= 1
+
+  def execute(self, requests):
+    connection, reused = self._acquire()
+    try:
+      responses = connection.execute(requests)
+    except (socket.error, StateServerError, ValueError) as e:
+      self._discard(connection)
+      if not reused:
+        raise
+      # the server may have restarted since; retry once, on a new connection
+      log.debug("State server connection broken (%s); reconnecting.", e)
+      connection, _ = self._acquire()
+      try:
+        responses = connection.execute(requests)
+      except:
+        self._discard(connection)
+        raise
+    self._idle.put(connection)
+    return responses
+
+  def close(self):
+    while True:
+      try:
+        self._discard(self._idle.get_nowait())
+      except Queue.Empty:
+        return
+
+
+class RemoteStateClient(object):
+  def __init__(self, pool):
+    self.pool = pool
+
+  def execute(self, requests):
+    """Pipeline ``requests``; returns their responses, in order."""
+
+    responses = self.pool.execute(requests)
+    for response in responses:
+      if 'error' in response:
+        raise StateServerError(response['error'])
+    return responses
+
+  def call(self, request):
+    return self.execute([request])[0]
+
+  @staticmethod
+  def encode(value):
+    return json.dumps(toJSON(value), separators=(',', ':'))
+
+  @staticmethod
+  def decode(data):
+    return fromJSON(json.loads(data))
+
+  def close(self):
+    self.pool.close()
+
+
+class RemoteDict(object):
+  """Dict-like view of a state server namespace (the subset of the dict /
+  ``ShardedDict`` interface the bot uses.)"""
+
+  MAX_CAS_ATTEMPTS = 10
+
+  def __init__(self, client, namespace, ttl=None):
+    self.client = client
+    self.namespace = namespace
+    self.ttl = ttl
+
+  def _request(self, op, **args):
+    args['op'] = op
+    args['ns'] = self.namespace
+    return args
+
+  def _getRaw(self, key):
+    return self.client.call(self._request('mget', keys=[key]))['values'][0]
+
+  def get(self, key, default=None):
+    raw = self._getRaw(key)
+    return self.client.decode(raw) if raw is not None else default
+
+  def mget(self, keys, default=None):
+    """Values for all ``keys``, in one request."""
+
+    values = self.client.call(self._request('mget', keys=list(keys)))['values']
+    return [self.client.decode(raw) if raw is not None else default
+        for raw in values]
+
+  def __getitem__(self, key):
+    raw = self._getRaw(key)
+    if raw is None:
+      raise KeyError(key)
+    return self.client.decode(raw)
+
+  def __contains__(self, key):
+    return self._getRaw(key) is not None
+
+  def __setitem__(self, key, value):
+    self.update([(key, value)])
+
+  def update(self, items):
+    """Set all ``items``, in one request."""
+
+    if hasattr(items, 'iteritems'):
+      items = items.iteritems()
+    encoded = [(key, self.client.encode(value), self.ttl)
+        for key, value in items]
+    if encoded:
+      self.client.call(self._request('mset', items=encoded))
+
+  def __delitem__(self, key):
+    if not self.client.call(self._request('delete', keys=[key]))['deleted']:
+      raise KeyError(key)
+
+  def pop(self, key, *default):
+    get, delete = self.client.execute([self._request('mget', keys=[key]),
+        self._request('delete', keys=[key])])
+    raw = get['values'][0]
+    if raw is None:
+      if default:
+        return default[0]
+      raise KeyError(key)
+    return self.client.decode(raw)
+
+  def __len__(self):
+    return self.client.call(self._request('len'))['len']
+
+  def checkAndSet(self, key, check, value):
+    """Atomically: if ``check(current value, or None)`` is true, set ``key``
+    to ``value``. Returns whether it was set."""
+
+    encoded = self.client.encode(value)
+    for _ in xrange(self.MAX_CAS_ATTEMPTS):
+      raw = self._getRaw(key)
+      if not check(self.client.decode(raw) if raw is not None else None):
+        return False
+      if self.client.call(self._request('cas', key=key, expected=raw,
+          value=encoded, ttl=self.ttl))['ok']:
+        return True
+      # someone else changed it in between; look again
+    raise StateServerError('too much contention on key %s' % key)
+
+  def removeIf(self, check):
+    keys = [key for key, value in self.iteritems() if check(value)]
+    if not keys:
+      return 0
+    return self.client.call(self._request('delete', keys=keys))['deleted']
+
+  def iteritems(self):
+    for key, raw in self.client.call(self._request('items'))['items']:
+      yield key, self.client.decode(raw)
+
+  def items(self):
+    return list(self.iteritems())
+
+  def keys(self):
+    return [key for key, _ in self.iteritems()]
+
+  def values(self):
+    return [value for _, value in self.iteritems()]
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def clear(self):
+    self.client.call(self._request('clear'))
+
+
+class RemoteStorageContainer(StorageContainer):
+  def __init__(self, name):
+    super(RemoteStorageContainer, self).__init__()
+
+    self._container_name = name
+
+
+class RemoteStorageHandler(StorageHandler):
+  """Containers whose dict attributes live on a state server.
+
+  ``ttls`` maps container names to the time to live of their items.
+  """
+
+  def __init__(self, host, port, pool_size=4, timeout=2.0, ttls=None):
+    super(RemoteStorageHandler, self).__init__()
+
+    self.client = RemoteStateClient(ConnectionPool(host, port, pool_size,
+        timeout))
+    self.ttls = ttls or dict()
+
+  def addContainer(self, name, **initial_attributes):
+    container = RemoteStorageContainer(name)
+    for attribute, value in initial_attributes.iteritems():
+      if isinstance(value, (dict, ShardedDict)):
+        value = RemoteDict(self.client, '%s.%s' % (name, attribute),
+            ttl=self.ttls.get(name))
+      setattr(container, attribute, value)
+    self.attachContainer(container)
+    log.info("Using container \"%s\" on state server %s:%d", name,
+        self.client.pool.host, self.client.pool.port)
+    return container
+
+  def detachContainer(self, container):
+    super(RemoteStorageHandler, self).detachContainer(container)
+    return True # nothing to save; it's all on the server already
+
+  def close(self):
+    ret = super(RemoteStorageHandler, self).close()
+    self.client.close()
+    return ret
+
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tell what a direct message to the bot asks for.
+
+``RequestParser`` is compiled once, from the known transports and the command
+vocabulary (config.KNOWN_PT_TYPES, config.COMMAND_WORDS), into a table of
+phrases keyed by their first word. Parsing a message is then one pass over
+its words (one regex scan to split them, and a dict lookup per word), however
+many transports and phrases there are; and only whole words match, so e.g.
+"forget" isn't "get", and "obfs34" isn't "obfs3".
+
+The vocabulary is per locale:
+
+  COMMAND_WORDS = {
+    'en': {'get': ('get', 'give'), 'bridges': ('bridges', 'bridge'),
+           'get_bridges': ('getbridges',)},
+    'ru': {'get': (u'дай',), 'bridges': (u'мосты',)},
+  }
+
+A request for bridges is a "get" word and a "bridges" word (in any locale,
+any order), or a single "get_bridges" phrase (for languages that don't
+separate words with spaces, say.) Phrases may be several words long.
+"""
+
+import re
+
+from twidibot import config
+
+
+GET_BRIDGES = 'get_bridges'
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class ParsedRequest(object):
+  """What a DM says.
+
+  * ``intent``: GET_BRIDGES, or None (we don't know what they want)
+  * ``transports``: transports asked for, in order of mention, no duplicates
+  * ``is_answer``: whether it could be an answer to a challenge: a single
+    word which isn't a command or transport
+  * ``locale``: the locale of the command words used (default: 'en')
+  * ``unrecognized``: the words that matched nothing
+  * ``text``: the message, stripped and lowercased
+  """
+
+  __slots__ = ('intent', 'transports', 'is_answer', 'locale', 'unrecognized',
+      'text')
+
+  def __init__(self, intent, transports, is_answer, locale, unrecognized,
+      text):
+    self.intent = intent
+    self.transports = transports
+    self.is_answer = is_answer
+    self.locale = locale
+    self.unrecognized = unrecognized
+    self.text = text
+
+  def __repr__(self):
+    return '<ParsedRequest intent=%r transports=%r is_answer=%r locale=%r>' % (
+        self.intent, self.transports, self.is_answer, self.locale)
+
+
+class RequestParser(object):
+  def __init__(self, transports, command_words, default_locale='en'):
+    self.default_locale = default_locale
+    self.phrases = dict() # first word => [(words, kind, value, locale)],
+                          # longest first
+    for transport in transports:
+      self.addPhrase(transport, 'transport', transport, None)
+    for locale, vocabulary in sorted(command_words.iteritems()):
+      for kind, phrases in vocabulary.iteritems():
+        for phrase in phrases:
+          self.addPhrase(phrase, kind, kind, locale)
+    for entries in self.phrases.itervalues():
+      entries.sort(key=lambda entry: -len(entry[0]))
+
+  @classmethod
+  def fromConfig(cls):
+    return cls(config.KNOWN_PT_TYPES, config.COMMAND_WORDS)
+
+  @staticmethod
+  def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+  def addPhrase(self, phrase, kind, value, locale):
+    words = tuple(self.tokenize(phrase))
+    if not words:
+      raise ValueError('no words in phrase %r' % phrase)
+    self.phrases.setdefault(words[0], list()).append((words, kind, value,
+        locale))
+
+  def parse(self, text):
+    """Return a ``ParsedRequest`` for message ``text``."""
+
+    text = text.strip().lower()
+    words = TOKEN_RE.findall(text)
+    kinds = set()
+    transports = list()
+    unrecognized = list()
+    locale = None
+
+    i, count = 0, len(words)
+    while i < count:
+      for phrase, kind, value, phrase_locale in self.phrases.get(words[i], ()):
+        if len(phrase) == 1 or tuple(words[i:i + len(phrase)]) == phrase:
+          break
+      else:
+        unrecognized.append(words[i])
+        i += 1
+        continue
+      i += len(phrase)
+      if kind == 'transport':
+        if value not in transports:
+          transports.append(value)
+      else:
+        kinds.add(kind)
+        if locale is None or locale == self.default_locale:
+          locale = phrase_locale
+
+    if GET_BRIDGES in kinds or ('get' in kinds and 'bridges' in kinds):
+      intent = GET_BRIDGES
+    else:
+      intent = None
+    is_answer = count == 1 and len(unrecognized) == 1
+    return ParsedRequest(intent, transports, is_answer,
+        locale or self.default_locale, unrecognized, text)
+
+
+if __name__ == '__main__':
+  pass
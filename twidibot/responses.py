@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""The bot's canned responses, rendered and split into DMs ahead of time.
+
+Responses are keyed by message ID and locale. ``ResponseCatalog`` fills in
+the templates (with e.g. the list of known transports) and splits each into
+DM-sized chunks once, when it's created (and again on ``render()``, after the
+config changes); sending one is then just sending its chunks. Only per-user
+content (bridge lines, challenges) gets split up at send time.
+
+Locales without a translation of a message get the default locale's.
+
+Everything said to a user while handling one request is collected in a
+``ReplyBuffer``, and sent in as few DMs as it fits in once handling is done.
+"""
+
+from collections import defaultdict
+
+from twidibot import config
+from twidibot.helpers import split_message
+
+
+MESSAGES = {
+  'en': {
+    'greeting': 'Hello! Say: "get bridges". If you want pluggable transport '
+        'bridges, include the PT name (e.g. "%(example_transport)s"), too.',
+    'help': 'Send a direct message with the words "get bridges" somewhere in '
+        'it.',
+    'transport_list': 'Here is a list of transports I know about: '
+        '%(known_transports)s',
+    'unknown_transport': 'You might have tried specifying a transport I do '
+        'not support. Sending you non-PT bridges anyway.',
+    'churn_notice': 'Please wait a while before requesting bridges again!',
+    'unfollow_notice': 'For your safety, I will now unfollow you. You should '
+        'unfollow me, too. If you then want bridges once more, just start '
+        'following me again.',
+    'challenge_passed': 'Correct! (Response with bridges goes here.)',
+    'challenge_failed': "The answer to the challenge presented is incorrect; "
+        "here's another challenge:",
+    'busy': "I'm getting too many requests right now, sorry! Please try again "
+        "in an hour or so.",
+  },
+}
+
+
+class ResponseCatalog(object):
+  def __init__(self, messages, params, character_limit, default_locale='en'):
+    self.messages = messages
+    self.params = params
+    self.character_limit = character_limit
+    self.default_locale = default_locale
+    self.render()
+
+  @classmethod
+  def fromConfig(cls):
+    return cls(MESSAGES, {
+      'known_transports': ', '.join(config.KNOWN_PT_TYPES),
+      'example_transport': config.KNOWN_PT_TYPES[0],
+    }, config.CHARACTER_LIMIT)
+
+  def render(self):
+    """(Re-)render and split all messages."""
+
+    chunks = dict()
+    for locale, messages in self.messages.iteritems():
+      for message_id, template in messages.iteritems():
+        chunks[message_id, locale] = tuple(split_message(
+            template % self.params, self.character_limit))
+    self._chunks = chunks
+
+  def chunks(self, message_id, locale=None):
+    """The DMs making up message ``message_id``, in ``locale`` (if we have
+    it in that locale.)"""
+
+    try:
+      return self._chunks[message_id, locale or self.default_locale]
+    except KeyError:
+      return self._chunks[message_id, self.default_locale]
+
+
+class ReplyBuffer(object):
+  """Replies to one user, to be packed into as few DMs as possible.
+
+  Parts are packed in order, several to a DM (one per line) where they fit;
+  canned responses' chunks are never split further. A part can have a
+  ``tag``, and can ``require`` tags: it is only sent if all the parts with
+  those tags were (e.g. "I will now unfollow you" only goes out if the
+  bridges did.) A DM holding a part is never also made to hold a part with
+  other requirements, so one failed DM doesn't take unrelated parts down
+  with it. (A requirement is met within a DM only if it holds all of the
+  tag's chunks.)
+  """
+
+  def __init__(self, catalog, character_limit):
+    self.catalog = catalog
+    self.character_limit = character_limit
+    self.parts = list() # (chunks, tag, requires)
+    self.sent_tags = set()
+    self.failed_tags = set()
+
+  def __len__(self):
+    return len(self.parts)
+
+  def add(self, text, tag=None, requires=()):
+    """Add per-user text (split up at packing time, if need be.)"""
+
+    self.parts.append((split_message(text, self.character_limit), tag,
+        frozenset(requires)))
+
+  def addResponse(self, message_id, locale=None, tag=None, requires=()):
+    """Add a canned response (see ``ResponseCatalog``.)"""
+
+    self.parts.append((self.catalog.chunks(message_id, locale), tag,
+        frozenset(requires)))
+
+  def pack(self):
+    """Returns a list of DMs, as (text, tags, requires) tuples."""
+
+    tag_chunks = defaultdict(int) # tag => chunks, in all
+    for chunks, tag, _ in self.parts:
+      if tag is not None:
+        tag_chunks[tag] += len(chunks)
+
+    messages = list()
+    text, tags, requires = None, defaultdict(int), frozenset()
+    for chunks, tag, part_requires in self.parts:
+      for chunk in chunks:
+        # (requirements met within the same DM - all of their chunks in it -
+        # don't count:)
+        complete = set(t for t, n in tags.iteritems() if n == tag_chunks[t])
+        if text is not None and part_requires - complete == requires and \
+            len(text) + 1 + len(chunk) <= self.character_limit:
+          text += '\n' + chunk
+        else:
+          if text is not None:
+            messages.append((text, set(tags), requires))
+          text, tags, requires = chunk, defaultdict(int), part_requires
+        if tag is not None:
+          tags[tag] += 1
+    if text is not None:
+      messages.append((text, set(tags), requires))
+    return messages
+
+  def flush(self, send, fatal=(), done=None):
+    """Pack and send everything, with ``send(text)``, which raises on failure
+    - or returns a Deferred (on the reactor), in which case the next DM waits
+    for it to fire. Exceptions of the ``fatal`` types stop sending
+    altogether; after others, whatever doesn't depend on the failed DM still
+    goes out. Once all DMs are sent (or failed), calls ``done(errors)``, with
+    a list of the exceptions.
+
+    Afterwards, ``sent(tag)`` tells whether all of a tag's parts were sent.
+    """
+
+    messages, self.parts = self.pack(), list()
+    self._sendFrom(messages, 0, send, fatal, list(), done)
+
+  def _sendFrom(self, messages, i, send, fatal, errors, done):
+    for i in xrange(i, len(messages)):
+      text, tags, requires = messages[i]
+      if requires & self.failed_tags:
+        self.failed_tags.update(tags)
+        continue
+      try:
+        result = send(text)
+      except Exception as e:
+        if self._failed(e, messages, i, fatal, errors):
+          break
+        continue
+      if hasattr(result, 'addCallbacks'):
+        result.addCallbacks(self._sentLater, self._failedLater,
+            callbackArgs=(messages, i, send, fatal, errors, done),
+            errbackArgs=(messages, i, send, fatal, errors, done))
+        return
+      self.sent_tags.update(tags)
+    if done is not None:
+      done(errors)
+
+  def _failed(self, e, messages, i, fatal, errors):
+    """Note that messages[i] failed with ``e``. Returns whether to stop."""
+
+    errors.append(e)
+    self.failed_tags.update(messages[i][1])
+    if isinstance(e, fatal):
+      for _, later_tags, _ in messages[i + 1:]:
+        self.failed_tags.update(later_tags)
+      return True
+    return False
+
+  def _sentLater(self, result, messages, i, send, fatal, errors, done):
+    self.sent_tags.update(messages[i][1])
+    self._sendFrom(messages, i + 1, send, fatal, errors, done)
+
+  def _failedLater(self, failure, messages, i, send, fatal, errors, done):
+    if self._failed(failure.value, messages, i, fatal, errors):
+      if done is not None:
+        done(errors)
+    else:
+      self._sendFrom(messages, i + 1, send, fatal, errors, done)
+
+  def sent(self, tag):
+    return tag in self.sent_tags and tag not in self.failed_tags
+
+
+if __name__ == '__main__':
+  pass
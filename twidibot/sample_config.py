@@ -15,16 +15,117 @@ class Config(object):
   """General config with general config settings"""
 
   KNOWN_PT_TYPES = ('obfs3', 'scramblesuit', 'fte')
+  # words users ask for bridges with, per locale (see ``request_parser``): a
+  # 'get' word and a 'bridges' word, or a whole 'get_bridges' phrase
+  COMMAND_WORDS = {
+    'en': {'get': ('get', 'give', 'send'), 'bridges': ('bridges', 'bridge'),
+        'get_bridges': ('getbridges',)},
+    'es': {'get': ('dame', 'obtener', 'enviar'),
+        'bridges': ('puentes', 'puente')},
+    'fa': {'get': (u'دریافت', u'بده', u'بفرست'), 'bridges': (u'پل', u'پلها')},
+    'ru': {'get': (u'дай', u'получить', u'пришли'),
+        'bridges': (u'мосты', u'мост')},
+    'zh': {'get': (u'获取', u'给我'), 'bridges': (u'网桥',),
+        'get_bridges': (u'获取网桥', u'给我网桥')},
+  }
   CHARACTER_LIMIT = 139
   UNFOLLOW_AFTER_GIVING_BRIDGES = True
 
   LOG_FILE = dir_path + '/../logs/main.log'  # consider separate logs for
                                              # debug/info/error, etc.?
   LOG_TO_CONSOLE_TOO = True
+  LOG_MAX_BYTES = 10 * 1024 * 1024 # rotate the log file at this size
+  LOG_BACKUP_COUNT = 5          # rotated log files to keep
+  LOG_ASYNC = True              # write the log on a background thread, in
+                                # batches (see ``logger``)
+  LOG_QUEUE_SIZE = 10000        # records waiting to be written, at most
+                                # (more are dropped)
+  LOG_BATCH_SIZE = 256          # records written per flush, at most
+
+  # e.g. 'localhost:25001' to use a local ``twitter_standin`` server instead
+  # of Twitter itself (set TWITTER_USE_TLS = False for it, too):
+  TWITTER_API_HOST = None
+  TWITTER_STREAM_HOST = None
+  TWITTER_USE_TLS = True
+  TWITTER_API_TIMEOUT = 20      # seconds, for each REST API call
+
+  WATCHDOG_DEADLINE = 30        # seconds; log the stack of (and count) any
+                                # event handling taking longer. None: off
+  WATCHDOG_CANCEL_STUCK_WORK = False # also abandon such work (by raising an
+                                # exception in the thread doing it)
 
   ASYNC_STREAMING_API = False   # get Streaming API events asynchronously
                                 # (tweepy does this by running a separate
                                 # thread with a loop)
+  USE_REACTOR = False           # run everything on the Twisted reactor
+                                # instead, with non-blocking REST API calls
+                                # (see ``async_twitter``.) quick_run.py
+                                # --reactor does the same
+  TWITTER_API_MAX_CONNECTIONS = 8 # kept-alive REST API connections (reactor)
+  WORKERS = 1                   # > 1: one process reads the userstream, and
+                                # hands events to this many worker processes
+                                # (see ``workers``.) quick_run.py --workers N
+  WORKER_QUEUE_SIZE = 10000     # events queued per worker, at most
+  WORKER_METRICS_INTERVAL = 5.0 # seconds between worker metrics reports
+  SHUTDOWN_DEADLINE = 10.0      # seconds; on SIGTERM / SIGINT, stop reading
+                                # the stream, finish queued work, and exit
+                                # within this. Work that doesn't get done is
+                                # saved, and done on the next start
+  SHUTDOWN_SAVE_TIME = 2.0      # seconds of that kept for saving state
+  HANDOFF_SOCKET = 'handoff.sock' # unix socket a new process takes over
+                                # from this one on (quick_run.py --take-over;
+                                # see ``handoff``.) None: don't listen
+  HANDOFF_TIMEOUT = 60.0        # seconds to wait on the other process, there
+  SCHEDULER_THREADS = 4         # handle events on this many threads, most
+                                # urgent first: challenge answers, then bridge
+                                # requests, then follows (see
+                                # ``scheduler``.) 0: handle each in the stream
+                                # thread, as it comes
+  SCHEDULER_AGING = 10.0        # seconds of waiting that make up for one
+                                # priority class (so nothing starves)
+  COALESCE_WINDOW = 10.0        # seconds; a user's DMs this close together
+                                # make one request: repeats of the same text
+                                # are ignored, and (with a scheduler) a DM
+                                # still waiting replaces the previous one.
+                                # 0: handle every DM
+  SEEN_MESSAGES_MAX = 100000    # DM IDs remembered (for ignoring DMs the
+  SEEN_MESSAGES_EXPIRY = 3600   # stream delivers twice), and for how long
+
+  # admission control (see ``admission``): DMs handled, at most, overall and
+  # per user, as (count, per this many seconds):
+  ADMISSION_CONTROL = True
+  ADMISSION_BUDGET = (6000, 60)
+  ADMISSION_USER_BUDGET = (10, 3600)
+  ADMISSION_LATENCY_TARGET = 30.0 # seconds; shed new bridge requests that
+                                # would wait longer than this (None: don't)
+  BUSY_REPLY_INTERVAL = 3600    # seconds; tell each shed user we're busy at
+                                # most once per this
+
+  # outbound rate budgets, per bot account: (count, per this many seconds);
+  # with WORKERS > 1, each worker gets an equal share of these (and of
+  # ADMISSION_BUDGET and UNFOLLOW_BUDGET; see ``workers``)
+  DM_BUDGET = (1000, 24 * 3600)
+  FOLLOW_BUDGET = (400, 24 * 3600)
+  RATE_BUDGET_MAX_WAIT = 5.0    # seconds to wait for budget before giving up
+
+  # unfollows (after giving bridges) are queued, and done in the background:
+  UNFOLLOW_BUDGET = (400, 24 * 3600) # per bot account, like the above
+  UNFOLLOW_BATCH_SIZE = 20      # unfollows tried per drain, at most
+  UNFOLLOW_INTERVAL = 10.0      # seconds between drains
+  UNFOLLOW_MAX_ATTEMPTS = 5     # give up on an unfollow after this many fails
+  UNFOLLOW_RETRY_DELAY = 60.0   # seconds before retrying; doubles every time
+
+  STATE_BACKEND = 'local'       # 'local': pickle files; 'remote': keep churn
+                                # and challenge-response state on a
+                                # ``state_server`` (shared by bot processes)
+  STATE_DIRECTORY = None        # where local state files go (None: the
+                                # current directory)
+  STATE_SERVER_HOST = '127.0.0.1'
+  STATE_SERVER_PORT = 25002
+  STATE_SERVER_POOL_SIZE = 4    # connections per bot process, at most
+  STATE_SERVER_TIMEOUT = 2.0    # seconds
+  LOAD_STATE_IN_BACKGROUND = True # load local state while connecting to the
+                                # stream (DMs wait for it, if need be)
 
   RESPOND_AFTER_FOLLOW = True   # send a message to user immediately after they
                                 # start following us (do not wait for their
@@ -37,9 +138,35 @@ class Config(object):
                                 # said user.
 
   DO_SINGLE_USER_CHURN_CONTROL = True
+  CHURN_BACKEND = 'exact'       # 'exact': a timestamp per (hashed) user;
+                                # 'bloom': rotating Bloom filters, fixed size
+                                # however many users (needs local state; see
+                                # ``churn_control``)
+  CHURN_BLOOM_BUCKETS = 4       # filters per MIN_REREQUEST_TIME (refusals may
+                                # last up to 1 / this longer)
+  CHURN_BLOOM_CAPACITY = 100000 # requests per MIN_REREQUEST_TIME to size for
+  CHURN_BLOOM_ERROR_RATE = 0.01 # users refused without having asked lately
   NOTIFY_USERS_ABOUT_CHURN = True
 
+  MEMOIZE_BRIDGES = True        # remember the bridges last given to each
+                                # (hashed) user for MIN_REREQUEST_TIME, and
+                                # give the same ones again on re-request
+  MEMOIZED_BRIDGES_MAX_USERS = 10000
+
   DO_CHALLENGE_RESPONSE = True
+  CHALLENGE_RESPONSE_SYSTEM = 'text' # 'text', or 'reactor' (twisted.web
+                                # based; see ``reactor_challenge_response``)
+
+  METRICS_HTTP_PORT = 9105      # serve metrics (Prometheus text format) on
+  METRICS_HTTP_HOST = '127.0.0.1' # http://host:port/metrics; None: don't
+
+  PROFILING_SIGNALS = True      # SIGUSR1 toggles a sampling profiler, SIGUSR2
+                                # toggles cProfile; see ``profiler``
+  PROFILE_DIR = dir_path + '/../logs'
+  PROFILE_SAMPLE_INTERVAL = 0.01 # seconds
+  PROFILE_MAX_DURATION = 300    # seconds; stop profiling after this anyway
+
+  TRACE_FILE = dir_path + '/../logs/traces.jsonl' # see ``tracing``
 
 
 class DevelopmentConfig(Config):
@@ -49,12 +176,16 @@ class DevelopmentConfig(Config):
 
   LOG_LEVEL = logging.DEBUG
   SAFE_LOG = False
+  TRACE_SAMPLE_RATE = 1.0 # fraction of events to trace; 0 disables tracing
 
   API_KEY = ''  # <-- insert your test api key here
   API_SECRET = ''  # <-- insert your test api secret here
   # these two are for actual access to a particular twitter account:
   ACCESS_TOKEN = ''  # <-- insert your test access token here
   TOKEN_SECRET = ''  # <-- insert your test access token secret here
+  # more accounts to run alongside this one, as dicts with 'api_key',
+  # 'api_secret', 'access_token' and 'token_secret' (see ``accounts``):
+  EXTRA_ACCOUNTS = list()
 
   MIN_REREQUEST_TIME = 60 # for a single user; seconds
 
@@ -68,11 +199,13 @@ class ProductionConfig(Config):
 
   LOG_LEVEL = logging.INFO
   SAFE_LOG = True
+  TRACE_SAMPLE_RATE = 0.01
 
   API_KEY = ''
   API_SECRET = ''
   ACCESS_TOKEN = ''
   TOKEN_SECRET = ''
+  EXTRA_ACCOUNTS = list()
 
   MIN_REREQUEST_TIME = 600 # for a single user; seconds
 
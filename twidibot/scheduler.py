@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Priority scheduling of event handling.
+
+Work comes in priority classes, most urgent first:
+
+  * ``CR_ANSWER``: DMs from users with a pending challenge (their answer
+    expires after CHALLENGE_RESPONSE_EXPIRY_TIME, so it mustn't wait behind
+    a backlog of new requests)
+  * ``BRIDGE_REQUEST``: all other DMs
+  * ``HOUSEKEEPING``: follow events / greetings, busy replies
+
+A pool of threads takes the next item from the most urgent class; to keep
+the lower classes from starving, an item's class effectively improves by one
+for every ``aging`` seconds it has waited (so with aging=10, a housekeeping
+item that has waited 20 s goes before a fresh challenge answer.)
+
+Items with the same ``key`` (the user they concern) are never run at the
+same time, and run in the order they were submitted within a class; so a
+user's events don't overtake each other (unless a later one is more urgent.)
+
+Submitting with ``coalesce``: if the same user already has an item of the
+same class waiting, submitted within the last ``coalesce`` seconds, it is
+replaced by the new one (keeping its place in the queue), so a burst of
+requests from one user costs one unit of work. ``replaced``, if given, is
+called with the args of the item that was replaced (e.g. to finish its
+trace.)
+
+Work can be submitted with a ``record``: something (picklable) to redo it
+from later. On shutdown, ``drain()`` takes whatever hasn't run, and returns
+its records, so the bot can save them for next time (see
+``TwitterBot.drain()``.)
+
+Queue depths per class, and time waited, are in ``metrics``.
+"""
+
+import time
+import threading
+from collections import deque
+
+from twidibot import metrics
+from twidibot.logger import log
+from twidibot.profiling import profiled
+
+
+CR_ANSWER = 0
+BRIDGE_REQUEST = 1
+HOUSEKEEPING = 2
+CLASS_NAMES = ('cr_answer', 'bridge_request', 'housekeeping')
+
+queue_wait = metrics.histogram('twidibot_scheduler_wait_seconds',
+    'Time work items waited in the scheduler queue, by class.', 'class')
+coalesced = metrics.counter('twidibot_scheduler_coalesced_total',
+    'Work items replaced by a later one for the same user, by class.',
+    'class')
+aged_picks = metrics.counter('twidibot_scheduler_aged_picks_total',
+    'Work items run ahead of more urgent classes because of their age.',
+    'class')
+
+
+class PriorityScheduler(object):
+  def __init__(self, num_threads=4, aging=10.0):
+    self.num_threads = num_threads
+    self.aging = aging
+    self.queues = [deque() for _ in CLASS_NAMES] # of (submitted, key,
+                                                 # function, args, record)
+    self.timers = set() # ``submitAfter()``s not yet due
+    self.busy_keys = set()
+    self._active = 0 # items being run
+    self.service_time = 0.0 # seconds per item; moving average
+    self._condition = threading.Condition()
+    self._threads = list()
+    self._running = False
+
+  def start(self):
+    self._running = True
+    for i in xrange(self.num_threads):
+      thread = threading.Thread(target=self._run, name='scheduler-%d' % i)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+    metrics.gauge('twidibot_scheduler_queue_depth', 'Work items waiting in '
+        'the scheduler, by class.', self.depths, 'class')
+    log.debug("Scheduler started (%d threads, aging: %.1f s)",
+        self.num_threads, self.aging)
+
+  def stop(self, timeout=None):
+    """Stop taking work; wait (up to ``timeout`` seconds) for running items
+    to finish. Queued items are left queued."""
+
+    with self._condition:
+      self._running = False
+      self._condition.notify_all()
+    deadline = time.time() + timeout if timeout is not None else None
+    for thread in self._threads:
+      if thread is not threading.current_thread():
+        thread.join(max(0, deadline - time.time()) if deadline else None)
+
+  def waitUntilIdle(self, timeout=None):
+    """Wait (up to ``timeout`` seconds) until nothing is queued or running.
+    Returns whether that happened."""
+
+    deadline = time.time() + timeout if timeout is not None else None
+    with self._condition:
+      while any(self.queues) or self._active:
+        remaining = deadline - time.time() if deadline else None
+        if remaining is not None and remaining <= 0:
+          return False
+        self._condition.wait(remaining if remaining is not None else 1.0)
+    return True
+
+  def submit(self, priority, function, args=(), key=None, coalesce=None,
+      record=None, replaced=None):
+    """Queue ``function(*args)`` in class ``priority``. Returns False if it
+    replaced a waiting item instead (see ``coalesce`` above.)"""
+
+    now = time.time()
+    replaced_args = None
+    with self._condition:
+      queue = self.queues[priority]
+      if coalesce and key is not None:
+        for i in xrange(len(queue) - 1, -1, -1):
+          submitted, queued_key = queue[i][:2]
+          if now - submitted > coalesce:
+            break # (older ones are older still)
+          if queued_key == key:
+            replaced_args = queue[i][3]
+            queue[i] = (submitted, key, function, args, record)
+            coalesced.inc(CLASS_NAMES[priority])
+            break
+      if replaced_args is None:
+        queue.append((now, key, function, args, record))
+        self._condition.notify_all() # (``waitUntilIdle()`` waits here, too)
+        return True
+    if replaced is not None:
+      replaced(replaced_args)
+    return False
+
+  def submitAfter(self, delay, priority, function, args=(), key=None,
+      record=None):
+    """``submit()`` in ``delay`` seconds."""
+
+    timer = threading.Timer(delay, self._submitTimed)
+    timer.args = (timer, priority, function, args, key, record)
+    timer.daemon = True
+    with self._condition:
+      self.timers.add(timer)
+    timer.start()
+
+  def _submitTimed(self, timer, priority, function, args, key, record):
+    with self._condition:
+      if timer not in self.timers:
+        return # taken by ``drain()``
+      self.timers.discard(timer)
+    self.submit(priority, function, args, key, record=record)
+
+  def drain(self):
+    """Take everything that's still queued (or not yet due), so it never
+    runs. Returns the records of it (of the items that have one), most urgent
+    first."""
+
+    with self._condition:
+      items = [item for queue in self.queues for item in queue]
+      for queue in self.queues:
+        queue.clear()
+      timers, self.timers = self.timers, set()
+      self._condition.notify_all()
+    for timer in timers:
+      timer.cancel()
+    return [record for _, _, _, _, record in items if record is not None] + \
+        [timer.args[-1] for timer in timers if timer.args[-1] is not None]
+
+  def expectedWait(self, priority):
+    """Roughly how long an item submitted now in class ``priority`` would
+    wait, with what's queued ahead of it (in the same or more urgent
+    classes.)"""
+
+    with self._condition:
+      now = time.time()
+      ahead = self.queues[:priority + 1]
+      oldest = max([now - queue[0][0] for queue in ahead if queue] or [0.0])
+      backlog = sum(len(queue) for queue in ahead) * self.service_time / \
+          self.num_threads
+    return max(oldest, backlog)
+
+  def depths(self):
+    return dict((name, len(queue)) for name, queue in zip(CLASS_NAMES,
+        self.queues))
+
+  def _pick(self):
+    """Take the next item to run, or None. Called with the lock held."""
+
+    now = time.time()
+    best = None # (score, priority, index in queue)
+    candidates = list()
+    for priority, queue in enumerate(self.queues):
+      for i, (submitted, key, _, _, _) in enumerate(queue):
+        if key is not None and key in self.busy_keys:
+          continue # that user's previous item is still running
+        score = priority - (now - submitted) / self.aging
+        if best is None or score < best[0]:
+          best = (score, priority, i)
+        candidates.append(priority)
+        break # only the first runnable item in each class is a candidate
+    if best is None:
+      return None
+    _, priority, i = best
+    if candidates[0] < priority:
+      aged_picks.inc(CLASS_NAMES[priority])
+    queue = self.queues[priority]
+    item = queue[i]
+    del queue[i]
+    return priority, item
+
+  def _run(self):
+    while True:
+      with self._condition:
+        picked = None
+        while self._running:
+          picked = self._pick()
+          if picked:
+            break
+          self._condition.wait()
+        if not picked:
+          return
+        priority, (submitted, key, function, args, _) = picked
+        self._active += 1
+        if key is not None:
+          self.busy_keys.add(key)
+
+      started = time.time()
+      queue_wait.observe(started - submitted, CLASS_NAMES[priority])
+      try:
+        profiled(function, *args) # (see ``profiling``)
+      except Exception as e:
+        log.exception("Scheduled %s work failed: %s", CLASS_NAMES[priority],
+            e)
+      finally:
+        with self._condition:
+          self.service_time += 0.1 * (time.time() - started -
+              self.service_time)
+          self._active -= 1
+          self.busy_keys.discard(key)
+          # items for this key may be runnable now:
+          self._condition.notify_all()
+
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A small standalone server for bot state shared by several bot processes.
+
+Holds namespaces (one per container attribute, e.g.
+"user_access_times.users") of key => value items, each with an optional
+time to live. Values are opaque strings to the server (the client stores
+JSON.) Expired items are treated as absent, and swept periodically.
+
+There is no authentication: anyone who can connect can change bot state,
+so it listens on localhost by default. Keep it on a private network.
+
+The protocol is JSON, one object per line, over TCP. Every request has an
+``id`` and an ``op``; responses come back in request order, with the same
+``id`` (plus ``error``, if the request failed). Clients can pipeline:
+send several requests, then read the responses.
+
+  {"id": 1, "op": "mget", "ns": "n", "keys": ["a", "b"]}
+    => {"id": 1, "values": ["...", null]}
+  {"id": 2, "op": "mset", "ns": "n", "items": [["a", "...", 600]]}
+  {"id": 3, "op": "cas", "ns": "n", "key": "a", "expected": null,
+   "value": "...", "ttl": 600}
+    => {"id": 3, "ok": true}   (set only if the current value is "expected";
+                                null means absent)
+  {"id": 4, "op": "delete", "ns": "n", "keys": ["a"]}
+  {"id": 5, "op": "len", "ns": "n"}, {"id": 6, "op": "items", "ns": "n"},
+  {"id": 7, "op": "clear", "ns": "n"}, {"id": 8, "op": "ping"}
+
+With --state-file, the state is loaded on startup, and saved periodically
+and on shutdown.
+
+  python -m twidibot.state_server --port 25002
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from collections import defaultdict
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+
+from twidibot.logger import log
+from twidibot.helpers import gpDump, gpLoad
+
+
+class StateStore(object):
+  """The actual state: namespace => key => (value, expiry timestamp)."""
+
+  def __init__(self):
+    self.namespaces = defaultdict(dict)
+
+  def handle(self, request):
+    handler = getattr(self, 'op_%s' % request.get('op'), None)
+    if handler is None:
+      raise ValueError('unknown op: %r' % request.get('op'))
+    return handler(request, time.time())
+
+  @staticmethod
+  def expiryFor(ttl, now):
+    return now + ttl if ttl else None
+
+  def _get(self, items, key, now):
+    entry = items.get(key)
+    if entry is None:
+      return None
+    if entry[1] is not None and entry[1] <= now:
+      del items[key]
+      return None
+    return entry[0]
+
+  def op_ping(self, request, now):
+    return {}
+
+  def op_mget(self, request, now):
+    items = self.namespaces[request['ns']]
+    return {'values': [self._get(items, key, now) for key in request['keys']]}
+
+  def op_mset(self, request, now):
+    items = self.namespaces[request['ns']]
+    for key, value, ttl in request['items']:
+      items[key] = (value, self.expiryFor(ttl, now))
+    return {}
+
+  def op_cas(self, request, now):
+    items = self.namespaces[request['ns']]
+    key = request['key']
+    if self._get(items, key, now) != request.get('expected'):
+      return {'ok': False}
+    items[key] = (request['value'], self.expiryFor(request.get('ttl'), now))
+    return {'ok': True}
+
+  def op_delete(self, request, now):
+    items = self.namespaces[request['ns']]
+    deleted = 0
+    for key in request['keys']:
+      if items.pop(key, None) is not None:
+        deleted += 1
+    return {'deleted': deleted}
+
+  def op_len(self, request, now):
+    self.sweepNamespace(request['ns'], now)
+    return {'len': len(self.namespaces[request['ns']])}
+
+  def op_items(self, request, now):
+    self.sweepNamespace(request['ns'], now)
+    return {'items': [(key, entry[0]) for key, entry in
+        self.namespaces[request['ns']].iteritems()]}
+
+  def op_clear(self, request, now):
+    self.namespaces[request['ns']].clear()
+    return {}
+
+  def sweepNamespace(self, namespace, now):
+    items = self.namespaces[namespace]
+    for key in [k for k, (_, expiry) in items.iteritems()
+        if expiry is not None and expiry <= now]:
+      del items[key]
+
+  def sweep(self):
+    now = time.time()
+    for namespace in self.namespaces.keys():
+      self.sweepNamespace(namespace, now)
+
+  def save(self, filename):
+    gpDump(dict(self.namespaces), filename)
+
+  def load(self, filename):
+    self.namespaces.update(gpLoad(filename))
+
+
+class StateProtocol(LineReceiver):
+  delimiter = '\n'
+  MAX_LENGTH = 16 * 1024 * 1024
+
+  def lineReceived(self, line):
+    request_id = None
+    try:
+      request = json.loads(line)
+      request_id = request.get('id')
+      response = self.factory.store.handle(request)
+    except Exception as e:
+      response = {'error': '%s: %s' % (e.__class__.__name__, e)}
+    response['id'] = request_id
+    self.sendLine(json.dumps(response, separators=(',', ':')))
+
+  def lineLengthExceeded(self, line):
+    log.warning("StateProtocol: request too long; dropping connection.")
+    self.transport.loseConnection()
+
+
+class StateFactory(Factory):
+  protocol = StateProtocol
+
+  def __init__(self, store):
+    self.store = store
+
+
+def runServer(port=25002, interface='127.0.0.1', state_file=None,
+    save_interval=300.0, sweep_interval=60.0):
+  """Start listening (the reactor still has to be run.) Returns the
+  ``StateStore``, for in-process use."""
+
+  store = StateStore()
+  if state_file and os.path.isfile(state_file):
+    store.load(state_file)
+    log.info("Loaded state from %s", state_file)
+  reactor.listenTCP(port, StateFactory(store), interface=interface)
+  LoopingCall(store.sweep).start(sweep_interval, now=False)
+  if state_file:
+    LoopingCall(store.save, state_file).start(save_interval, now=False)
+    reactor.addSystemEventTrigger('before', 'shutdown', store.save,
+        state_file)
+  log.info("State server listening on %s:%d", interface, port)
+  return store
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--port', type=int, default=25002)
+  parser.add_argument('--interface', default='127.0.0.1')
+  parser.add_argument('--state-file', help='load state from (and save it to) '
+      'this file')
+  parser.add_argument('--save-interval', type=float, default=300.0,
+      help='seconds')
+  args = parser.parse_args(argv[1:])
+
+  runServer(args.port, args.interface, args.state_file, args.save_interval)
+  reactor.run()
+
+
+if __name__ == '__main__':
+  main(sys.argv)
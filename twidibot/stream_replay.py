@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Stream replay harness for end-to-end throughput and latency testing.
+
+Feeds recorded or synthetic userstream JSON lines (direct messages, follows,
+deletes, and assorted noise) into ``TwitterBotStreamListener.on_data()`` at a
+controlled rate. The bot talks to a ``FakeTwitterAPI`` instead of Twitter:
+it records every call, and can inject latency and errors.
+
+Reports events per second, p50/p99 event-to-reply latency (time from handing
+an event to ``on_data()`` until the first direct message sent back to that
+event's user) and memory growth.
+
+  python -m twidibot.stream_replay --events 5000 --rate 200
+  python -m twidibot.stream_replay --input recorded.jsonl --api-latency 0.05
+
+Recorded input is one raw userstream JSON object per line.
+
+Nothing here touches the network, and the bot's real state is never touched:
+it starts out empty, in a temporary directory (removed on exit), where its
+log and traces go too.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import atexit
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+from collections import defaultdict, deque
+
+import tweepy
+import tweepy.parsers
+
+from twidibot import config, logger
+from twidibot.helpers import percentile
+from twidibot.challenge_response import number_units
+
+
+TWITTER_TIME_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+UNLIMITED_BUDGET = (10 ** 9, 1) # (count, per this many seconds)
+
+
+class FakeTwitterUser(object):
+  """Stands in for ``tweepy.models.User``; (un)follows are recorded."""
+
+  def __init__(self, api, user_id, screen_name=None):
+    self._api = api
+    self.id = user_id
+    self.id_str = str(user_id)
+    self.screen_name = screen_name or 'user%d' % user_id
+    self.name = self.screen_name
+
+  def follow(self):
+    return self._api.create_friendship(id=self.id)
+
+  def unfollow(self):
+    return self._api.destroy_friendship(id=self.id)
+
+
+class FakeTwitterAPI(object):
+  """Stands in for ``tweepy.API``: records calls, injects latency/errors.
+
+  ``latency`` is added to every call (in seconds); each call fails with a
+  ``tweepy.TweepError`` with probability ``error_rate``. ``on_send`` (if set)
+  is called as ``on_send(user_id, text, timestamp)`` for every direct message
+  successfully sent.
+  """
+
+  def __init__(self, bot_id=1, bot_screen_name='twidibot', latency=0.0,
+      error_rate=0.0, seed=None):
+    self.bot_user = FakeTwitterUser(self, bot_id, bot_screen_name)
+    self.latency = latency
+    self.error_rate = error_rate
+    self.on_send = None
+    self.parser = tweepy.parsers.ModelParser() # used by ``Status.parse()``
+
+    self.calls = defaultdict(int) # API method name => number of calls
+    self.errors = 0
+    self.sent_messages = list() # (timestamp, user_id, text)
+    self.last_message_to = dict() # user_id => text
+
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+
+  def _call(self, name):
+    with self._lock:
+      self.calls[name] += 1
+      fail = self.error_rate and self._random.random() < self.error_rate
+      if fail:
+        self.errors += 1
+    if self.latency:
+      time.sleep(self.latency)
+    if fail:
+      raise tweepy.TweepError('Injected error in %s' % name)
+
+  def send_direct_message(self, user_id=None, text=None, **kw):
+    self._call('send_direct_message')
+    timestamp = time.time()
+    with self._lock:
+      self.sent_messages.append((timestamp, user_id, text))
+      self.last_message_to[user_id] = text
+    if self.on_send:
+      self.on_send(user_id, text, timestamp)
+
+  def get_user(self, id=None, **kw):
+    self._call('get_user')
+    return FakeTwitterUser(self, id)
+
+  def create_friendship(self, id=None, **kw):
+    self._call('create_friendship')
+    return FakeTwitterUser(self, id)
+
+  def destroy_friendship(self, id=None, **kw):
+    self._call('destroy_friendship')
+    return FakeTwitterUser(self, id)
+
+  def me(self):
+    self._call('me')
+    return self.bot_user
+
+  def verify_credentials(self, **kw):
+    self._call('verify_credentials')
+    return self.bot_user
+
+  def followers(self, **kw):
+    self._call('followers')
+    return list()
+
+
+def user_json(user_id, screen_name=None):
+  screen_name = screen_name or 'user%d' % user_id
+  return {'id': user_id, 'id_str': str(user_id), 'screen_name': screen_name,
+      'name': screen_name}
+
+def direct_message_json(message_id, sender_id, text, recipient_id=1):
+  sender = user_json(sender_id)
+  return {'direct_message': {
+      'id': message_id,
+      'id_str': str(message_id),
+      'text': text,
+      'created_at': time.strftime(TWITTER_TIME_FORMAT, time.gmtime()),
+      'sender_id': sender_id,
+      'sender_id_str': str(sender_id),
+      'sender_screen_name': sender['screen_name'],
+      'sender': sender,
+      'recipient_id': recipient_id,
+      'recipient': user_json(recipient_id, 'twidibot')}}
+
+def follow_json(source_id, target_id=1):
+  return {'event': 'follow',
+      'created_at': time.strftime(TWITTER_TIME_FORMAT, time.gmtime()),
+      'source': user_json(source_id),
+      'target': user_json(target_id, 'twidibot')}
+
+def delete_json(status_id, user_id):
+  return {'delete': {'status': {'id': status_id, 'id_str': str(status_id),
+      'user_id': user_id, 'user_id_str': str(user_id)}}}
+
+def noise_json(rng, user_id):
+  return rng.choice((
+      {'friends': [rng.randint(2, 10 ** 9) for _ in range(20)]},
+      {'limit': {'track': rng.randint(1, 100)}},
+      {'scrub_geo': {'user_id': user_id, 'up_to_status_id': 1}},
+      {'in_reply_to_status_id': None, 'id': rng.randint(2, 10 ** 9),
+          'text': 'just some tweet', 'user': user_json(user_id)}))
+
+
+def answer_bogus_challenge(screen_name, challenge_text):
+  """Work out the answer to a ``BogusTextBasedChallengeResponse`` challenge.
+
+  Returns None if the text does not look like such a challenge.
+  """
+
+  match = re.search(r'plus (\w+)\.', challenge_text or '')
+  if not match or match.group(1) not in number_units:
+    return None
+  return str(len(screen_name) + number_units.index(match.group(1)))
+
+
+class SyntheticStream(object):
+  """Generates a synthetic mix of userstream events.
+
+  Yields ``(raw_data, reply_user_id)`` tuples, where ``reply_user_id`` is the
+  user we expect the bot to reply to (or None if no reply is expected.)
+  ``mix`` maps event kinds ('dm', 'answer', 'follow', 'delete', 'noise') to
+  relative weights. 'answer' events answer the last challenge the bot sent to
+  a user (looked up in the fake API), falling back to a plain request.
+  """
+
+  DEFAULT_MIX = {'dm': 50, 'answer': 20, 'follow': 15, 'delete': 5,
+      'noise': 10}
+  REQUEST_TEXTS = ('get bridges', 'Get bridges please', 'get bridges obfs3',
+      'get bridges scramblesuit fte', 'hello?', 'bridges get obfs4')
+
+  def __init__(self, api, events, users=1000, mix=None, seed=None):
+    self.api = api
+    self.events = events
+    self.users = users
+    self.mix = mix or self.DEFAULT_MIX
+    self.rng = random.Random(seed)
+    self._kinds = list()
+    for kind, weight in sorted(self.mix.iteritems()):
+      self._kinds.extend([kind] * weight)
+
+  def __iter__(self):
+    bot_id = self.api.bot_user.id
+    for i in xrange(self.events):
+      kind = self.rng.choice(self._kinds)
+      user_id = self.rng.randint(1000, 1000 + self.users - 1)
+      if kind == 'follow':
+        yield json.dumps(follow_json(user_id, bot_id)), user_id
+      elif kind == 'delete':
+        yield json.dumps(delete_json(i + 1, user_id)), None
+      elif kind == 'noise':
+        yield json.dumps(noise_json(self.rng, user_id)), None
+      else:
+        text = None
+        if kind == 'answer':
+          text = answer_bogus_challenge('user%d' % user_id,
+              self.api.last_message_to.get(user_id))
+        if text is None:
+          text = self.rng.choice(self.REQUEST_TEXTS)
+        yield json.dumps(direct_message_json(i + 1, user_id, text, bot_id)),\
+            user_id
+
+
+class RecordedStream(object):
+  """Replays recorded userstream data: one raw JSON object per line."""
+
+  def __init__(self, filename, bot_id=1):
+    self.lines = list()
+    with open(filename) as f:
+      for line in f:
+        line = line.strip()
+        if line:
+          self.lines.append((line, self.replyUserFor(json.loads(line),
+              bot_id)))
+
+  @staticmethod
+  def replyUserFor(data, bot_id):
+    if 'direct_message' in data:
+      sender_id = data['direct_message']['sender_id']
+      return sender_id if sender_id != bot_id else None
+    if data.get('event') == 'follow' and data['source']['id'] != bot_id:
+      return data['source']['id']
+    return None
+
+  def __iter__(self):
+    return iter(self.lines)
+
+
+class ReplayHarness(object):
+  """Drives a bot's stream listener with events, and measures the results."""
+
+  def __init__(self, bot, api):
+    self.bot = bot
+    self.api = api
+    self.latencies = list()
+    self._pending = defaultdict(deque) # user_id => injection timestamps
+    self._lock = threading.Lock()
+    api.on_send = self.messageSent
+
+  def messageSent(self, user_id, text, timestamp):
+    with self._lock:
+      pending = self._pending.get(user_id)
+      if pending and pending[0] <= timestamp:
+        self.latencies.append(timestamp - pending.popleft())
+        if not pending:
+          del self._pending[user_id]
+
+  def pendingReplies(self):
+    with self._lock:
+      return sum(len(p) for p in self._pending.itervalues())
+
+  def replay(self, stream, rate=0, drain_timeout=5.0):
+    """Feed ``stream`` to the listener at ``rate`` events/s (0 = no limit)"""
+
+    listener = self.bot.listener
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    events = 0
+    exceptions = 0
+
+    start = time.time()
+    for raw_data, reply_user_id in stream:
+      if rate:
+        delay = start + float(events) / rate - time.time()
+        if delay > 0:
+          time.sleep(delay)
+      if reply_user_id is not None:
+        with self._lock:
+          self._pending[reply_user_id].append(time.time())
+      try:
+        listener.on_data(raw_data)
+      except Exception:
+        exceptions += 1
+      events += 1
+    replay_time = time.time() - start
+
+    # wait for replies still in flight (if the bot handles events
+    # asynchronously), giving up after the replies stop coming in:
+    last_count, last_change = len(self.latencies), time.time()
+    while self.pendingReplies() and time.time() - last_change < drain_timeout:
+      time.sleep(0.05)
+      if len(self.latencies) != last_count:
+        last_count, last_change = len(self.latencies), time.time()
+    total_time = time.time() - start
+
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies = sorted(self.latencies)
+    return {
+        'events': events,
+        'handler_exceptions': exceptions,
+        'replay_seconds': replay_time,
+        'total_seconds': total_time,
+        'events_per_second': events / replay_time if replay_time else None,
+        'replies': len(latencies),
+        'unanswered': self.pendingReplies(),
+        'api_calls': dict(self.api.calls),
+        'api_errors': self.api.errors,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': latencies[-1] if latencies else None,
+        'max_rss_kb_before': rss_before,
+        'max_rss_kb_after': rss_after,
+        'max_rss_kb_growth': rss_after - rss_before,
+    }
+
+
+def unlimit_budgets():
+  """Lift the bot's rate budgets (DMs, follows, unfollows, admission): we're
+  measuring how fast it handles events, not Twitter's rate limits."""
+
+  config.DM_BUDGET = config.FOLLOW_BUDGET = config.UNFOLLOW_BUDGET = \
+      UNLIMITED_BUDGET
+  config.ADMISSION_BUDGET = config.ADMISSION_USER_BUDGET = UNLIMITED_BUDGET
+
+def build_bot(api):
+  """Construct a ``TwitterBot`` wired to a fake API, with empty state (in a
+  temporary directory: even if it's saved, e.g. on SIGINT, the bot's real
+  state files are left alone; and so are its log and trace files.)"""
+
+  from twidibot.twitter_bot import TwitterBot, TwitterBotStreamListener
+
+  config.STATE_DIRECTORY = tempfile.mkdtemp(prefix='twidibot-replay-')
+  atexit.register(shutil.rmtree, config.STATE_DIRECTORY, True)
+  logger.redirect(os.path.join(config.STATE_DIRECTORY, 'main.log'))
+  config.TRACE_FILE = os.path.join(config.STATE_DIRECTORY, 'traces.jsonl')
+  config.METRICS_HTTP_PORT = None # (a live bot may well be using the port)
+  unlimit_budgets()
+
+  bot = TwitterBot()
+  bot.api = api
+  bot.bot_info = api.me()
+  bot.listener = TwitterBotStreamListener(bot=bot, api=api)
+
+  bot.state.loaded.wait()
+  bot.startUnfollowQueue()
+  bot.unfollow_queue.save = None
+
+  return bot
+
+def format_report(report):
+  lines = list()
+  for key in sorted(report):
+    value = report[key]
+    if isinstance(value, float):
+      value = '%.6f' % value
+    lines.append('%-22s %s' % (key, value))
+  return '\n'.join(lines)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--input', help='recorded userstream data (JSON lines);'
+      ' synthetic events are generated if not given')
+  parser.add_argument('--events', type=int, default=1000,
+      help='number of synthetic events')
+  parser.add_argument('--users', type=int, default=1000,
+      help='number of distinct synthetic users')
+  parser.add_argument('--rate', type=float, default=0,
+      help='events per second to feed in (0: as fast as possible)')
+  parser.add_argument('--api-latency', type=float, default=0.0,
+      help='seconds added to every fake API call')
+  parser.add_argument('--api-error-rate', type=float, default=0.0,
+      help='probability of a fake API call failing')
+  parser.add_argument('--follow-wait', type=float, default=0.0,
+      help='overrides config.WAIT_TIME_AFTER_FOLLOW')
+  parser.add_argument('--drain-timeout', type=float, default=5.0)
+  parser.add_argument('--seed', type=int, default=None)
+  parser.add_argument('--json', action='store_true',
+      help='print the report as JSON')
+  args = parser.parse_args(argv[1:])
+
+  config.WAIT_TIME_AFTER_FOLLOW = args.follow_wait
+
+  api = FakeTwitterAPI(latency=args.api_latency,
+      error_rate=args.api_error_rate, seed=args.seed)
+  bot = build_bot(api)
+  if args.input:
+    stream = RecordedStream(args.input, bot_id=api.bot_user.id)
+  else:
+    stream = SyntheticStream(api, args.events, users=args.users,
+        seed=args.seed)
+
+  report = ReplayHarness(bot, api).replay(stream, rate=args.rate,
+      drain_timeout=args.drain_timeout)
+  bot.stopUnfollowQueue()
+  if args.json:
+    print json.dumps(report, indent=2, sort_keys=True)
+  else:
+    print format_report(report)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
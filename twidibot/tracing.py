@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Lightweight per-request tracing, from stream event to final DM.
+
+A (sampled) fraction of incoming events get a trace: a random trace ID, and
+a list of timed spans (parse, challenge-response check, churn check, bridge
+fetch, each DM chunk sent, ...) Finished traces are appended to a local
+file, one compact JSON object per line:
+
+  {"id": "5f0c...", "k": "direct_message", "t": 1413720000.123, "d": 12.5,
+   "u": "a94a8fe5cc", "s": [["parse", 0.0, 0.21], ["cr_check", 0.3, 0.05]]}
+
+(``t``: start timestamp; ``d`` and span offsets/durations: milliseconds.)
+Traces of work that never ran also have an outcome, ``o`` (e.g.
+"coalesced": replaced by a later request from the same user.)
+With config.SAFE_LOG, the user (``u``) is recorded only as a truncated hash
+of their handle; otherwise as the handle itself.
+
+The current trace is kept per thread, so instrumented code just does:
+
+  with tracing.stage('churn_check'):
+    ...
+
+which also records the stage's latency in ``metrics``. Summarize a trace file
+with:
+
+  python -m twidibot.tracing logs/traces.jsonl --top 10
+"""
+
+import sys
+import json
+import time
+import random
+import threading
+from collections import defaultdict
+
+from twidibot import metrics
+from twidibot.helpers import hash_user_handle, percentile
+
+
+class Trace(object):
+  __slots__ = ('trace_id', 'kind', 'start', 'user', 'spans', 'outcome')
+
+  def __init__(self, kind, start=None):
+    self.trace_id = '%016x' % random.getrandbits(64)
+    self.kind = kind
+    self.start = start or time.time()
+    self.user = None
+    self.spans = list() # (name, start, duration) - in seconds
+    self.outcome = None
+
+  def addSpan(self, name, start, duration):
+    self.spans.append((name, start, duration))
+
+  def toJSON(self, end):
+    fields = {
+      'id': self.trace_id,
+      'k': self.kind,
+      't': round(self.start, 3),
+      'd': round((end - self.start) * 1000, 3),
+      'u': self.user,
+      's': [(name, round((start - self.start) * 1000, 3),
+          round(duration * 1000, 3)) for name, start, duration in self.spans],
+    }
+    if self.outcome is not None:
+      fields['o'] = self.outcome
+    return json.dumps(fields, separators=(',', ':'))
+
+
+class Tracer(object):
+  """Decides which events get traced, and writes finished traces out."""
+
+  FLUSH_EVERY = 50 # traces
+
+  def __init__(self, filename, sample_rate=1.0, safe_log=True):
+    self.filename = filename
+    self.sample_rate = sample_rate
+    self.safe_log = safe_log
+    self._file = open(filename, 'a')
+    self._unflushed = 0
+    self._lock = threading.Lock()
+    self._random = random.Random()
+
+  def startTrace(self, kind, start=None):
+    """Start a trace for the current thread, if this event is sampled.
+
+    ``start`` is when the event arrived (default: now.)
+    """
+
+    if self.sample_rate < 1.0 and self._random.random() >= self.sample_rate:
+      _current.trace = None
+      return None
+    trace = _current.trace = Trace(kind, start)
+    return trace
+
+  def finishTrace(self, trace=None, outcome=None):
+    """Write out ``trace`` (default: the current thread's, which is then
+    dropped.)"""
+
+    if trace is None:
+      trace, _current.trace = getattr(_current, 'trace', None), None
+    if trace is None:
+      return
+    if outcome is not None:
+      trace.outcome = outcome
+    line = trace.toJSON(time.time())
+    with self._lock:
+      self._file.write(line + '\n')
+      self._unflushed += 1
+      if self._unflushed >= self.FLUSH_EVERY:
+        self._file.flush()
+        self._unflushed = 0
+
+  def scrubUser(self, user_handle):
+    if self.safe_log:
+      return hash_user_handle(user_handle)[:10]
+    return user_handle
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+
+
+_current = threading.local()
+tracer = None # set by ``configure()``
+
+def configure(filename, sample_rate, safe_log):
+  global tracer
+  if tracer is not None:
+    tracer.close()
+  tracer = Tracer(filename, sample_rate, safe_log) if sample_rate > 0 else \
+      None
+  return tracer
+
+def startTrace(kind, start=None):
+  if tracer is not None:
+    return tracer.startTrace(kind, start)
+
+def finishTrace(trace=None, outcome=None):
+  if tracer is not None:
+    tracer.finishTrace(trace, outcome)
+
+def currentTrace():
+  return getattr(_current, 'trace', None)
+
+def detachTrace():
+  """Take the current trace away from this thread (e.g. to hand the rest of
+  the work to another thread, which then does ``attachTrace()``.)"""
+
+  trace, _current.trace = getattr(_current, 'trace', None), None
+  return trace
+
+def attachTrace(trace):
+  _current.trace = trace
+
+def setUser(user_handle):
+  """Record who the current trace (if any) is about."""
+
+  trace = getattr(_current, 'trace', None)
+  if trace is not None:
+    trace.user = tracer.scrubUser(user_handle)
+
+def recordStage(name, start, duration):
+  """Record an already timed stage (in metrics, and the current trace.)"""
+
+  metrics.stage_latency.observe(duration, name)
+  trace = getattr(_current, 'trace', None)
+  if trace is not None:
+    trace.addSpan(name, start, duration)
+
+
+class Stage(object):
+  """Context manager timing a request handling stage: one clock read on
+  either side, recorded both as a metric and as a span."""
+
+  __slots__ = ('name', 'start')
+
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    recordStage(self.name, self.start, time.time() - self.start)
+
+stage = Stage
+
+
+def loadTraces(filename):
+  with open(filename) as f:
+    for line in f:
+      line = line.strip()
+      if line:
+        try:
+          yield json.loads(line)
+        except ValueError:
+          pass # e.g. a line cut short by a crash
+
+def summarize(traces, top=10):
+  """Return a text summary: per-span latency stats, and the slowest traces."""
+
+  traces = list(traces)
+  span_durations = defaultdict(list)
+  for trace in traces:
+    for name, offset, duration in trace['s']:
+      span_durations[name].append(duration)
+
+  outcomes = defaultdict(int)
+  for trace in traces:
+    if trace.get('o'):
+      outcomes[trace['o']] += 1
+  out = ['%d traces' % len(traces) + ''.join(', %d %s' % (count, outcome)
+      for outcome, count in sorted(outcomes.iteritems())), '',
+      '%-16s %8s %10s %10s %10s' % ('span', 'count', 'p50 ms', 'p99 ms',
+          'max ms')]
+  for name, durations in sorted(span_durations.iteritems()):
+    durations.sort()
+    out.append('%-16s %8d %10.3f %10.3f %10.3f' % (name, len(durations),
+        percentile(durations, 50), percentile(durations, 99), durations[-1]))
+
+  out.extend(['', 'Slowest %d traces:' % top])
+  for trace in sorted(traces, key=lambda t: -t['d'])[:top]:
+    out.append('%s %-14s %10.3f ms  user=%s  at %s' % (trace['id'],
+        trace['k'], trace['d'], trace['u'], time.strftime('%Y-%m-%d %H:%M:%S',
+        time.localtime(trace['t']))))
+    for name, offset, duration in trace['s']:
+      out.append('    +%9.3f ms  %-16s %10.3f ms' % (offset, name, duration))
+  return '\n'.join(out)
+
+
+def main(argv):
+  import argparse
+
+  parser = argparse.ArgumentParser(description='Summarize a trace file.')
+  parser.add_argument('filename')
+  parser.add_argument('--top', type=int, default=10,
+      help='how many of the slowest traces to show')
+  parser.add_argument('--kind', help='only consider traces of this kind, '
+      'e.g. direct_message')
+  args = parser.parse_args(argv[1:])
+
+  traces = loadTraces(args.filename)
+  if args.kind:
+    traces = (t for t in traces if t['k'] == args.kind)
+  print summarize(traces, args.top)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -15,21 +15,44 @@ client, or bridge-getter as subclassed bridgedb.Distributor (the latter is
 the easiest way to fulfil main deliverable, but we should also think ahead.))
 """
 
+import os
 import sys
 import signal
 import json
 import time
-from pprint import pprint
+import threading
 
 import tweepy
 from tweepy.models import Status
 
-from twidibot import config, bridge_getter
-from twidibot.logger import log
+from twidibot import config, bridge_getter, metrics, tracing, admission, \
+    logger
+from twidibot.logger import log, UserRef
+from twidibot.helpers import TokenBucket, ExpiringLRUCache, split_message
+from twidibot.responses import ResponseCatalog, ReplyBuffer
+from twidibot.request_parser import RequestParser, GET_BRIDGES
 from twidibot.bot_storage import StorageController
 from twidibot.bot_state import TwitterBotState
-from twidibot.churn_control import ChurnController
+from twidibot.churn_control import ChurnController, BloomChurnController
 from twidibot.challenge_response import BogusTextBasedChallengeResponseSystem
+from twidibot.watchdog import Watchdog
+from twidibot.scheduler import PriorityScheduler, CR_ANSWER, BRIDGE_REQUEST, \
+    HOUSEKEEPING
+from twidibot.unfollow_queue import UnfollowQueue
+
+
+class RateBudgetExhausted(Exception):
+  pass
+
+
+class NotWatching(object):
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    pass
+
+_not_watching = NotWatching()
 
 
 class TwitterBotStreamListener(tweepy.StreamListener):
@@ -38,6 +61,8 @@ class TwitterBotStreamListener(tweepy.StreamListener):
   def __init__(self, bot, api=None):
     self.bot = bot
     self.processing_data = False
+    self.processing_thread = None # (while processing_data)
+    self.current_data = None
 
     super(TwitterBotStreamListener, self).__init__(api)
 
@@ -55,36 +80,144 @@ class TwitterBotStreamListener(tweepy.StreamListener):
     """
 
     self.processing_data = True
+    self.processing_thread = threading.current_thread()
+    self.current_data = raw_data
+    try:
+      return self.handleData(raw_data)
+    finally:
+      # (however handling ended: the bot's ``drain()`` waits for this)
+      self.processing_data = False
+
+  def handleData(self, raw_data, resumed=False):
+    """(``resumed``: see ``handleEvent()``.)"""
 
+    start = time.time()
     data = json.loads(raw_data)
+    event_type = self.eventTypeOf(data)
+    metrics.events.inc(event_type)
+    if event_type in ('event', 'direct_message'):
+      tracing.startTrace(event_type, start)
+    try:
+      if event_type in ('status', 'event', 'direct_message'):
+        status = Status.parse(self.api, data)
+      tracing.recordStage('parse', start, time.time() - start)
+
+      if event_type == 'status':
+        if self.on_status(status) is False:
+          return False
+      elif event_type == 'delete':
+        delete = data['delete']['status']
+        if self.on_delete(delete['id'], delete['user_id']) is False:
+          return False
+      elif event_type in ('event', 'direct_message'):
+        if self.handleEvent(event_type, status, start, raw_data,
+            resumed) is False:
+          return False
+      elif event_type == 'limit':
+        if self.on_limit(data['limit']['track']) is False:
+          return False
+      elif event_type == 'disconnect':
+        if self.on_disconnect(data['disconnect']) is False:
+          return False
+      else:
+        log.debug('TwitterBotStreamListener::on_data(): got event/stream data '
+            'of unknown type. Raw data follows:\n%s', data)
+    finally:
+      tracing.finishTrace()
+
+  def handleEvent(self, event_type, status, start, raw_data=None,
+      resumed=False):
+    """Handle a userstream event or DM: right away, or, if the bot has a
+    scheduler, queued by priority (see ``scheduler``.) ``raw_data`` is kept
+    along with it, in case it's still queued on shutdown.
+
+    ``resumed`` events (left unfinished by a previous process) were admitted
+    already; if we've seen them, it's only on our stream, too."""
+
+    # (everything about a DM depends on state; and while taking over from
+    # another process, it's also what tells us which events it has handled)
+    self.bot.waitForState()
+    priority = self.bot.priorityOf(event_type, status)
+    if event_type == 'direct_message':
+      if status.direct_message['sender']['id_str'] == \
+          self.bot.bot_info.id_str:
+        return # sent by us; see on_direct_message()
+      repeated = self.bot.isRepeatMessage(status) # (remembers it, too)
+      if not resumed and (repeated or
+          not self.bot.admitMessage(status, priority)):
+        return
+    elif self.bot.isRepeatEvent(status) and not resumed:
+      return
 
-    if 'in_reply_to_status_id' in data:
-      status = Status.parse(self.api, data)
-      if self.on_status(status) is False:
-        return False
-    elif 'delete' in data:
-      delete = data['delete']['status']
-      if self.on_delete(delete['id'], delete['user_id']) is False:
-        return False
-    elif 'event' in data:
-      status = Status.parse(self.api, data)
-      if self.on_event(status) is False:
-        return False
-    elif 'direct_message' in data:
-      status = Status.parse(self.api, data)
-      if self.on_direct_message(status) is False:
-        return False
-    elif 'limit' in data:
-      if self.on_limit(data['limit']['track']) is False:
-        return False
-    elif 'disconnect' in data:
-      if self.on_disconnect(data['disconnect']) is False:
-        return False
-    else:
-      log.debug('TwitterBotStreamListener::on_data(): got event/stream data of'
-          ' unknown type. Raw data follows:\n%s', data)
+    scheduler = self.bot.scheduler
+    if scheduler is None:
+      return self.runHandler(event_type, status, start)
+    # the trace goes along with the event, to the thread that will handle it;
+    # a user's DMs still waiting to be handled are collapsed into the latest:
+    scheduler.submit(priority, self.runHandler,
+        (event_type, status, start, tracing.detachTrace(), time.time()),
+        key=self.userIdOf(event_type, status),
+        coalesce=config.COALESCE_WINDOW if event_type == 'direct_message'
+            else None,
+        record=self.bot.workRecord('event', raw_data) if raw_data else None,
+        replaced=self.finishReplacedTrace)
+
+  @staticmethod
+  def finishReplacedTrace(args):
+    """The trace of an event collapsed into a later one ends here."""
+
+    _, _, _, trace, queued = args
+    if trace is not None:
+      trace.addSpan('queue', queued, time.time() - queued)
+      tracing.finishTrace(trace, 'coalesced')
+
+  def runHandler(self, event_type, status, start, trace=None, queued=None):
+    if queued is not None:
+      tracing.attachTrace(trace)
+      tracing.recordStage('queue', queued, time.time() - queued)
+    try:
+      with self.watching(event_type):
+        if event_type == 'event':
+          result = self.on_event(status)
+        else:
+          result = self.on_direct_message(status)
+      if result is not False:
+        metrics.stage_latency.observe(time.time() - start, 'total')
+      return result
+    finally:
+      if queued is not None:
+        tracing.finishTrace()
 
-    self.processing_data = False
+  @staticmethod
+  def userIdOf(event_type, status):
+    """Whom the event is from (as an id_str), or None."""
+
+    if event_type == 'direct_message':
+      return status.direct_message['sender']['id_str']
+    source = getattr(status, 'source', None)
+    if isinstance(source, dict):
+      return source.get('id_str')
+    return None
+
+  def watching(self, description):
+    """Context manager for handling one event, under the bot's watchdog (if
+    there is one.)"""
+
+    if self.bot.watchdog is None:
+      return _not_watching
+    return self.bot.watchdog.watch(description)
+
+  @staticmethod
+  def eventTypeOf(data):
+    """Tell what kind of userstream message ``data`` (parsed JSON) is."""
+
+    if 'in_reply_to_status_id' in data:
+      return 'status'
+    for event_type in ('delete', 'event', 'direct_message', 'limit',
+        'disconnect'):
+      if event_type in data:
+        return event_type
+    return 'unknown'
 
   def on_status(self, status):
     """Called when a new status arrives"""
@@ -129,7 +262,7 @@ class TwitterBotStreamListener(tweepy.StreamListener):
     is received from the server. Allows the listener
     to perform some work prior to entering the read loop.
     """
-    pass
+    self.bot.onStreamConnected()
 
   def on_exception(self, exception):
     """Called when an unhandled exception occurs."""
@@ -161,6 +294,26 @@ class TwitterBotStreamListener(tweepy.StreamListener):
     return
 
 
+class RedirectableStream(tweepy.Stream):
+  """A ``tweepy.Stream`` that can be pointed at some other host.
+
+  ``tweepy.Stream.userstream()`` (etc.) set the host themselves, so we
+  override it at the attribute level. ``host=None`` behaves like the parent.
+  """
+
+  def __init__(self, auth, listener, host=None, **options):
+    self._host_override = host
+    super(RedirectableStream, self).__init__(auth, listener, **options)
+
+  def _getHost(self):
+    return self._host_override or self._host
+
+  def _setHost(self, host):
+    self._host = host
+
+  host = property(_getHost, _setHost)
+
+
 class TwitterBot(object):
   """Main interface between the stateful listener and Twitter APIs.
 
@@ -178,30 +331,72 @@ class TwitterBot(object):
     'token_secret': config.TOKEN_SECRET
   }
 
-  def __init__(self, **kw):
+  def __init__(self, storage_suffix=None, shared_with=None, take_over=False,
+      **kw):
     """Constructor that accepts custom access config as named arguments.
 
     Easy to test things from interactive shell this way.
     Probably won't be needed in production code.
+
+    ``shared_with`` is another ``TwitterBot`` (for another account) whose
+    state, bridge getter etc. this one should use, instead of having its own.
+
+    With ``take_over``, state comes from the bot process already running
+    (if there is one), which then hands over to us (see ``handoff``.)
     """
 
-    self.access_config = dict()
-    for key, default in self.default_access_config.iteritems():
-      self.access_config[key] = kw.get(key, default)
+    self.access_config = self.accessConfigFrom(kw)
+
+    # each account has its own outbound rate budgets:
+    self.dm_budget = TokenBucket.perPeriod(*config.DM_BUDGET)
+    self.follow_budget = TokenBucket.perPeriod(*config.FOLLOW_BUDGET)
+    self.reactor = None # set when running on the reactor (``runReactor()``)
+    self.storage_suffix = storage_suffix
+    self.unfollow_queue = None # see ``startUnfollowQueue()``
+    self.listener = self.stream = None # see ``subscribeToStreams()``
+    self.delayed_calls = list() # (call, record) of ``callLater()``s on the
+                                # reactor
+    self.stopping = False
+    self.handoff = None # while taking over (see ``completeTakeOver()``)
+    self.handed_over_events = set() # see ``isRepeatEvent()``
+
+    # DM IDs seen lately (the stream may deliver a DM again after
+    # reconnecting), and what each user asked lately (users repeat "get
+    # bridges" a lot):
+    self.seen_messages = ExpiringLRUCache(config.SEEN_MESSAGES_MAX,
+        expiry_time=config.SEEN_MESSAGES_EXPIRY)
+    self.recent_requests = ExpiringLRUCache(config.SEEN_MESSAGES_MAX,
+        expiry_time=config.COALESCE_WINDOW)
+
+    if shared_with is not None:
+      self.shareStateWith(shared_with)
+      return
 
     self.storage_controller = StorageController()
 
+    snapshot = None
+    if take_over:
+      from twidibot.handoff import HandoffClient
+      self.handoff = HandoffClient(config.HANDOFF_SOCKET,
+          timeout=config.HANDOFF_TIMEOUT)
+      snapshot = self.handoff.fetchSnapshot()
+      if snapshot is None:
+        self.handoff = None
+
     # TwitterBotState initializes particular storage handlers,
     # and attaches them to the main storage controller:
-    self.state = TwitterBotState(self.storage_controller)
+    # (loading in the background, while we connect; see ``waitForState()``)
+    self.state = TwitterBotState(self.storage_controller, storage_suffix,
+        load_in_background=config.LOAD_STATE_IN_BACKGROUND, snapshot=snapshot)
 
     # ChurnController doesn't care about storage in itself; we just pass in
     # the respective container:
-    self.churn_controller = ChurnController(self.state.user_access_times)
+    self.churn_controller = self.churnControllerClass()(
+        self.state.user_access_times)
 
     # likewise with challenge response; we only pass the respective container:
     if config.DO_CHALLENGE_RESPONSE:
-      self.challenge_response = BogusTextBasedChallengeResponseSystem(
+      self.challenge_response = self.challengeResponseSystem()(
           self.state.user_challenges)
     else:
       self.challenge_response = None
@@ -210,9 +405,94 @@ class TwitterBot(object):
     # will likely be needed here, etc.:
     self.bridge_getter = bridge_getter.TwitterBotBridgeGetter(
         known_pt_types=config.KNOWN_PT_TYPES)
+    if config.MEMOIZE_BRIDGES:
+      # answer re-requests within the churn window with the same bridges:
+      self.bridge_getter = bridge_getter.MemoizingBridgeGetter(
+          self.bridge_getter, max_users=config.MEMOIZED_BRIDGES_MAX_USERS,
+          expiry_time=config.MIN_REREQUEST_TIME)
+
+    self.request_parser = RequestParser.fromConfig()
+    self.responses = ResponseCatalog.fromConfig()
+
+    if config.WATCHDOG_DEADLINE:
+      self.watchdog = Watchdog(config.WATCHDOG_DEADLINE,
+          cancel_stuck=config.WATCHDOG_CANCEL_STUCK_WORK)
+      self.watchdog.start()
+    else:
+      self.watchdog = None
+
+    # handle events on a pool of threads, most urgent first:
+    if config.SCHEDULER_THREADS:
+      self.scheduler = PriorityScheduler(config.SCHEDULER_THREADS,
+          aging=config.SCHEDULER_AGING)
+      self.scheduler.start()
+    else:
+      self.scheduler = None
+
+    if config.ADMISSION_CONTROL:
+      self.admission = admission.AdmissionController(config.ADMISSION_BUDGET,
+          config.ADMISSION_USER_BUDGET, config.ADMISSION_LATENCY_TARGET,
+          busy_reply_interval=config.BUSY_REPLY_INTERVAL)
+    else:
+      self.admission = None
+
+    self.registerStorageGauges()
+    if config.TRACE_SAMPLE_RATE:
+      tracing.configure(config.TRACE_FILE, config.TRACE_SAMPLE_RATE,
+          safe_log=config.SAFE_LOG)
+    if self.handoff is None:
+      self.startMetricsServer()
+    # (otherwise, the process we're taking over from has the port until it
+    # lets go; see ``completeTakeOver()``)
 
     self.setSignalHandlers()
 
+  @staticmethod
+  def challengeResponseSystem():
+    """The class for config.CHALLENGE_RESPONSE_SYSTEM (imported only if it's
+    the one used.)"""
+
+    if config.CHALLENGE_RESPONSE_SYSTEM == 'reactor':
+      from twidibot.reactor_challenge_response import \
+          TwitterReactorBasedChallengeResponseSystem
+      return TwitterReactorBasedChallengeResponseSystem
+    return BogusTextBasedChallengeResponseSystem
+
+  @staticmethod
+  def churnControllerClass():
+    """The class for config.CHURN_BACKEND: 'exact' (a timestamp per user),
+    or 'bloom' (see ``churn_control``.)"""
+
+    if config.CHURN_BACKEND == 'bloom':
+      if config.STATE_BACKEND != 'remote':
+        return BloomChurnController
+      # (the filter would be fetched, and stored back, whole, every time)
+      log.warning("Bloom filter churn control needs local state; keeping "
+          "exact timestamps on the state server instead.")
+    return ChurnController
+
+  def shareStateWith(self, bot):
+    for name in ('storage_controller', 'state', 'churn_controller',
+        'challenge_response', 'bridge_getter', 'request_parser', 'responses',
+        'watchdog', 'scheduler', 'admission'):
+      setattr(self, name, getattr(bot, name))
+
+  @classmethod
+  def accessConfigFrom(cls, kw):
+    access_config = dict()
+    for key, default in cls.default_access_config.iteritems():
+      access_config[key] = kw.get(key, default)
+    return access_config
+
+  def registerStorageGauges(self):
+    metrics.gauge('twidibot_churn_users', 'Users in churn control storage.',
+        lambda: self.churn_controller.userCount())
+    metrics.gauge('twidibot_challenge_users', 'Users with a stored '
+        'challenge-response.', lambda: len(self.state.user_challenges.users))
+    if config.MEMOIZE_BRIDGES:
+      metrics.gauge('twidibot_memoized_bridge_sets', 'Bridge sets remembered '
+          'for re-requests.', lambda: len(self.bridge_getter.given_bridges))
+
   def setSignalHandlers(self):
     """Set up relevant SIG* handlers for the bot.
 
@@ -222,23 +502,38 @@ class TwitterBot(object):
     For now, we'll only care about signals after which the program does exit.
     """
 
-    # for now, we'll only handle SIGTERM. it might make sense to handle SIGINT
-    # as well, though.
+    # for now, we'll only handle SIGTERM and SIGINT, both the same way (and,
+    # if enabled, SIGUSR1/SIGUSR2 to toggle profiling.)
 
     signal.signal(signal.SIGTERM, self.handleSIGTERM)
-    log.debug("SIGTERM handler is set.")
+    signal.signal(signal.SIGINT, self.handleSIGTERM)
+    log.debug("SIGTERM / SIGINT handlers are set.")
+
+    if config.PROFILING_SIGNALS:
+      from twidibot.profiler import ProfilerControl
+      self.profiler_control = ProfilerControl(config.PROFILE_DIR,
+          sample_interval=config.PROFILE_SAMPLE_INTERVAL,
+          max_duration=config.PROFILE_MAX_DURATION)
+      self.profiler_control.installSignalHandlers()
 
   def handleSIGTERM(self, sig_number, stack_frame):
-    """Callback function called upon SIGTERM"""
+    """Callback function called upon SIGTERM (or SIGINT): shut down within
+    SHUTDOWN_DEADLINE seconds (see ``drain()``.)"""
 
-    log.info("TwitterBot::handleSIGTERM(): caught SIGTERM signal.")
+    log.info("TwitterBot::handleSIGTERM(): caught signal %d.", sig_number)
+    if self.stopping:
+      log.info("Already shutting down.")
+      return
+    self.stopping = True
+    deadline = time.time() + config.SHUTDOWN_DEADLINE
 
-    log.info("Stopping bot listener.")
-    self.listener.running = False
-    while self.listener.processing_data:
-      log.info("Waiting for TwitterBotStreamListener to finish processing a "
-          "data request/package")
-      time.sleep(0.5)
+    if self.reactor is not None:
+      # we may have interrupted the reactor mid-event; finish up from the
+      # reactor loop instead:
+      self.reactor.callFromThread(self.stopReactor, deadline)
+      return
+
+    self.drain(deadline)
 
     log.info("Closing down storage controller.")
     self.storage_controller.closeAll()
@@ -246,8 +541,129 @@ class TwitterBot(object):
     log.info("Exiting program.")
     sys.exit(0)
 
-  def authenticate(self, auth=None):
-    """Authenticate to Twitter API, get API handle, and remember it."""
+  def drain(self, deadline, records=()):
+    """Shut down gracefully by ``deadline`` (a ``time.time()``): stop taking
+    in events, finish queued work while there's time (up to
+    SHUTDOWN_SAVE_TIME before the deadline), and stop background work. What
+    couldn't be finished (plus ``records``, see ``workRecord()``) is saved
+    in bot state, and redone on the next start (``startResuming()``.)
+
+    Closing storage is up to the caller, so that it's saved once, however
+    many bots share it."""
+
+    self.stopIntake()
+    records = list(records) + self.finishListening(deadline)
+    until = deadline - config.SHUTDOWN_SAVE_TIME
+    if self.scheduler is not None:
+      records.extend(self.drainScheduler(until))
+    self.stopUnfollowQueue(max(0, until - time.time()))
+    self.saveUnfinishedWork(records)
+
+  def stopIntake(self):
+    if self.stream is None:
+      return
+    log.info("Stopping userstream.")
+    self.listener.running = False
+    if self.reactor is not None:
+      self.stream.stop()
+    else:
+      self.stream.disconnect()
+
+  def finishListening(self, deadline):
+    """Wait (until ``deadline``) for the listener to be done with the event
+    it's handling, if any. Returns records of the work that won't get
+    done."""
+
+    listener = self.listener
+    if listener is None or not listener.processing_data:
+      return []
+    if listener.processing_thread is threading.current_thread():
+      # a signal handler interrupted it (on the main thread); it won't get
+      # to finish:
+      return [self.workRecord('event', listener.current_data)]
+    log.info("Waiting for the listener to finish handling an event.")
+    while listener.processing_data and time.time() < deadline:
+      time.sleep(0.05)
+    return []
+
+  def drainScheduler(self, until):
+    """Run queued work until ``until``; then take what's left, and wait
+    (until then, too) for what's running. Returns records of the work
+    taken."""
+
+    log.info("Finishing queued work.")
+    if not self.scheduler.waitUntilIdle(max(0, until - time.time())):
+      log.warning("Out of time for queued work.")
+    records = self.scheduler.drain()
+    self.scheduler.stop(timeout=max(0, until - time.time()))
+    return records
+
+  def workRecord(self, kind, data):
+    """A record of work to be redone, if it's unfinished at shutdown:
+    ('event', raw userstream data), or ('response', ``sendResponse()``
+    args)."""
+
+    return (self.accountKey(), kind, data)
+
+  def saveUnfinishedWork(self, records):
+    """Put ``records`` (see ``workRecord()``) in bot state, by account."""
+
+    if not records:
+      return
+    if not self.state.loaded.is_set():
+      log.warning("Bot state not loaded yet; dropping %d unfinished work "
+          "items.", len(records))
+      return
+    work = dict()
+    for account, kind, data in records:
+      items = work.setdefault(account, list())
+      if (kind, data) not in items:
+        items.append((kind, data))
+    container = self.state.unfinished_work
+    for account, items in work.iteritems():
+      container.users[account] = list(container.users.get(account) or ()) + \
+          items
+    log.info("Saving %d unfinished work items for next time.", len(records))
+
+  def startResuming(self):
+    """Redo the work left unfinished at the last shutdown, once bot state is
+    loaded (without holding up the stream.)"""
+
+    if self.reactor is not None:
+      from twisted.internet import threads
+      threads.deferToThread(self.state.loaded.wait).addCallback(
+          lambda _: self.resumeUnfinishedWork())
+      return
+    thread = threading.Thread(target=self.resumeUnfinishedWork,
+        name='resume')
+    thread.daemon = True
+    thread.start()
+
+  def resumeUnfinishedWork(self):
+    self.waitForState()
+    work = self.state.unfinished_work.users.pop(self.accountKey(), None)
+    if not work:
+      return
+    log.info("Resuming %d work items left unfinished at the last shutdown.",
+        len(work))
+    for kind, data in work:
+      try:
+        if kind == 'event':
+          self.listener.handleData(data, resumed=True)
+        elif kind == 'response':
+          self.sendResponse(*data)
+      except Exception as e:
+        log.exception("Failed to resume unfinished work: %s", e)
+
+  def authenticate(self, auth=None, api_host=None, secure=None):
+    """Authenticate to Twitter API, get API handle, and remember it.
+
+    ``api_host`` (default: config.TWITTER_API_HOST, or Twitter itself if not
+    set) can point the bot to e.g. a local ``twitter_standin`` server.
+    """
+
+    api_host = api_host or config.TWITTER_API_HOST
+    secure = config.TWITTER_USE_TLS if secure is None else secure
 
     if auth:
       self.auth = auth
@@ -260,7 +676,11 @@ class TwitterBot(object):
           self.access_config['token_secret'])
 
     try:
-      self.api = tweepy.API(self.auth)
+      if api_host:
+        self.api = tweepy.API(self.auth, host=api_host, secure=secure,
+            timeout=config.TWITTER_API_TIMEOUT)
+      else:
+        self.api = tweepy.API(self.auth, timeout=config.TWITTER_API_TIMEOUT)
     except Exception as e:
       log.fatal('Exception while authenticating to Twitter and getting API '
           'handle: %s', e)
@@ -272,150 +692,552 @@ class TwitterBot(object):
 
     if self.api:
       log.info('Authenticated to Twitter and got the RESTful API handle')
-      self.bot_info = self.api.me()
+      if api_host:
+        # api.me() asks the auth handler for our username, and the handler
+        # always asks Twitter itself; so ask our API host directly instead.
+        self.bot_info = self.api.verify_credentials()
+        self.auth.username = self.bot_info.screen_name
+      else:
+        self.bot_info = self.api.me()
+
+  def makeListener(self):
+    return TwitterBotStreamListener(bot=self, api=self.api)
+
+  def subscribeToStreams(self, stream_host=None, secure=None,
+      in_background=None):
+    """Subscribe to relevant streams in the Streaming API.
+
+    ``stream_host`` defaults to config.TWITTER_STREAM_HOST (if not set,
+    Twitter's own streaming hosts are used.) ``in_background`` defaults to
+    config.ASYNC_STREAMING_API.
+    """
 
-  def subscribeToStreams(self):
-    """Subscribe to relevant streams in the Streaming API."""
+    stream_host = stream_host or config.TWITTER_STREAM_HOST
+    secure = config.TWITTER_USE_TLS if secure is None else secure
 
-    self.listener = TwitterBotStreamListener(bot=self, api=self.api)
-    self.stream = tweepy.Stream(self.auth, self.listener)
+    self.startUnfollowQueue()
+    self.listener = self.makeListener()
+    self.startResuming()
+    self.stream = RedirectableStream(self.auth, self.listener,
+        host=stream_host, secure=secure)
 
     # user stream gives us direct messages and follow events
-    self.stream.userstream(async=config.ASYNC_STREAMING_API)
+    self.stream.userstream(async=config.ASYNC_STREAMING_API
+        if in_background is None else in_background)
     # stream.filter may be useful, but we don't need it for now
 
     # the following will not be executed if we're not going async -
     # userstream() blocks, its event handler loop takes over:
     log.info('Subscribed to relevant streams via Streaming API')
 
+  def runReactor(self, api_host=None, stream_host=None, secure=None):
+    """Authenticate, subscribe to the userstream, and handle events, all on
+    the Twisted reactor: REST API calls don't block, so many requests can be
+    in flight at once. Returns once the reactor is stopped.
+
+    Hosts default to config.TWITTER_API_HOST and config.TWITTER_STREAM_HOST,
+    like for ``authenticate()`` and ``subscribeToStreams()``.
+    """
+
+    self.startOnReactor(api_host, stream_host, secure)
+    # keep our own SIGTERM handler:
+    self.reactor.run(installSignalHandlers=False)
+
+  def startOnReactor(self, api_host=None, stream_host=None, secure=None):
+    """Set things up for ``runReactor()``; the rest happens once the reactor
+    runs. (Several bots can share a reactor this way; see ``accounts``.)"""
+
+    from twisted.internet import reactor
+    from twidibot import async_twitter
+
+    api_host = api_host or config.TWITTER_API_HOST or 'api.twitter.com'
+    stream_host = stream_host or config.TWITTER_STREAM_HOST or \
+        'userstream.twitter.com'
+    secure = config.TWITTER_USE_TLS if secure is None else secure
+
+    self.reactor = reactor
+    if self.scheduler is not None:
+      # nothing blocks on the reactor; events are handled right as they come
+      self.scheduler.stop()
+      self.scheduler = None
+    client = async_twitter.AsyncTwitterClient(self.access_config, api_host,
+        secure, timeout=config.TWITTER_API_TIMEOUT,
+        max_connections=config.TWITTER_API_MAX_CONNECTIONS)
+    self.api = async_twitter.DeferredTwitterAPI(client)
+    self.listener = self.makeListener()
+    self.stream = async_twitter.AsyncUserStream(client, self.listener,
+        stream_host, secure)
+
+    def authenticated(bot_info):
+      self.bot_info = bot_info
+      log.info('Authenticated to Twitter (non-blocking API client)')
+      self.startUnfollowQueue()
+      self.startResuming()
+      self.stream.start()
+
+    def failed(failure):
+      log.fatal('Exception while authenticating to Twitter: %s',
+          failure.getErrorMessage())
+      reactor.stop()
+
+    reactor.callWhenRunning(lambda: self.api.verify_credentials().addCallbacks(
+        authenticated, failed))
+
+  def startUnfollowQueue(self):
+    """Start doing the unfollows ``handleDirectMessage()`` queues (and any
+    left pending from before); needs ``bot_info``, to know whose they are."""
+
+    self.unfollow_queue = UnfollowQueue(self.state.pending_unfollows,
+        self.accountKey(),
+        self.unfollow, config.UNFOLLOW_BUDGET,
+        batch_size=config.UNFOLLOW_BATCH_SIZE,
+        interval=config.UNFOLLOW_INTERVAL,
+        max_attempts=config.UNFOLLOW_MAX_ATTEMPTS,
+        retry_delay=config.UNFOLLOW_RETRY_DELAY, save=self.state.checkpoint,
+        ready=self.state.loaded)
+    self.unfollow_queue.start(self.reactor)
+
+  def startHandoffServer(self):
+    """Be ready to hand over to a new process (see ``handoff``), if
+    config.HANDOFF_SOCKET is set."""
+
+    if config.HANDOFF_SOCKET:
+      from twidibot.handoff import HandoffServer
+      HandoffServer(self, config.HANDOFF_SOCKET,
+          timeout=config.HANDOFF_TIMEOUT).start()
+
+  def onStreamConnected(self):
+    if self.handoff is not None:
+      # (the old process may take a while to let go; don't hold the stream
+      # up meanwhile)
+      thread = threading.Thread(target=self.completeTakeOver,
+          name='handoff')
+      thread.daemon = True
+      thread.start()
+
+  def completeTakeOver(self):
+    """Now that our stream is up, have the process we're taking over from
+    let go of its, and carry on with its state."""
+
+    handoff, self.handoff = self.handoff, None
+    try:
+      changes, seen = handoff.release()
+    except Exception as e:
+      log.error("Handoff failed (%s); carrying on with the snapshot.", e)
+      changes, seen = dict(), ()
+    finally:
+      handoff.close()
+    # (before ``finishTakeOver()``: events wait for it; see ``handleEvent()``)
+    for key in seen:
+      if key.startswith('event:'):
+        self.handed_over_events.add(key)
+      else:
+        self.seen_messages.setIfAbsent(key, True)
+    self.state.finishTakeOver(self.storage_controller, changes)
+    log.info("Took over from the previous process (%d DMs / events seen).",
+        len(seen))
+    self.startHandoffServer()
+    # (it may not have exited quite yet:)
+    self.startMetricsServer(retry_for=config.HANDOFF_TIMEOUT)
+
+  @staticmethod
+  def startMetricsServer(retry_for=0.0):
+    if config.METRICS_HTTP_PORT:
+      metrics.startHTTPServer(config.METRICS_HTTP_PORT,
+          config.METRICS_HTTP_HOST, retry_for)
+
+  def release(self, deadline):
+    """Let go of the stream, for a process taking over (see ``handoff``):
+    stop taking in events, and leave queued work in bot state, for it to do;
+    wait (until ``deadline``) for work in progress."""
+
+    self.stopping = True
+    metrics.stopHTTPServer() # (the new process wants the port)
+    if self.reactor is not None:
+      from twisted.internet.threads import blockingCallFromThread
+      blockingCallFromThread(self.reactor, self.stopOnReactor)
+      while self.api.inFlight() and time.time() < deadline:
+        time.sleep(0.05)
+      self.stopUnfollowQueue() # (again, now that the unfollows are done)
+      return
+    self.stopIntake()
+    records = self.finishListening(deadline)
+    if self.scheduler is not None:
+      records.extend(self.scheduler.drain())
+      self.scheduler.stop(timeout=max(0, deadline - time.time()))
+    self.stopUnfollowQueue(max(0, deadline - time.time()))
+    self.saveUnfinishedWork(records)
+
+  def exitAfterHandoff(self):
+    log.info("Closing down storage controller.")
+    self.storage_controller.closeAll()
+
+    log.info("Handed over; exiting program.")
+    if self.reactor is not None:
+      self.reactor.callFromThread(self.reactor.stop)
+      return
+    # (whatever the main thread is doing)
+    logger.flush(5.0)
+    os._exit(0)
+
+  def accountKey(self):
+    """Our account's key in bot state (for unfollows, unfinished work);
+    needs ``bot_info``."""
+
+    if self.storage_suffix:
+      return '%s.%s' % (self.bot_info.id_str, self.storage_suffix)
+    return self.bot_info.id_str
+
+  def stopUnfollowQueue(self, timeout=None):
+    if self.unfollow_queue is not None:
+      log.info("Saving pending unfollows.")
+      self.unfollow_queue.stop(timeout=config.SHUTDOWN_DEADLINE
+          if timeout is None else timeout)
+
+  def stopReactor(self, deadline):
+    """``drain()``, on the reactor (without blocking it); then stop it."""
+
+    self.stopOnReactor()
+
+    def finish():
+      # (again, now that the unfollows in flight are done:)
+      self.stopUnfollowQueue()
+
+      log.info("Closing down storage controller.")
+      self.storage_controller.closeAll()
+
+      log.info("Stopping reactor.")
+      self.reactor.stop()
+
+    self.whenIdle(deadline - config.SHUTDOWN_SAVE_TIME, finish)
+
+  def stopOnReactor(self):
+    """Stop taking in events, and starting unfollows; save the replies still
+    to be sent later (see ``callLater()``.)"""
+
+    self.stopIntake()
+    self.stopUnfollowQueue()
+    records = [record for call, record in self.delayed_calls
+        if call.active()]
+    for call, _ in self.delayed_calls:
+      if call.active():
+        call.cancel()
+    self.delayed_calls = list()
+    self.saveUnfinishedWork(records)
+
+  def whenIdle(self, until, function, bots=None):
+    """On the reactor: call ``function()`` once no REST API calls (of
+    ``bots``; default: ours) are in flight, or at ``until``."""
+
+    bots = bots or [self]
+    in_flight = sum(bot.api.inFlight() for bot in bots)
+    if in_flight and time.time() < until:
+      self.reactor.callLater(0.1, self.whenIdle, until, function, bots)
+      return
+    if in_flight:
+      log.warning("Out of time: %d API calls still in flight.", in_flight)
+    function()
+
+  def callLater(self, delay, function, args=(), record=None):
+    """Call ``function(*args)`` in ``delay`` seconds. Blocks until then,
+    unless running on the reactor, or with a scheduler (which then runs it as
+    housekeeping.) ``record`` (see ``workRecord()``) is saved, if it's still
+    to come on shutdown."""
+
+    if self.reactor is not None:
+      call = self.reactor.callLater(delay, function, *args)
+      if record is not None:
+        self.delayed_calls = [(other, other_record) for other, other_record
+            in self.delayed_calls if other.active()]
+        self.delayed_calls.append((call, record))
+    elif self.scheduler is not None:
+      self.scheduler.submitAfter(delay, HOUSEKEEPING, function, args,
+          record=record)
+    else:
+      time.sleep(delay)
+      function(*args)
+
+  def waitForState(self):
+    """Wait until bot state is loaded (it may still be loading in the
+    background; see ``TwitterBotState``.)"""
+
+    if self.state.loaded.is_set():
+      return
+    log.info("Waiting for bot state to load.")
+    while not self.state.loaded.wait(1.0): # (a timeout lets signals through)
+      pass
+
+  def isRepeatMessage(self, status):
+    """Whether a DM to us is one we've handled (or queued) already, or the
+    same text its sender sent just now (within COALESCE_WINDOW.)"""
+
+    direct_message = status.direct_message
+    sender_id = direct_message['sender']['id_str']
+    if not self.seen_messages.setIfAbsent(direct_message['id_str'], True):
+      metrics.duplicate_messages.inc('replayed')
+      return True
+    if config.COALESCE_WINDOW and not self.recent_requests.setIfAbsent(
+        (sender_id, direct_message['text'].strip().lower()), True):
+      metrics.duplicate_messages.inc('repeated')
+      return True
+    return False
+
+  def isRepeatEvent(self, status):
+    """Whether a userstream event (e.g. a follow) is one the process we took
+    over from has handled (or queued) already. (Events have no IDs; the same
+    user may well follow again within the second, so our own aren't
+    deduplicated.)"""
+
+    key = 'event:%s:%s:%s' % (status.event,
+        TwitterBotStreamListener.userIdOf('event', status),
+        getattr(status, 'created_at', None))
+    if key in self.handed_over_events:
+      self.handed_over_events.discard(key) # (we get each one once, too)
+      metrics.duplicate_messages.inc('replayed')
+      return True
+    self.seen_messages.setIfAbsent(key, True) # (for the next process)
+    return False
+
+  def admitMessage(self, status, priority):
+    """Whether to handle a DM, under the current load (see ``admission``.)
+    If not, its sender may be told we're busy."""
+
+    if self.admission is None:
+      return True
+    sender_id = status.direct_message['sender']['id_str']
+    decision = self.admission.decide(sender_id, priority, self.scheduler)
+    if decision == admission.ADMIT:
+      return True
+    if decision != admission.DROP and self.admission.shouldNotify(sender_id):
+      args = (status.direct_message['sender_id'], 'busy',
+          status.direct_message['sender'].get('lang'))
+      if self.scheduler is not None:
+        # not ahead of the users we did admit:
+        self.scheduler.submit(HOUSEKEEPING, self.sendResponse, args,
+            key=sender_id, record=self.workRecord('response', args))
+      else:
+        self.sendResponse(*args)
+    return False
+
+  def priorityOf(self, event_type, status):
+    """Scheduling class of a userstream event or DM (see ``scheduler``.)"""
+
+    if event_type != 'direct_message':
+      return HOUSEKEEPING
+    # (only what could be an answer: "get bridges" again mustn't skip
+    # shedding, or be coalesced with a waiting answer)
+    if self.challenge_response is not None and \
+        self.parseRequest(status).is_answer and \
+        self.challenge_response.userHasAChallenge(
+            status.direct_message['sender_screen_name']):
+      return CR_ANSWER
+    return BRIDGE_REQUEST
+
+  def parseRequest(self, status):
+    """The DM's ``ParsedRequest`` (parsed once, and kept on ``status``.)"""
+
+    request = getattr(status, 'parsed_request', None)
+    if request is None:
+      with tracing.stage('request_parse'):
+        request = status.parsed_request = self.request_parser.parse(
+            status.direct_message['text'])
+    return request
+
   def handleFollowEvent(self, event):
     user_id = event.source['id']  # 'id' is unique big int
+    tracing.setUser(event.source['screen_name'])
 
     if user_id != self.bot_info.id:
-      user = self.api.get_user(id=user_id)
-      user.follow()
+      if self.follow_budget.take():
+        user = self.api.get_user(id=user_id)
+        user.follow()
+      else:
+        metrics.budget_exhausted.inc('follow')
+        log.warning("Not following back user %s: out of follow budget.",
+            UserRef(user_id))
 
     if config.RESPOND_AFTER_FOLLOW:
-      # the following line *blocks* the thread that we care about.
-      # we should not do this, ever.
-      # as long as we're just testing with a few cat accounts, it's ok.
-      time.sleep(config.WAIT_TIME_AFTER_FOLLOW)  # TODO: use sched.scheduler,
-                                                 # or threading.Timer (or sth)
+      # unless we're on the reactor, waiting *blocks* the thread that we care
+      # about. as long as we're just testing with a few cat accounts, it's ok.
 
       # previously we just sent some bridges automatically, but now we send
       # an informative message instead. I guess this is good, but maybe it'd
       # be nice for a user to receive bridges just by clicking 'follow.'
 
       #str_bridges = self.bridge_getter.getBridges(user_id, event.source)
-      self.sendMessage(user_id, 'Hello! Say: "get bridges". If you want '
-          'pluggable transport bridges, include the PT name (e.g. "obfs3"), '
-          'too.')
+      args = (user_id, 'greeting', event.source.get('lang'))
+      self.callLater(config.WAIT_TIME_AFTER_FOLLOW, self.sendResponse, args,
+          record=self.workRecord('response', args))
 
   def handleDirectMessage(self, status):
+    """Answer a DM; all of the answer goes out at the end, in as few DMs as
+    it fits in (see ``responses.ReplyBuffer``.)"""
+
+    sender_id = status.direct_message['sender_id']
+    reply = ReplyBuffer(self.responses, config.CHARACTER_LIMIT)
+    result = self.answerDirectMessage(status, reply)
+
+    def replied():
+      if reply.sent('bridges') and config.UNFOLLOW_AFTER_GIVING_BRIDGES:
+        # (done in the background, at its own rate; see ``unfollow_queue``)
+        self.unfollow_queue.add(sender_id)
+    self.sendReply(sender_id, reply, replied)
+    return result
+
+  def answerDirectMessage(self, status, reply):
     sender_id = status.direct_message['sender_id']
-    message = status.direct_message['text'].strip().lower()
     screen_name = status.direct_message['sender_screen_name']
+    tracing.setUser(screen_name)
+    request = self.parseRequest(status)
+    message = request.text
+    locale = request.locale
 
     # FIXME <- move to ``BridgeRequest``s / merge nonbroken things here.
     if config.DO_CHALLENGE_RESPONSE:
-      if self.challenge_response.userHasAChallenge(screen_name):
-        if self.challenge_response.checkUserAnswer(screen_name, message):
+      with tracing.stage('cr_check'):
+        # (anything but a lone word - e.g. "get bridges" again - isn't an
+        # answer; it just gets them a new challenge:)
+        has_challenge = request.is_answer and \
+            self.challenge_response.userHasAChallenge(screen_name)
+        answer_ok = has_challenge and \
+            self.challenge_response.checkUserAnswer(screen_name, message)
+      if has_challenge:
+        metrics.challenge_responses.inc('pass' if answer_ok else 'fail')
+        if answer_ok:
           # process cached request here ->
-          self.sendMessage(sender_id, "Correct! (Response with bridges goes "
-              "here.)")
+          reply.addResponse('challenge_passed', locale)
           return
         else:
-          self.sendMessage(sender_id, "The answer to the challenge presented "
-              "is incorrect; here's another challenge:")
+          reply.addResponse('challenge_failed', locale)
 
       # either there wasn't a challenge ready, or we need another one:
       challenge = self.challenge_response.generateChallengeForUser(
           screen_name, status.direct_message['sender'])
+      metrics.challenge_responses.inc('issued')
       # assume text-based CR here:
-      self.sendMessage(sender_id, challenge)
+      reply.add(challenge)
       return
 
     # (cleanest way to incorporate bridge requests into a CR system is via
     # ``BridgeRequests`` together with ``bot_state``.)
 
-    if not ('get' in message and 'bridges' in message):  # this is.. overly
-      self.sendMessage(sender_id, 'Send a direct '       # simplistic, maybe
-          'message with the words "get bridges" somewhere in it.')
+    if request.intent != GET_BRIDGES:
+      reply.addResponse('help', locale)
       return False
 
-    transports = []
-    for pt in config.KNOWN_PT_TYPES:
-      if pt in message and pt not in transports:
-        transports.append(pt)
-    if not transports and len(message) > len('get bridges'):
-      self.sendMessage(sender_id, 'Here is a list of transports I know '
-          'about: %s' % ', '.join(config.KNOWN_PT_TYPES))
+    transports = request.transports
+    if not transports and request.unrecognized:
+      reply.addResponse('transport_list', locale)
       # should we do this? (below)
-      self.sendMessage(sender_id, 'You might have tried specifying a '
-          'transport I do not support. Sending you non-PT bridges anyway.')
+      reply.addResponse('unknown_transport', locale)
 
     # do our own churn control, before any possible interaction with bridgedb:
     if config.DO_SINGLE_USER_CHURN_CONTROL:
-      if not self.churn_controller.canGiveBridgesToUser(screen_name,
-          expiry_time=config.MIN_REREQUEST_TIME):
+      with tracing.stage('churn_check'):
+        # check and update in one go: other threads (or bots for other
+        # accounts, see ``accounts``) may be looking at the same user.
+        can_give = self.churn_controller.checkAndUpdateUser(screen_name,
+            expiry_time=config.MIN_REREQUEST_TIME)
+      if not can_give:
+        metrics.churn_refusals.inc()
+        if config.MEMOIZE_BRIDGES:
+          str_bridges = self.bridge_getter.getMemoizedBridges(
+              status.direct_message['sender'], transports)
+          if str_bridges:
+            log.info("Giving %s the same bridges as last time because of set "
+                "churn rate.", UserRef(screen_name))
+            reply.add(str_bridges)
+            return
 
         log.info("Not providing bridges to %s because of set churn rate.",
-            screen_name)
+            UserRef(screen_name))
         if config.NOTIFY_USERS_ABOUT_CHURN:
           # XXX should we tell users about how long they should wait before
           # XXX being able to get bridges again?
-          self.sendMessage(sender_id, "Please wait a while before requesting "
-              "bridges again!")
+          reply.addResponse('churn_notice', locale)
         return
 
-      timestamp = self.churn_controller.getCurrentTimestamp()
-      self.churn_controller.addOrUpdateUser(screen_name, timestamp)
-
-    str_bridges = self.bridge_getter.getBridges(sender_id,
-        status.direct_message['sender'], transports)
+    with tracing.stage('bridge_fetch'):
+      str_bridges = self.bridge_getter.getBridges(sender_id,
+          status.direct_message['sender'], transports)
     if str_bridges:
-      result = self.sendMessage(sender_id, str_bridges)
-      if result and config.UNFOLLOW_AFTER_GIVING_BRIDGES:
-        self.sendMessage(sender_id, 'For your safety, I will now unfollow '
-            'you. You should unfollow me, too. If you then want bridges '
-            'once more, just start following me again.')
-        self.api.get_user(id=sender_id).unfollow()
+      reply.add(str_bridges, tag='bridges')
+      if config.UNFOLLOW_AFTER_GIVING_BRIDGES:
+        reply.addResponse('unfollow_notice', locale, requires=['bridges'])
 
     else:
-      # XXX this is neither DEBUG, nor safe to log. this is PoC stuff.
-      # TODO: an actual scrubbing function which uses config.SAFE_LOG
-      log.debug('Have no bridge data to give to %s',
-          status.direct_message['sender_screen_name'])
+      log.debug('Have no bridge data to give to %s', UserRef(screen_name))
+
+  def unfollow(self, user_id):
+    # (one API call; going through ``get_user()`` would make it two)
+    return self.api.destroy_friendship(id=user_id)
 
   def sendMessage(self, target_id, message):
-    # this is quick and ugly. primary splits (if needed) at newlines.
+    """Send ``message`` (per-user content; canned responses go through
+    ``sendResponse()``), split into as many DMs as it takes. Returns whether
+    all of it was sent."""
+
+    return self.sendChunks(target_id, split_message(message,
+        config.CHARACTER_LIMIT))
+
+  def sendResponse(self, target_id, message_id, locale=None):
+    """Send a canned response (already split into DMs; see ``responses``.)"""
+
+    return self.sendChunks(target_id, self.responses.chunks(message_id,
+        locale))
+
+  def sendReply(self, target_id, reply, done=None):
+    """Send a ``ReplyBuffer``'s contents, then call ``done()`` (on the
+    reactor, once the DMs have actually gone out or failed; until then,
+    ``reply.sent()`` doesn't know.)"""
+
+    def flushed(errors):
+      for e in errors:
+        metrics.send_failures.inc()
+        log.warning('Failed to send a direct message to %s. Exception:\n%s',
+            UserRef(target_id), e)
+      if done is not None:
+        done()
+    reply.flush(lambda text: self._sendChunk(target_id, text),
+        fatal=RateBudgetExhausted, done=flushed)
+
+  def sendChunks(self, target_id, chunks):
     try:
-      cur_message = ''
-      for line in message.split('\n'):
-        if len(cur_message + ('\n' if cur_message else '') + line)\
-            > config.CHARACTER_LIMIT:
-          self._split_in_chunks_and_send(target_id, cur_message)
-          cur_message = ''
-        else:
-          cur_message += ('\n' if cur_message else '') + line
-      if cur_message:
-        self._split_in_chunks_and_send(target_id, cur_message)
+      for chunk in chunks:
+        result = self._sendChunk(target_id, chunk)
+        if result is not None:
+          result.addErrback(self._sendFailedLater, target_id)
     except Exception as e:
-      # again, scrubbing 'target_id' should be an option, etc.
+      metrics.send_failures.inc()
       log.warning('Failed to send a direct message to %s. Exception:\n%s',
-          str(target_id), e)
+          UserRef(target_id), e)
       return False
     return True
 
-  def _split_in_chunks_and_send(self, target_id, message):
-    # assume any decent humane splitting has been done beforehand.
-    # we have to do with what we have here.
-    # exception handling at higher call stack.
-
-    while message:
-      self.api.send_direct_message(user_id=target_id,
-          text=message[:config.CHARACTER_LIMIT])
-      message = message[config.CHARACTER_LIMIT:]
+  def _sendChunk(self, target_id, chunk):
+    # exception handling at higher call stack. (on the reactor, returns the
+    # Deferred, whose failure is the caller's to handle, too.)
+
+    # waiting for budget would hold up the whole reactor:
+    budget_wait = 0 if self.reactor is not None else \
+        config.RATE_BUDGET_MAX_WAIT
+    if not self.dm_budget.take(timeout=budget_wait):
+      metrics.budget_exhausted.inc('direct_message')
+      raise RateBudgetExhausted('out of direct message budget')
+    with tracing.stage('send'):
+      result = self.api.send_direct_message(user_id=target_id, text=chunk)
+    if hasattr(result, 'addCallbacks'): # a Deferred; see ``runReactor()``
+      return result.addCallback(self._sentLater)
+    metrics.messages_sent.inc()
+
+  def _sentLater(self, result):
+    metrics.messages_sent.inc()
+    return result
+
+  def _sendFailedLater(self, failure, target_id):
+    metrics.send_failures.inc()
+    log.warning('Failed to send a direct message to %s. Exception:\n%s',
+        UserRef(target_id), failure.getErrorMessage())
 
   def followAllFollowers(self):
     """Start following everyone who is following us."""
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A local stand-in for the parts of the Twitter API the bot uses.
+
+For offline integration / load testing of the full stack, including tweepy's
+HTTP layer. Serves (plain HTTP, API version 1.1):
+
+  * REST: direct_messages/new, users/show, friendships/create,
+    friendships/destroy, followers/list, account/verify_credentials
+  * the userstream (user.json), chunked and length-delimited like the real
+    thing, with periodic keep-alive newlines
+
+Responses carry Twitter-style ``x-rate-limit-*`` headers, and requests over
+budget get a 429. Every call is recorded.
+
+There is also a small control interface, for test drivers:
+
+  POST /_standin/events   push userstream events (one JSON object per line)
+                          to every connected stream
+  GET  /_standin/calls    recorded calls, as JSON
+  GET  /_standin/stats    call counts per endpoint, as JSON
+  POST /_standin/reset    forget recorded calls and rate limit usage
+
+Point the bot at it by setting TWITTER_API_HOST and TWITTER_STREAM_HOST to
+e.g. 'localhost:25001', and TWITTER_USE_TLS to False.
+
+  python -m twidibot.twitter_standin --port 25001
+"""
+
+import sys
+import json
+import time
+import argparse
+import itertools
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web.server import Site, NOT_DONE_YET
+from twisted.web.resource import Resource
+
+from twidibot.logger import log
+
+
+API_ROOT = '/1.1'
+TWITTER_TIME_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+RATE_LIMIT_WINDOW = 15 * 60 # seconds
+# requests per window, per endpoint. loosely follows Twitter's documented
+# limits; DMs and friendships aren't header-limited there, but they are
+# limited - these numbers are guesses.
+DEFAULT_RATE_LIMITS = {
+  '/direct_messages/new.json': 1000,
+  '/users/show.json': 180,
+  '/friendships/create.json': 1000,
+  '/friendships/destroy.json': 1000,
+  '/followers/list.json': 15,
+  '/account/verify_credentials.json': 15,
+}
+
+
+class CallRecorder(object):
+  """Remembers every call made to the stand-in server."""
+
+  def __init__(self, log_filename=None):
+    self.calls = list()
+    self.counts = dict()
+    self._log_file = open(log_filename, 'a') if log_filename else None
+
+  def record(self, method, path, args, status):
+    call = {'time': time.time(), 'method': method, 'path': path,
+        'args': dict((k, v[0] if len(v) == 1 else v)
+            for k, v in args.iteritems()),
+        'status': status}
+    self.calls.append(call)
+    self.counts[path] = self.counts.get(path, 0) + 1
+    if self._log_file:
+      self._log_file.write(json.dumps(call) + '\n')
+      self._log_file.flush()
+
+  def reset(self):
+    del self.calls[:]
+    self.counts.clear()
+
+
+class RateLimiter(object):
+  """Fixed-window, per-endpoint request budgets (like Twitter's.)"""
+
+  def __init__(self, limits=None, window=RATE_LIMIT_WINDOW):
+    self.limits = limits if limits is not None else dict(DEFAULT_RATE_LIMITS)
+    self.window = window
+    self._windows = dict() # endpoint => [window reset timestamp, used]
+
+  def check(self, endpoint):
+    """Count a request; returns (allowed, dict of rate limit headers)."""
+
+    limit = self.limits.get(endpoint)
+    if limit is None:
+      return True, {}
+    now = time.time()
+    window = self._windows.get(endpoint)
+    if window is None or window[0] <= now:
+      window = self._windows[endpoint] = [now + self.window, 0]
+    allowed = window[1] < limit
+    if allowed:
+      window[1] += 1
+    headers = {
+      'x-rate-limit-limit': str(limit),
+      'x-rate-limit-remaining': str(limit - window[1]),
+      'x-rate-limit-reset': str(int(window[0])),
+    }
+    return allowed, headers
+
+  def reset(self):
+    self._windows.clear()
+
+
+class TwitterStandIn(object):
+  """Users, friendships, connected streams, and the things we record."""
+
+  def __init__(self, bot_id=1, bot_screen_name='twidibot', rate_limits=None,
+      rate_limit_window=RATE_LIMIT_WINDOW, call_log=None):
+    self.bot_id = bot_id
+    self.bot_screen_name = bot_screen_name
+    self.recorder = CallRecorder(call_log)
+    self.rate_limiter = RateLimiter(rate_limits, rate_limit_window)
+    self.followers = set() # ids of users following the bot
+    self.friends = set() # ids of users the bot follows
+    self.streams = list() # (request, length_delimited) of open userstreams
+    self._ids = itertools.count(10 ** 9)
+
+  def userJSON(self, user_id=None, screen_name=None):
+    if user_id is None and screen_name is None:
+      user_id = self.bot_id
+    if user_id is None:
+      user_id = self.bot_id if screen_name == self.bot_screen_name else \
+          abs(hash(screen_name)) % (10 ** 9)
+    user_id = int(user_id)
+    if screen_name is None:
+      screen_name = self.bot_screen_name if user_id == self.bot_id else \
+          'user%d' % user_id
+    return {
+      'id': user_id,
+      'id_str': str(user_id),
+      'screen_name': screen_name,
+      'name': screen_name,
+      'created_at': 'Wed Aug 27 13:08:45 +0000 2008',
+      'protected': False,
+      'following': user_id in self.friends,
+      'followers_count': len(self.followers) if user_id == self.bot_id else 0,
+      'friends_count': len(self.friends) if user_id == self.bot_id else 0,
+    }
+
+  def nextId(self):
+    return self._ids.next()
+
+  def pushEvent(self, data):
+    """Send a userstream event (a dict, or a raw JSON string) to every
+    connected stream."""
+
+    if isinstance(data, basestring):
+      raw_data, data = data, json.loads(data)
+    else:
+      raw_data = json.dumps(data)
+    self.observeEvent(data)
+    for request, length_delimited in list(self.streams):
+      if length_delimited:
+        request.write('%d\r\n%s' % (len(raw_data) + 2, raw_data + '\r\n'))
+      else:
+        request.write(raw_data + '\r\n')
+
+  def observeEvent(self, data):
+    """Keep track of follows pushed onto the stream."""
+
+    if data.get('event') == 'follow' and \
+        data.get('target', {}).get('id') == self.bot_id:
+      self.followers.add(data['source']['id'])
+    elif data.get('event') == 'unfollow' and \
+        data.get('target', {}).get('id') == self.bot_id:
+      self.followers.discard(data['source']['id'])
+
+  def keepAlive(self):
+    for request, _ in list(self.streams):
+      request.write('\r\n')
+
+
+class RESTResource(Resource):
+  """Emulates the REST endpoints used by the bot."""
+
+  isLeaf = True
+
+  def __init__(self, standin):
+    Resource.__init__(self)
+    self.standin = standin
+
+  def render_GET(self, request):
+    return self.handle(request)
+
+  def render_POST(self, request):
+    return self.handle(request)
+
+  def handle(self, request):
+    endpoint = request.path[len(API_ROOT):]
+    allowed, headers = self.standin.rate_limiter.check(endpoint)
+    for name, value in headers.iteritems():
+      request.setHeader(name, value)
+    request.setHeader('content-type', 'application/json; charset=utf-8')
+
+    if not allowed:
+      status, body = 429, {'errors': [{'code': 88,
+          'message': 'Rate limit exceeded'}]}
+    else:
+      handler = getattr(self, 'handle_' + endpoint.strip('/').replace(
+          '/', '_').replace('.json', ''), None)
+      if handler is None:
+        status, body = 404, {'errors': [{'code': 34,
+            'message': 'Sorry, that page does not exist'}]}
+      else:
+        status, body = handler(request, dict((k, v[0])
+            for k, v in request.args.iteritems()))
+
+    self.standin.recorder.record(request.method, request.path, request.args,
+        status)
+    request.setResponseCode(status)
+    return json.dumps(body)
+
+  def _user(self, args):
+    return self.standin.userJSON(args.get('user_id') or args.get('id'),
+        args.get('screen_name'))
+
+  def handle_direct_messages_new(self, request, args):
+    text = args.get('text')
+    if not text:
+      return 403, {'errors': [{'code': 151, 'message': 'Missing text'}]}
+    message_id = self.standin.nextId()
+    message = {
+      'id': message_id,
+      'id_str': str(message_id),
+      'text': text.decode('utf-8'),
+      'created_at': time.strftime(TWITTER_TIME_FORMAT, time.gmtime()),
+      'sender': self.standin.userJSON(),
+      'sender_id': self.standin.bot_id,
+      'sender_screen_name': self.standin.bot_screen_name,
+      'recipient': self._user(args),
+    }
+    message['recipient_id'] = message['recipient']['id']
+    message['recipient_screen_name'] = message['recipient']['screen_name']
+    # like Twitter, echo sent messages on the sender's userstream:
+    reactor.callLater(0, self.standin.pushEvent, {'direct_message': message})
+    return 200, message
+
+  def handle_users_show(self, request, args):
+    return 200, self._user(args)
+
+  def handle_account_verify_credentials(self, request, args):
+    return 200, self.standin.userJSON()
+
+  def handle_friendships_create(self, request, args):
+    user = self._user(args)
+    self.standin.friends.add(user['id'])
+    user['following'] = True
+    return 200, user
+
+  def handle_friendships_destroy(self, request, args):
+    user = self._user(args)
+    self.standin.friends.discard(user['id'])
+    user['following'] = False
+    return 200, user
+
+  def handle_followers_list(self, request, args):
+    return 200, {
+      'users': [self.standin.userJSON(i) for i in
+          sorted(self.standin.followers)],
+      'next_cursor': 0, 'next_cursor_str': '0',
+      'previous_cursor': 0, 'previous_cursor_str': '0',
+    }
+
+
+class UserStreamResource(Resource):
+  """Emulates the userstream: a long-lived, chunked response."""
+
+  isLeaf = True
+
+  def __init__(self, standin):
+    Resource.__init__(self)
+    self.standin = standin
+
+  def render_GET(self, request):
+    return self.render_POST(request)
+
+  def render_POST(self, request):
+    self.standin.recorder.record(request.method, request.path, request.args,
+        200)
+    length_delimited = request.args.get('delimited') == ['length']
+    stream = (request, length_delimited)
+    self.standin.streams.append(stream)
+    request.notifyFinish().addBoth(
+        lambda _: self.standin.streams.remove(stream))
+
+    request.setHeader('content-type', 'application/json')
+    # like Twitter, start with the list of friends:
+    self.standin.pushEvent({'friends': sorted(self.standin.friends)})
+    return NOT_DONE_YET
+
+
+class ControlResource(Resource):
+  """Lets test drivers push events and read what was recorded."""
+
+  isLeaf = True
+
+  def __init__(self, standin):
+    Resource.__init__(self)
+    self.standin = standin
+
+  def render_GET(self, request):
+    request.setHeader('content-type', 'application/json')
+    if request.path.endswith('/calls'):
+      return json.dumps(self.standin.recorder.calls)
+    if request.path.endswith('/stats'):
+      return json.dumps({'calls': self.standin.recorder.counts,
+          'streams': len(self.standin.streams),
+          'followers': len(self.standin.followers),
+          'friends': len(self.standin.friends)})
+    request.setResponseCode(404)
+    return '{}'
+
+  def render_POST(self, request):
+    request.setHeader('content-type', 'application/json')
+    if request.path.endswith('/events'):
+      pushed = 0
+      for line in request.content.read().splitlines():
+        if line.strip():
+          self.standin.pushEvent(line.strip())
+          pushed += 1
+      return json.dumps({'pushed': pushed})
+    if request.path.endswith('/reset'):
+      self.standin.recorder.reset()
+      self.standin.rate_limiter.reset()
+      return '{}'
+    request.setResponseCode(404)
+    return '{}'
+
+
+class StandInRoot(Resource):
+  def __init__(self, standin):
+    Resource.__init__(self)
+    self.rest = RESTResource(standin)
+    self.userstream = UserStreamResource(standin)
+    self.control = ControlResource(standin)
+
+  def getChild(self, path, request):
+    if request.path.startswith('/_standin/'):
+      return self.control
+    if request.path == API_ROOT + '/user.json':
+      return self.userstream
+    return self.rest
+
+
+def runServer(port=25001, interface='127.0.0.1', keep_alive_interval=30.0,
+    **standin_options):
+  """Start listening (the reactor still has to be run.) Returns the
+  ``TwitterStandIn``, for in-process use."""
+
+  standin = TwitterStandIn(**standin_options)
+  reactor.listenTCP(port, Site(StandInRoot(standin)), interface=interface)
+  LoopingCall(standin.keepAlive).start(keep_alive_interval, now=False)
+  log.info("Twitter stand-in listening on %s:%d", interface, port)
+  return standin
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--port', type=int, default=25001)
+  parser.add_argument('--interface', default='127.0.0.1')
+  parser.add_argument('--bot-id', type=int, default=1)
+  parser.add_argument('--bot-screen-name', default='twidibot')
+  parser.add_argument('--rate-limit-scale', type=float, default=1.0,
+      help='multiply all default rate limits by this')
+  parser.add_argument('--rate-limit-window', type=float,
+      default=RATE_LIMIT_WINDOW, help='seconds')
+  parser.add_argument('--call-log', help='also append calls to this file, '
+      'as JSON lines')
+  args = parser.parse_args(argv[1:])
+
+  rate_limits = dict((endpoint, max(1, int(limit * args.rate_limit_scale)))
+      for endpoint, limit in DEFAULT_RATE_LIMITS.iteritems())
+  runServer(args.port, args.interface, bot_id=args.bot_id,
+      bot_screen_name=args.bot_screen_name, rate_limits=rate_limits,
+      rate_limit_window=args.rate_limit_window, call_log=args.call_log)
+  reactor.run()
+
+
+if __name__ == '__main__':
+  main(sys.argv)
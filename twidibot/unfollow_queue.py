@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unfollowing users in the background, off the reply path.
+
+After a user is given bridges, the bot unfollows them (with
+UNFOLLOW_AFTER_GIVING_BRIDGES.) Instead of doing that right after the reply
+(another API round trip, or two, before the handler is done), the user is
+added to an ``UnfollowQueue``, which is drained in batches every so often, at
+its own rate (UNFOLLOW_BUDGET; apart from the DM budget.) Failed unfollows
+are retried, with backoff, up to ``max_attempts`` times.
+
+Pending unfollows are kept in a bot state container, one entry per account
+(see ``bot_state``), written back after each batch that changed anything and
+on ``stop()``; so they survive restarts (at worst, the last ``interval``
+seconds' worth is lost on a crash.)
+
+The queue runs on a thread of its own, or on the reactor (where ``unfollow``
+returns a Deferred.)
+"""
+
+import time
+import threading
+
+from twidibot import metrics
+from twidibot.logger import log, UserRef
+from twidibot.helpers import TokenBucket
+
+
+unfollows = metrics.counter('twidibot_unfollows_total',
+    'Queued unfollows, by result (done, retried, dropped.)', 'result')
+
+_queues = list() # started ones, for the gauge below
+pending_unfollows = metrics.gauge('twidibot_unfollows_pending',
+    'Unfollows waiting to be done, by account.',
+    lambda: dict((queue.name, len(queue)) for queue in _queues), 'account')
+
+
+class UnfollowQueue(object):
+  def __init__(self, container, name, unfollow, budget, batch_size=20,
+      interval=10.0, max_attempts=5, retry_delay=60.0, save=None,
+      ready=None):
+    """``container.users`` maps account ``name``s to their pending unfollows;
+    ``unfollow(user_id)`` does one (raising, or returning a Deferred that
+    fails, if it didn't work); ``budget`` is (count, per this many seconds);
+    ``save(container)``, if given, persists the container. ``ready`` (an
+    Event), if given, is set once the container is loaded; unfollows added
+    before that are kept, and done once it is."""
+
+    self.container = container
+    self.name = name
+    self.unfollow = unfollow
+    self.budget = TokenBucket.perPeriod(*budget)
+    self.batch_size = batch_size
+    self.interval = interval
+    self.max_attempts = max_attempts
+    self.retry_delay = retry_delay
+    self.save = save
+    self.ready = ready
+    self.pending = dict() # user ID => (queued at, attempts so far, not before)
+    self.in_flight = set()
+    self.dirty = False
+    self.loaded = False
+    self._lock = threading.Lock()
+    self._stopped = threading.Event()
+    self._thread = None
+    self._looping_call = None
+    self.load()
+
+  def __len__(self):
+    return len(self.pending)
+
+  def load(self):
+    """Take over the unfollows pending from before, once the container is
+    loaded. Returns whether it is."""
+
+    if self.loaded:
+      return True
+    if self.ready is not None and not self.ready.is_set():
+      return False
+    with self._lock:
+      pending = dict(self.container.users.get(self.name) or dict())
+      if pending:
+        log.info("%d unfollows pending from before.", len(pending))
+      pending.update(self.pending)
+      self.pending = pending
+      self.loaded = True
+    return True
+
+  def add(self, user_id):
+    with self._lock:
+      if user_id not in self.pending:
+        self.pending[user_id] = (time.time(), 0, 0.0)
+        self.dirty = True
+
+  def start(self, reactor=None):
+    """Drain every ``interval`` seconds: on the reactor, if given; otherwise
+    on a thread."""
+
+    _queues.append(self)
+    if reactor is not None:
+      from twisted.internet.task import LoopingCall
+      self._looping_call = LoopingCall(self.drain)
+      self._looping_call.clock = reactor
+      self._looping_call.start(self.interval, now=False)
+      return
+    self._thread = threading.Thread(target=self._run,
+        name='unfollow-queue-%s' % self.name)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self, timeout=None):
+    """Stop draining (waiting up to ``timeout`` seconds for a batch in
+    progress), and write what's still pending back to the container (which
+    is saved with the rest of the state, on shutdown.)"""
+
+    self._stopped.set()
+    if self._looping_call is not None and self._looping_call.running:
+      self._looping_call.stop()
+    if self._thread is not None and \
+        self._thread is not threading.current_thread():
+      self._thread.join(timeout)
+    if self in _queues:
+      _queues.remove(self)
+    self.checkpoint(save=False)
+
+  def _run(self):
+    while not self._stopped.wait(self.interval):
+      try:
+        self.drain()
+      except Exception as e:
+        log.exception("Draining the unfollow queue failed: %s", e)
+
+  def drain(self):
+    """Try (at most) one batch of due unfollows, oldest first, as far as the
+    budget allows. Returns how many were tried."""
+
+    if not self.load():
+      return 0
+    now = time.time()
+    with self._lock:
+      due = sorted((queued, user_id) for user_id, (queued, _, not_before)
+          in self.pending.iteritems()
+          if not_before <= now and user_id not in self.in_flight)
+    tried = 0
+    for _, user_id in due[:self.batch_size]:
+      if not self.budget.take():
+        metrics.budget_exhausted.inc('unfollow')
+        break
+      tried += 1
+      with self._lock:
+        self.in_flight.add(user_id)
+      try:
+        result = self.unfollow(user_id)
+      except Exception as e:
+        self._failed(user_id, e)
+        continue
+      if hasattr(result, 'addCallbacks'): # a Deferred, on the reactor
+        result.addCallbacks(lambda _, user_id=user_id: self._done(user_id),
+            lambda failure, user_id=user_id: self._failed(user_id,
+                failure.getErrorMessage()))
+      else:
+        self._done(user_id)
+    # (on the reactor, this batch's results get saved next time around)
+    self.checkpoint()
+    return tried
+
+  def _done(self, user_id):
+    with self._lock:
+      self.in_flight.discard(user_id)
+      self.pending.pop(user_id, None)
+      self.dirty = True
+    unfollows.inc('done')
+
+  def _failed(self, user_id, error):
+    with self._lock:
+      self.in_flight.discard(user_id)
+      queued, attempts, _ = self.pending.get(user_id, (time.time(), 0, 0.0))
+      attempts += 1
+      if attempts >= self.max_attempts:
+        self.pending.pop(user_id, None)
+        result = 'dropped'
+      else:
+        self.pending[user_id] = (queued, attempts,
+            time.time() + self.retry_delay * 2 ** (attempts - 1))
+        result = 'retried'
+      self.dirty = True
+    unfollows.inc(result)
+    log.warning("Failed to unfollow user %s (attempt %d; %s): %s",
+        UserRef(user_id), attempts, 'giving up' if result == 'dropped' else
+        'will retry', error)
+
+  def checkpoint(self, save=True):
+    """Write pending unfollows back to the container (and ``save`` it), if
+    anything changed."""
+
+    if not self.load():
+      return
+    with self._lock:
+      if not self.dirty:
+        return
+      self.container.users[self.name] = dict(self.pending)
+      self.dirty = False
+    if save and self.save is not None:
+      self.save(self.container)
+
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Watchdog for event handling that takes too long.
+
+Code handling one unit of work (e.g. one userstream event) does:
+
+  with watchdog.watch('direct_message'):
+    ...
+
+A background thread checks on the work in progress every ``check_interval``
+seconds. Work running for longer than ``deadline`` seconds gets the stack of
+the thread doing it logged (once), and is counted in ``metrics``. If
+``cancel_stuck`` is set, a ``WorkItemTimeout`` is also raised in that thread,
+which abandons the work item (the exception is swallowed by ``watch()``.)
+
+Note that an exception can only be delivered to a thread when it runs Python
+code: a thread blocked in a system call (e.g. a socket read without a
+timeout) only notices after the call returns. So API calls should have
+timeouts of their own (see config.TWITTER_API_TIMEOUT), and this is the net
+for everything else.
+"""
+
+import sys
+import time
+import ctypes
+import threading
+import traceback
+
+from twidibot import metrics
+from twidibot.logger import log
+
+
+stuck_work = metrics.counter('twidibot_stuck_work_total',
+    'Work items that ran past the watchdog deadline (detected, cancelled).',
+    'action')
+
+
+class WorkItemTimeout(BaseException):
+  """Raised in a thread whose work item was cancelled by the watchdog.
+
+  Not an ``Exception``, so that generic ``except Exception`` handlers along
+  the way don't swallow it.
+  """
+  pass
+
+
+def raiseInThread(thread_id, exception_class):
+  """Asynchronously raise ``exception_class`` in another thread; with
+  ``exception_class=None``, clear a pending one. Returns success."""
+
+  exc = ctypes.py_object(exception_class) if exception_class else None
+  modified = ctypes.pythonapi.PyThreadState_SetAsyncExc(
+      ctypes.c_long(thread_id), exc)
+  if modified > 1: # "you're in trouble" (says the C API documentation)
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(thread_id), None)
+    return False
+  return modified == 1
+
+
+class WorkItem(object):
+  __slots__ = ('watchdog', 'description', 'thread_id', 'start', 'reported',
+      'cancelled')
+
+  def __init__(self, watchdog, description):
+    self.watchdog = watchdog
+    self.description = description
+    self.thread_id = None
+    self.start = None
+    self.reported = False
+    self.cancelled = False
+
+  def __enter__(self):
+    self.thread_id = threading.current_thread().ident
+    self.start = time.time()
+    self.watchdog._begin(self)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.watchdog._end(self, exc_type)
+    if exc_type is WorkItemTimeout:
+      log.warning("Abandoned work item \"%s\" after %.1f s.",
+          self.description, time.time() - self.start)
+      return True # swallow it
+
+
+class Watchdog(object):
+  def __init__(self, deadline, check_interval=1.0, cancel_stuck=False):
+    self.deadline = deadline
+    self.check_interval = check_interval
+    self.cancel_stuck = cancel_stuck
+    self._active = dict() # thread id => WorkItem
+    self._lock = threading.Lock()
+    self._running = False
+
+  def watch(self, description):
+    """Return a context manager for one unit of work."""
+
+    return WorkItem(self, description)
+
+  def _begin(self, item):
+    with self._lock:
+      self._active[item.thread_id] = item
+
+  def _end(self, item, exc_type):
+    with self._lock:
+      if self._active.get(item.thread_id) is item:
+        del self._active[item.thread_id]
+      if item.cancelled and exc_type is not WorkItemTimeout:
+        # the work finished before the exception got delivered; don't let it
+        # hit whatever this thread does next:
+        raiseInThread(item.thread_id, None)
+
+  def start(self):
+    self._running = True
+    thread = threading.Thread(target=self._run, name='watchdog')
+    thread.daemon = True
+    thread.start()
+    log.debug("Watchdog started (deadline: %.1f s, cancel stuck work: %s)",
+        self.deadline, self.cancel_stuck)
+
+  def stop(self):
+    self._running = False
+
+  def _run(self):
+    while self._running:
+      time.sleep(self.check_interval)
+      self.check()
+
+  def check(self):
+    now = time.time()
+    frames = None
+    with self._lock:
+      for thread_id, item in self._active.items():
+        if item.reported or now - item.start < self.deadline:
+          continue
+        item.reported = True
+        if frames is None:
+          frames = sys._current_frames()
+        frame = frames.get(thread_id)
+        stack = ''.join(traceback.format_stack(frame)) if frame else '?'
+        log.warning("Work item \"%s\" has been running for %.1f s (deadline "
+            "%.1f s). Stack of thread %s:\n%s", item.description,
+            now - item.start, self.deadline, thread_id, stack)
+        stuck_work.inc('detected')
+        if self.cancel_stuck and raiseInThread(thread_id, WorkItemTimeout):
+          item.cancelled = True
+          stuck_work.inc('cancelled')
+
+
+if __name__ == '__main__':
+  pass
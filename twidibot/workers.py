@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Multi-process mode: one process reads the userstream, N workers handle it.
+
+The parent (``StreamDispatcher``) authenticates, owns the userstream
+connection, and does as little per event as it can: it pulls the sender's
+user ID out of the raw JSON (no full parse), and puts the event on the queue
+of worker ``hash(sender) % N``. So all events from one user go to the same
+worker, in order, and that worker alone holds their churn control and
+challenge-response state (in state files of its own, suffixed with the
+worker number - keep the number of workers the same across restarts, or
+users will land on a worker that doesn't know them.)
+
+Each worker is a full ``TwitterBot`` (with its own REST API handle) fed from
+its queue instead of a stream. The account's rate budgets (DM_BUDGET,
+FOLLOW_BUDGET, UNFOLLOW_BUDGET, and ADMISSION_BUDGET) are split between the
+workers, so that together they stay within them; per-user budgets aren't,
+as each user's events all go to one worker. Workers periodically send a
+snapshot of their metrics back; the parent serves them, summed, on its own
+metrics endpoint, along with per-worker dispatched/handled event counts. A
+worker that dies is restarted.
+
+On shutdown, the parent stops reading the stream, and tells the workers by
+when to be done (SHUTDOWN_DEADLINE); each handles what's in its queue until
+SHUTDOWN_SAVE_TIME before that, and saves the rest for next time (see
+``TwitterBot.drain()``.)
+
+  python quick_run.py --workers 4
+"""
+
+import os
+import re
+import json
+import time
+import signal
+import Queue
+import threading
+import multiprocessing
+
+import tweepy
+
+from twidibot import config, metrics, logger
+from twidibot.logger import log
+from twidibot.helpers import hash_user_handle
+from twidibot.bot_storage import StorageController, PersistableStorageHandler
+from twidibot.twitter_bot import TwitterBot
+
+
+dispatched_events = metrics.counter('twidibot_worker_events_dispatched_total',
+    'Userstream events handed to each worker process.', 'worker')
+handled_events = metrics.counter('twidibot_worker_events_handled_total',
+    'Userstream events handled by each worker process.', 'worker')
+worker_restarts = metrics.counter('twidibot_worker_restarts_total',
+    'Worker processes restarted after dying.')
+
+SENDER_ID_RE = re.compile(r'"sender_id"\s*:\s*(\d+)')
+# only matches if the "source" user object has no nested objects before its
+# "id"; otherwise, we fall back to parsing the JSON:
+SOURCE_ID_RE = re.compile(r'"source"\s*:\s*\{[^{}]*?"id"\s*:\s*(\d+)')
+
+
+def senderIdOf(raw_data):
+  """Return the ID (a string) of the user a userstream event is from (the
+  sender of a DM, the source of an event), or None."""
+
+  if '"direct_message"' in raw_data:
+    match = SENDER_ID_RE.search(raw_data)
+  elif '"event"' in raw_data:
+    match = SOURCE_ID_RE.search(raw_data)
+    if not match:
+      try:
+        return str(json.loads(raw_data)['source']['id'])
+      except (ValueError, KeyError, TypeError):
+        return None
+  else:
+    return None
+  return match.group(1) if match else None
+
+def partitionOf(user_id, num_workers):
+  return int(hash_user_handle(user_id)[:8], 16) % num_workers
+
+# (budgets for the whole account; see ``budgetShare()``)
+SHARED_BUDGETS = ('DM_BUDGET', 'FOLLOW_BUDGET', 'UNFOLLOW_BUDGET',
+    'ADMISSION_BUDGET')
+
+def budgetShare(budget, index, num_workers):
+  """Worker ``index``'s share of a (count, period) budget: the shares add up
+  to ``count`` (but each gets at least one.)"""
+
+  count, period = budget
+  share = count // num_workers + (1 if index < count % num_workers else 0)
+  return (max(1, share), period)
+
+
+def runWorker(index, num_workers, events, results, metrics_interval,
+    deadline):
+  """Worker process main loop: handle events from ``events`` until a None
+  arrives, sending metrics snapshots to ``results`` along the way. Once the
+  parent sets ``deadline`` (a shared value), events it's too late for are
+  only saved."""
+
+  # the parent tells us when to stop, after it's done dispatching:
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  # the parent serves metrics for all of us (we start counting from zero, even
+  # if forked from a parent that has counted things), and traces go to a file
+  # per process:
+  metrics.registry.reset()
+  config.METRICS_HTTP_PORT = None
+  config.TRACE_FILE = '%s.worker-%d' % (config.TRACE_FILE, index)
+  for name in SHARED_BUDGETS:
+    setattr(config, name, budgetShare(getattr(config, name), index,
+        num_workers))
+
+  bot = TwitterBot(storage_suffix='worker-%d.%s' % (index,
+      PersistableStorageHandler.DEFAULT_SUFFIX))
+  signal.signal(signal.SIGTERM, signal.SIG_IGN)
+  signal.signal(signal.SIGINT, signal.SIG_IGN) # (the bot set its own)
+  bot.authenticate()
+  bot.startUnfollowQueue()
+  bot.listener = listener = bot.makeListener()
+  bot.startResuming()
+  label = str(index)
+  log.info("Worker %d (pid %d) started.", index, os.getpid())
+
+  unfinished = list()
+  next_report = time.time() + metrics_interval
+  while True:
+    try:
+      raw_data = events.get(timeout=max(0, next_report - time.time()))
+    except Queue.Empty:
+      raw_data = ''
+    if raw_data is None:
+      break
+    if raw_data and deadline.value and \
+        time.time() > deadline.value - config.SHUTDOWN_SAVE_TIME:
+      unfinished.append(bot.workRecord('event', raw_data))
+    elif raw_data:
+      try:
+        listener.on_data(raw_data)
+      except Exception as e:
+        log.exception("Worker %d: failed to handle an event: %s", index, e)
+      handled_events.inc(label)
+    if time.time() >= next_report:
+      results.put((index, metrics.registry.snapshot()))
+      next_report = time.time() + metrics_interval
+
+  bot.drain(deadline.value or time.time() + config.SHUTDOWN_DEADLINE,
+      unfinished)
+  bot.storage_controller.closeAll()
+  results.put((index, metrics.registry.snapshot()))
+  log.info("Worker %d stopped.", index)
+  # (a worker process exits without running ``atexit`` handlers)
+  logger.flush(5.0)
+
+
+class WorkerPool(object):
+  """Worker processes, each with its own event queue."""
+
+  def __init__(self, num_workers, queue_size=10000, metrics_interval=5.0):
+    self.num_workers = num_workers
+    self.queue_size = queue_size
+    self.metrics_interval = metrics_interval
+    self.queues = [multiprocessing.Queue(queue_size)
+        for _ in xrange(num_workers)]
+    self.results = multiprocessing.Queue()
+    self.processes = [None] * num_workers
+    self.deadline = multiprocessing.Value('d', 0.0) # set by ``stop()``
+    self.snapshots = dict() # worker index => latest metrics snapshot
+    self.retired = list() # snapshots of dead workers (counters only)
+    self.stopping = False
+
+  def start(self):
+    for index in xrange(self.num_workers):
+      self.startWorker(index)
+    thread = threading.Thread(target=self._collect, name='worker-results')
+    thread.daemon = True
+    thread.start()
+    metrics.registry.addSource(self.metricsSnapshots)
+
+  def startWorker(self, index):
+    process = multiprocessing.Process(target=runWorker, name='worker-%d' %
+        index, args=(index, self.num_workers, self.queues[index], self.results,
+        self.metrics_interval, self.deadline))
+    process.daemon = True
+    process.start()
+    self.processes[index] = process
+
+  def dispatch(self, raw_data, sender_id):
+    index = partitionOf(sender_id, self.num_workers) if sender_id else 0
+    self.queues[index].put(raw_data) # blocks if the worker is far behind
+    dispatched_events.inc(str(index))
+
+  def metricsSnapshots(self):
+    return self.snapshots.values() + self.retired
+
+  def _collect(self):
+    while True:
+      try:
+        index, snapshot = self.results.get(timeout=1.0)
+        self.snapshots[index] = snapshot
+      except Queue.Empty:
+        pass
+      if self.stopping:
+        continue
+      for index, process in enumerate(self.processes):
+        if not process.is_alive():
+          log.error("Worker %d (pid %d) died (exit code %s); restarting it.",
+              index, process.pid, process.exitcode)
+          self.retire(index)
+          worker_restarts.inc()
+          self.startWorker(index)
+
+  def retire(self, index):
+    """Keep a dead worker's counts, but not its gauges (its successor will
+    report those.)"""
+
+    snapshot = self.snapshots.pop(index, None)
+    if snapshot:
+      self.retired.append(dict((name, entry) for name, entry in
+          snapshot.iteritems() if entry[0] != 'gauge'))
+
+  def stop(self, timeout=30.0):
+    """Let the workers finish what's queued (or save what they can't, in
+    ``timeout`` seconds), and stop them."""
+
+    self.stopping = True
+    deadline = time.time() + timeout
+    self.deadline.value = deadline
+    for events in self.queues:
+      events.put(None)
+    for index, process in enumerate(self.processes):
+      process.join(max(0, deadline - time.time()))
+      if process.is_alive():
+        log.warning("Worker %d didn't stop in time; terminating it.", index)
+        process.terminate()
+
+
+class DispatchingStreamListener(tweepy.StreamListener):
+  """Hands raw userstream events to a ``WorkerPool``."""
+
+  def __init__(self, pool, bot_id_str, api=None):
+    self.pool = pool
+    self.bot_id_str = bot_id_str
+    self.processing_data = False
+    self.processing_thread = None # (while processing_data)
+    self.current_data = None
+    self.dispatched = False # (``current_data``, to a worker)
+
+    super(DispatchingStreamListener, self).__init__(api)
+
+  def on_data(self, raw_data):
+    self.processing_data = True
+    self.processing_thread = threading.current_thread()
+    self.current_data = raw_data
+    self.dispatched = False
+    try:
+      sender_id = senderIdOf(raw_data)
+      # DMs sent by us come back on the stream, too; nobody needs those:
+      if not (sender_id == self.bot_id_str and
+          '"direct_message"' in raw_data):
+        self.pool.dispatch(raw_data, sender_id)
+      self.dispatched = True
+    finally:
+      self.processing_data = False
+
+  def on_error(self, status_code):
+    return False
+
+
+class StreamDispatcher(TwitterBot):
+  """A ``TwitterBot`` that owns the userstream but handles no events itself;
+  it has no state of its own, either."""
+
+  def __init__(self, num_workers, **kw):
+    self.access_config = self.accessConfigFrom(kw)
+    self.storage_controller = StorageController(list())
+    self.watchdog = None
+    self.scheduler = None
+    self.reactor = None
+    self.unfollow_queue = None
+    self.storage_suffix = None
+    self.listener = self.stream = None
+    self.stopping = False
+
+    # start the workers before we have threads (of our own) or connections:
+    self.pool = WorkerPool(num_workers, queue_size=config.WORKER_QUEUE_SIZE,
+        metrics_interval=config.WORKER_METRICS_INTERVAL)
+    self.pool.start()
+    log.info("Started %d worker processes.", num_workers)
+
+    if config.METRICS_HTTP_PORT:
+      metrics.startHTTPServer(config.METRICS_HTTP_PORT,
+          config.METRICS_HTTP_HOST)
+
+    self.setSignalHandlers()
+
+  def startUnfollowQueue(self):
+    pass # (the workers do the unfollowing)
+
+  def startResuming(self):
+    pass # (the workers resume their own unfinished work)
+
+  def makeListener(self):
+    return DispatchingStreamListener(self.pool, self.bot_info.id_str,
+        api=self.api)
+
+  def drain(self, deadline, records=()):
+    """Stop reading the stream, and stop the workers (which save what they
+    can't finish by ``deadline``.)"""
+
+    self.stopIntake()
+    for _, _, raw_data in self.finishListening(deadline):
+      # dispatch the event we interrupted, unless it got to a worker already
+      # (only DMs are deduplicated there; a follow would be followed back,
+      # and greeted, twice):
+      if not self.listener.dispatched:
+        self.listener.on_data(raw_data)
+    log.info("Stopping workers.")
+    self.pool.stop(max(0, deadline - time.time()))
+
+
+if __name__ == '__main__':
+  pass